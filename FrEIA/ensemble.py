@@ -0,0 +1,109 @@
+'''Vectorized ensembles of ReversibleGraphNets. The parameters of K nets with
+the same structure are stacked along a new leading dimension, and all members
+are evaluated in one call with torch.func.vmap, so the linear layers of the
+subnets become batched matrix multiplications instead of K sequential passes
+through small layers.'''
+
+import copy
+
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+
+class Ensemble(nn.Module):
+    '''Runs the list of ReversibleGraphNets nets as one batched model. The
+    stacked parameters are parameters of the ensemble, so it can be trained
+    with a single optimizer. The nets themselves are not changed afterwards,
+    use member(k) to get a net with the current parameters of member k.
+
+    Reversible backprop is not supported inside vmap, the members always
+    store their intermediate results for the backward pass.'''
+
+    def __init__(self, nets):
+        super(Ensemble, self).__init__()
+        self.n_members = len(nets)
+
+        # The modules of the template are only used for their structure, the
+        # stacked tensors are swapped in for every call. It is not registered
+        # as a submodule, so that its own parameters are not trained.
+        template = copy.deepcopy(nets[0])
+        template.reversible_backprop = False
+        # Buffers and log scales kept across calls can't hold the batched
+        # tensors of vmap, and vmap doesn't carry over to other threads
+        template.reuse_buffers = False
+        template.parallel_branches = False
+        template.set_log_scale_cache(False)
+        self.__dict__['template'] = template
+
+        params, buffers = stack_module_state(nets)
+        self._param_names = list(params)
+        self._buffer_names = list(buffers)
+        for name, p in params.items():
+            self.register_parameter(self._key(name), nn.Parameter(
+                p.detach(), requires_grad=p.requires_grad))
+        for name, b in buffers.items():
+            self.register_buffer(self._key(name), b)
+
+    @staticmethod
+    def _key(name):
+        return name.replace('.', '__')
+
+    def _stacked_state(self):
+        state = {name: getattr(self, self._key(name))
+                 for name in self._param_names}
+        state.update({name: getattr(self, self._key(name))
+                      for name in self._buffer_names})
+        return state
+
+    def forward(self, x, rev=False, jac=False, shared=False, pool=False):
+        '''Run all members in the given direction. x is a tensor (or list of
+        tensors, as for ReversibleGraphNet) with a leading dimension of size
+        n_members, holding the inputs of every member, or with shared=True,
+        one batch that is passed to every member. The outputs (and log
+        jacobian determinants) have a leading member dimension, unless pool
+        is set, in which case the members are merged into the batch
+        dimension, e.g. to get the pooled posterior samples of all members
+        from one call.'''
+        template = self.template
+
+        def run_member(state, x):
+            return functional_call(template, state, (x,),
+                                   {'rev': rev, 'jac': jac})
+
+        # randomness='different' gives every member its own dropout masks
+        out = vmap(run_member, in_dims=(0, None if shared else 0),
+                   randomness='different')(self._stacked_state(), x)
+
+        # The template kept a reference to the batched intermediate results
+        template._last_run.buffer = None
+
+        if pool:
+            out = _pool(out)
+        return out
+
+    def member(self, k):
+        '''A standalone ReversibleGraphNet with the current parameters and
+        buffers of member k.'''
+        net = copy.deepcopy(self.template)
+        with torch.no_grad():
+            for name in self._param_names:
+                stacked = getattr(self, self._key(name))
+                net.get_parameter(name).copy_(stacked[k])
+            for name in self._buffer_names:
+                stacked = getattr(self, self._key(name))
+                net.get_buffer(name).copy_(stacked[k])
+        return net
+
+    def train(self, mode=True):
+        super(Ensemble, self).train(mode)
+        self.template.train(mode)
+        return self
+
+
+def _pool(out):
+    '''Merge the leading member dimension into the batch dimension of all
+    tensors in out.'''
+    if torch.is_tensor(out):
+        return out.reshape((-1,) + out.shape[2:])
+    return type(out)(_pool(o) for o in out)
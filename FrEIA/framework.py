@@ -2,21 +2,88 @@
 inferring the order that the nodes have to be executed in forward and backward
 direction.'''
 
+import contextlib
+import gc
+import inspect
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from operator import itemgetter
+from typing import List
+
+import torch
+import torch.fx
 import torch.nn as nn
-from torch.autograd import Variable
 
 import FrEIA.dummy_modules as dummys
 
 verbose=True
 
+
+def _post_order(root, neighbours, done):
+    '''Returns the nodes reachable from root (including root itself) that
+    are not done yet, in depth-first post-order, i.e. every node comes after
+    all of its neighbours. Iterative instead of recursive, so that very deep
+    graphs don't run into the recursion limit.'''
+    order = []
+    seen = {id(root)}
+    stack = [(root, iter(neighbours(root)))]
+    while stack:
+        node, remaining = stack[-1]
+        for n in remaining:
+            if id(n) not in seen and not done(n):
+                seen.add(id(n))
+                stack.append((n, iter(neighbours(n))))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+    return order
+
+
+# (emits_jac, accepts_out) per forward function, see _forward_flags
+_forward_flags_cache = weakref.WeakKeyDictionary()
+
+
+def _forward_flags(module):
+    '''Whether the forward method of module has a 'jac' and an 'out'
+    argument. Looked up once per forward function (i.e. per module class)
+    and shared by all plans, inspect.signature is too slow to call for every
+    op of a deep net.'''
+    forward = getattr(module.forward, '__func__', module.forward)
+    try:
+        return _forward_flags_cache[forward]
+    except (KeyError, TypeError):
+        pass
+    params = inspect.signature(module.forward).parameters
+    flags = ('jac' in params, 'out' in params)
+    try:
+        _forward_flags_cache[forward] = flags
+    except TypeError:
+        pass
+    return flags
+
+
 class Node:
     '''The Node class represents one transformation in the graph, with an
-    arbitrary number of in- and outputs.'''
-    def __init__(self, inputs, module_type, module_args, name=None):
+    arbitrary number of in- and outputs. With checkpoint_subnets=True, the
+    subnets of a coupling layer don't keep their hidden activations for the
+    backward pass, they are recomputed instead (see run_subnet). Modules
+    without subnets ignore it.
+
+    conditions is a list of ConditionNodes, whose data is passed to the
+    module as a side input. The module is then constructed with the
+    additional argument dims_c (the list of their dimensions), and gets the
+    condition tensors appended to its list of inputs in both directions.'''
+    def __init__(self, inputs, module_type, module_args, name=None,
+                 checkpoint_subnets=False, conditions=None):
         self.inputs = inputs
         self.outputs = []
         self.module_type = module_type
         self.module_args = module_args
+        self.checkpoint_subnets = checkpoint_subnets
+        self.conditions = conditions or []
 
         self.input_dims, self.module = None, None
         self.computed = None
@@ -27,60 +94,106 @@ class Node:
             self.name = name
         else:
             self.name = hex(id(self))[-6:]
-        for i in range(255):
-            exec('self.out{0} = (self, {0})'.format(i))
+
+    def __getattr__(self, name):
+        # The output handles out0, out1, ... are created on first access
+        if name.startswith('out') and name[3:].isdigit():
+            handle = (self, int(name[3:]))
+            self.__dict__[name] = handle
+            return handle
+        raise AttributeError("'%s' object has no attribute '%s'"
+                             % (type(self).__name__, name))
+
+    def _input_nodes(self):
+        return [n for n, c in self.inputs]
+
+    def _output_nodes(self):
+        return [n for n, c in self.outputs]
 
     def build_modules(self, verbose=True):
         ''' Returns a list with the dimension of each output of this node,
-        recursively calling build_modules of the nodes connected to the input.
-        Use this information to initialize the pytorch nn.Module of this node.
+        building the nodes connected to the input first. Use this information
+        to initialize the pytorch nn.Module of this node.
         '''
 
         if not self.input_dims:  # Only do it if this hasn't been computed yet
-            self.input_dims = [n.build_modules(verbose=verbose)[c]
-                               for n, c in self.inputs]
-            try:
-                self.module = self.module_type(self.input_dims,
-                                               **self.module_args)
-            except Exception as e:
-                print('Error in node %s' % (self.name))
-                raise e
-
-            if verbose:
-                print("Node %s has following input dimensions:" % (self.name))
-                for d, (n, c) in zip(self.input_dims, self.inputs):
-                    print("\t Output #%i of node %s:" % (c, n.name), d)
-                print()
-
-            self.output_dims = self.module.output_dims(self.input_dims)
-            self.n_outputs = len(self.output_dims)
+            for n in _post_order(self, Node._input_nodes,
+                                 lambda n: (isinstance(n, InputNode)
+                                            or n.input_dims)):
+                n._build_module(verbose=verbose)
 
         return self.output_dims
 
+    def _build_module(self, verbose=True):
+        '''Initialize the nn.Module of this node, all input nodes have to be
+        built already.'''
+        input_dims = [n.build_modules(verbose=verbose)[c]
+                      for n, c in self.inputs]
+        dims_c = [n.build_modules(verbose=verbose)[0]
+                  for n in self.conditions]
+        try:
+            self._instantiate(input_dims, dims_c)
+        except Exception as e:
+            print('Error in node %s' % (self.name))
+            raise e
+
+        if verbose:
+            print("Node %s has following input dimensions:" % (self.name))
+            for d, (n, c) in zip(self.input_dims, self.inputs):
+                print("\t Output #%i of node %s:" % (c, n.name), d)
+            print()
+
+    def _instantiate(self, input_dims, dims_c=None):
+        '''Construct the nn.Module of this node for the given input
+        dimensions (and those of the conditions).'''
+        self.input_dims = input_dims
+        self.dims_c = dims_c
+        if self.conditions:
+            self.module = self.module_type(self.input_dims, dims_c=dims_c,
+                                           **self.module_args)
+        else:
+            self.module = self.module_type(self.input_dims,
+                                           **self.module_args)
+        if self.checkpoint_subnets and hasattr(self.module,
+                                               'checkpoint_subnets'):
+            self.module.checkpoint_subnets = True
+        self.output_dims = self.module.output_dims(self.input_dims)
+        self.n_outputs = len(self.output_dims)
+
     def run_forward(self, op_list):
-        '''Determine the order of operations needed to reach this node. Calls
-        run_forward of parent nodes recursively. Each operation is appended to
+        '''Determine the order of operations needed to reach this node. Runs
+        run_forward of parent nodes first. Each operation is appended to
         the global list op_list, in the form (node ID, input variable IDs,
         output variable IDs)'''
 
         if not self.computed:
-
-            # Compute all nodes which provide inputs, filter out the
-            # channels you need
-            self.input_vars = []
-            for i, (n, c) in enumerate(self.inputs):
-                self.input_vars.append(n.run_forward(op_list)[c])
-                # Register youself as an output in the input node
-                n.outputs.append((self, i))
-
-            # All outputs could now be computed
-            self.computed = [(self.id, i) for i in range(self.n_outputs)]
-            op_list.append((self.id, self.input_vars, self.computed))
+            for n in _post_order(self, Node._input_nodes,
+                                 lambda n: (isinstance(n, InputNode)
+                                            or n.computed)):
+                n._run_forward(op_list)
 
         # Return the variables you have computed (this happens mulitple times
         # without recomputing if called repeatedly)
         return self.computed
 
+    def _run_forward(self, op_list):
+        # Compute all nodes which provide inputs, filter out the
+        # channels you need
+        self.input_vars = []
+        for i, (n, c) in enumerate(self.inputs):
+            self.input_vars.append(n.run_forward(op_list)[c])
+            # Register youself as an output in the input node
+            n.outputs.append((self, i))
+
+        # All outputs could now be computed
+        self.computed = [(self.id, i) for i in range(self.n_outputs)]
+        op_list.append((self.id, self.input_vars + self._condition_vars(),
+                        self.computed))
+
+    def _condition_vars(self):
+        # The conditions are read in both directions, and never computed
+        return [(n.id, 0) for n in self.conditions]
+
     def run_backward(self, op_list):
         '''See run_forward, this is the same, only for the reverse computation.
         Need to call run_forward first, otherwise this function will not
@@ -88,20 +201,25 @@ class Node:
 
         assert len(self.outputs) > 0, "Call run_forward first"
         if not self.computed_rev:
+            for n in _post_order(self, Node._output_nodes,
+                                 lambda n: (isinstance(n, OutputNode)
+                                            or n.computed_rev)):
+                n._run_backward(op_list)
 
-            # These are the input variables that must be computed first
-            output_vars = [(self.id, i) for i in range(self.n_outputs)]
+        return self.computed_rev
 
-            # Recursively compute these
-            for n, c in self.outputs:
-                n.run_backward(op_list)
+    def _run_backward(self, op_list):
+        assert len(self.outputs) > 0, "Call run_forward first"
 
-            # The variables that this node computes are the input variables
-            # from the forward pass
-            self.computed_rev = self.input_vars
-            op_list.append((self.id, output_vars, self.computed_rev))
+        # These are the input variables that must be computed first, the
+        # nodes producing them have already been run
+        output_vars = [(self.id, i) for i in range(self.n_outputs)]
 
-        return self.computed_rev
+        # The variables that this node computes are the input variables
+        # from the forward pass
+        self.computed_rev = self.input_vars
+        op_list.append((self.id, output_vars + self._condition_vars(),
+                        self.computed_rev))
 
 
 class InputNode(Node):
@@ -112,6 +230,7 @@ class InputNode(Node):
         self.name = name
         self.data = dummys.dummy_data(*dims)
         self.outputs = []
+        self.conditions = []
         self.module = None
         self.computed_rev = None
         self.n_outputs = 1
@@ -125,6 +244,46 @@ class InputNode(Node):
         return [(self.id, 0)]
 
 
+class ConditionNode(Node):
+    '''Special type of node for data the net is conditioned on (e.g. the
+    observation in a conditional INN). It is not transformed, but passed to
+    the modules of all nodes that list it in their conditions, in both
+    directions. If feature_net (an nn.Module) is given, it is applied to the
+    condition once per call of the net, and the modules get its output
+    instead. Conditions with a batch size of one are broadcast to the batch
+    size of the inputs, so e.g. drawing many posterior samples for a single
+    observation evaluates the feature net only once.'''
+
+    def __init__(self, *dims, name='node', feature_net=None):
+        self.name = name
+        self.dims = dims
+        self.inputs = []
+        self.outputs = []
+        self.conditions = []
+        self.module = feature_net
+        self.id = None
+        self.output_dims = [self._feature_dims()]
+
+    def _feature_dims(self):
+        if self.module is None:
+            return tuple(self.dims)
+
+        # Evaluated on one dummy sample, without changing e.g. the running
+        # statistics of batch norm layers
+        param = next(self.module.parameters(), None)
+        training = self.module.training
+        self.module.eval()
+        with torch.no_grad():
+            features = self.module(torch.zeros(
+                (1,) + tuple(self.dims),
+                device=None if param is None else param.device))
+        self.module.train(training)
+        return tuple(features.shape[1:])
+
+    def build_modules(self, verbose=True):
+        return self.output_dims
+
+
 class OutputNode(Node):
     '''Special type of node that represents the output of the whole net (of the
     input when running in reverse)'''
@@ -133,14 +292,16 @@ class OutputNode(Node):
         def __init__(self, *args):
             super(OutputNode.dummy, self).__init__()
 
-        def __call__(*args):
-            return args
+        def forward(self, x, rev=False):
+            return x
 
-        def output_dims(*args):
-            return args
+        def output_dims(self, input_dims):
+            return input_dims
 
     def __init__(self, inputs, name='node'):
         self.module_type, self.module_args = self.dummy, {}
+        self.checkpoint_subnets = False
+        self.conditions = []
         self.output_dims = []
         self.inputs = inputs
         self.input_dims, self.module = None, None
@@ -155,16 +316,410 @@ class OutputNode(Node):
         return [(self.id, 0)]
 
 
+class ExecutionPlan:
+    '''Flat, precompiled sequence of operations for one direction of a
+    ReversibleGraphNet. Built once from the indexed op list, it holds the
+    module of every op together with its input and output slot indices, so
+    that executing the graph is a single loop over plain tuples writing into a
+    per-call slot buffer.'''
+
+    def __init__(self, module_list, indexed_ops, input_slots, output_slots,
+                 n_slots, rev=False):
+        for o in indexed_ops:
+            if o[0] is None or module_list[o[0]] is None:
+                raise RuntimeError("Are you sure all used Nodes are in the "
+                                   "Node list?")
+
+        self.rev = rev
+        self.n_slots = n_slots
+        self.module_list = module_list
+        self.indexed_ops = tuple(indexed_ops)
+        self.node_ids = tuple(o[0] for o in indexed_ops)
+        self.modules = tuple(module_list[o[0]] for o in indexed_ops)
+        self.in_slots = tuple(tuple(o[1]) for o in indexed_ops)
+        self.out_slots = tuple(tuple(o[2]) for o in indexed_ops)
+        self.input_slots = tuple(input_slots)
+        self.output_slots = tuple(output_slots)
+
+        # Outputs of ops that are neither read later on nor returned, which
+        # happens for plans pruned to a subset of the outputs
+        used = set(self.output_slots).union(*self.in_slots)
+        self.unused_slots = tuple(i for outs in self.out_slots for i in outs
+                                  if i not in used)
+
+        # Slicing a single slot keeps the 'list of inputs' calling convention
+        # of the modules without building a new list in Python for every op
+        self.gathers = tuple(itemgetter(slice(s[0], s[0]+1)) if len(s) == 1
+                             else itemgetter(*s) for s in self.in_slots)
+        self.steps = tuple(zip(self.modules, self.gathers, self.out_slots))
+
+        # Modules with a 'jac' argument return their log jacobian determinant
+        # together with the output, for all others it is computed separately
+        flags = [_forward_flags(m) for m in self.modules]
+        self.emits_jac = tuple(f[0] for f in flags)
+        self.jac_steps = tuple(zip(self.modules, self.gathers, self.out_slots,
+                                   self.emits_jac))
+
+        # Modules with an 'out' argument can write their result into a given
+        # tensor, see execute with a pool
+        self.accepts_out = tuple(f[1] for f in flags)
+        self.buffer_ids, self.n_buffers = self._assign_buffers()
+
+        # Ops grouped by their depth in the graph. Ops of the same level don't
+        # depend on each other, so they can run at the same time.
+        depth = {i: 0 for i in self.input_slots}
+        levels = []
+        for k, (ins, outs) in enumerate(zip(self.in_slots, self.out_slots)):
+            level = max([depth.get(i, 0) for i in ins], default=0)
+            for i in outs:
+                depth[i] = level + 1
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(k)
+        self.levels = tuple(tuple(level) for level in levels)
+        self.pooled_steps = tuple(zip(self.modules, self.gathers,
+                                      self.out_slots, self.emits_jac,
+                                      self.buffer_ids))
+
+    def _assign_buffers(self):
+        '''Assign a reusable buffer to every op with an 'out' argument and a
+        single output that is not returned. The outputs of the other ops can be
+        views of their inputs (e.g. split_layer), so a buffer only becomes free
+        again when no live slot can refer to it anymore. For a chain of blocks
+        this alternates between two buffers. Returns the buffer index of every
+        op (None if it allocates its output) and the number of buffers.'''
+        n_ops = len(self.modules)
+        pooled = [self.accepts_out[k] and len(self.out_slots[k]) == 1
+                  for k in range(n_ops)]
+
+        # The ops whose output each slot may share memory with
+        aliases = {}
+        for k in range(n_ops):
+            if pooled[k]:
+                aliases[self.out_slots[k][0]] = {k}
+            else:
+                shared = set().union(*[aliases.get(i, set())
+                                       for i in self.in_slots[k]])
+                for i in self.out_slots[k]:
+                    aliases[i] = shared
+        for i in self.output_slots:
+            for k in aliases.get(i, ()):
+                pooled[k] = False
+
+        last_use = {}
+        for k, ins in enumerate(self.in_slots):
+            for i in ins:
+                last_use[i] = k
+
+        buffer_ids = [None] * n_ops
+        n_buffers = 0
+        free = []
+        # Number of live slots that may refer to each buffer
+        n_refs = {}
+        live = {}
+        for k in range(n_ops):
+            if pooled[k]:
+                if free:
+                    buffer_ids[k] = free.pop()
+                else:
+                    buffer_ids[k] = n_buffers
+                    n_buffers += 1
+
+            for i in self.out_slots[k]:
+                live[i] = {buffer_ids[j] for j in aliases[i]
+                           if buffer_ids[j] is not None}
+                for b in live[i]:
+                    n_refs[b] = n_refs.get(b, 0) + 1
+
+            dead = [i for i in set(self.in_slots[k]) if last_use[i] == k]
+            dead += [i for i in self.out_slots[k] if i not in last_use]
+            for i in dead:
+                for b in live.pop(i, ()):
+                    n_refs[b] -= 1
+                    if n_refs[b] == 0:
+                        free.append(b)
+
+        return tuple(buffer_ids), n_buffers
+
+    def prune(self, output_slots):
+        '''Returns a plan that only computes the given output slots. All ops
+        that don't contribute to any of them are dropped, walking backwards
+        from the requested slots. The inputs stay the same.'''
+        needed = set(output_slots)
+        kept = []
+        for o in reversed(self.indexed_ops):
+            if needed.intersection(o[2]):
+                kept.append(o)
+                needed.update(o[1])
+        kept.reverse()
+        return ExecutionPlan(self.module_list, kept, self.input_slots,
+                             output_slots, self.n_slots, rev=self.rev)
+
+    def execute(self, inputs, jac=False, pool=None, executor=None):
+        '''Run the plan on a list of input tensors. Returns the filled slot
+        buffer and, if jac is set, the per-sample log jacobian determinant
+        accumulated over all ops (otherwise None).
+
+        With pool, a dict owned by the caller, the ops with a buffer (see
+        _assign_buffers) write their outputs into tensors kept in the pool
+        from the previous call, instead of allocating new ones. This only
+        works without autograd, and the intermediate results in the slot
+        buffer are overwritten by later ops.
+
+        With executor, a concurrent.futures.Executor, the ops of every level
+        that has more than one are run concurrently on it. The log jacobian
+        determinant is then summed level by level, which may differ from the
+        sequential order by rounding.'''
+        if pool is not None:
+            return self._execute_pooled(inputs, jac, pool)
+        if executor is not None:
+            return self._execute_parallel(inputs, jac, executor)
+
+        buf = [None] * self.n_slots
+        for i, x in zip(self.input_slots, inputs):
+            buf[i] = x
+
+        rev = self.rev
+        if not jac:
+            for module, gather, outs in self.steps:
+                results = module(gather(buf), rev=rev)
+                for k, i in enumerate(outs):
+                    buf[i] = results[k]
+            return buf, None
+
+        log_jac = 0
+        for module, gather, outs, emits_jac in self.jac_steps:
+            x = gather(buf)
+            if emits_jac:
+                results, j = module(x, rev=rev, jac=True)
+            else:
+                results = module(x, rev=rev)
+                j = module.jacobian(x, rev=rev)
+            log_jac = log_jac + j
+            for k, i in enumerate(outs):
+                buf[i] = results[k]
+
+        return buf, self.per_sample(log_jac, inputs[0])
+
+    def _execute_pooled(self, inputs, jac, pool):
+        buf = [None] * self.n_slots
+        for i, x in zip(self.input_slots, inputs):
+            buf[i] = x
+
+        rev = self.rev
+        log_jac = 0
+        for module, gather, outs, emits_jac, b in self.pooled_steps:
+            x = gather(buf)
+            kwargs = {} if b is None else {'out': pool.get(b)}
+            if jac and emits_jac:
+                results, j = module(x, rev=rev, jac=True, **kwargs)
+            else:
+                results = module(x, rev=rev, **kwargs)
+                if jac:
+                    j = module.jacobian(x, rev=rev)
+            if jac:
+                log_jac = log_jac + j
+            # Keeps the tensor allocated in the first call (or for a new
+            # batch size) for the next one
+            if b is not None:
+                pool[b] = results[0]
+            for k, i in enumerate(outs):
+                buf[i] = results[k]
+
+        if jac:
+            return buf, self.per_sample(log_jac, inputs[0])
+        return buf, None
+
+    def _execute_parallel(self, inputs, jac, executor):
+        buf = [None] * self.n_slots
+        for i, x in zip(self.input_slots, inputs):
+            buf[i] = x
+
+        rev = self.rev
+        # Grad mode is local to each thread
+        grad_enabled = torch.is_grad_enabled()
+
+        def run(k):
+            module, gather, outs, emits_jac = self.jac_steps[k]
+            with torch.set_grad_enabled(grad_enabled):
+                x = gather(buf)
+                if not jac:
+                    return module(x, rev=rev), None
+                if emits_jac:
+                    return module(x, rev=rev, jac=True)
+                return module(x, rev=rev), module.jacobian(x, rev=rev)
+
+        log_jac = 0
+        for level in self.levels:
+            # The first op runs in the calling thread meanwhile
+            futures = [executor.submit(run, k) for k in level[1:]]
+            results = [run(level[0])] + [f.result() for f in futures]
+            for k, (outputs, j) in zip(level, results):
+                for c, i in enumerate(self.out_slots[k]):
+                    buf[i] = outputs[c]
+                if jac:
+                    log_jac = log_jac + j
+
+        if jac:
+            return buf, self.per_sample(log_jac, inputs[0])
+        return buf, None
+
+    @staticmethod
+    def per_sample(log_jac, x):
+        '''Broadcast a log jacobian determinant that doesn't depend on the
+        sample (a number or a 0-d tensor) to the batch size of x.'''
+        if isinstance(log_jac, (int, float)):
+            return x.new_full((x.shape[0],), log_jac)
+        if torch.is_tensor(log_jac) and log_jac.dim() == 0:
+            return log_jac.expand(x.shape[0])
+        return log_jac
+
+
+class ReversibleBackprop(torch.autograd.Function):
+    '''Runs an ExecutionPlan without keeping any intermediate activations for
+    the backward pass, as in RevNet. During backward, the inputs of every op
+    are reconstructed from its outputs with the op's own inverse direction,
+    and the op is then re-run locally to obtain the gradients. Activation
+    memory is therefore independent of the depth of the net.
+
+    The ops have to be exactly invertible and deterministic, i.e. this gives
+    wrong gradients with dropout in the subnets, and batch norm statistics
+    are updated twice.
+
+    The last n_cond inputs are the conditions of the net. They are never
+    inverted, but kept for the backward pass and passed unchanged to the ops
+    reading them in both directions, and their gradients are summed over
+    these ops.'''
+
+    @staticmethod
+    def forward(ctx, plan, jac, n_inputs, n_cond, *args):
+        inputs, params = args[:n_inputs], args[n_inputs:]
+        ctx.plan, ctx.jac, ctx.params = plan, jac, params
+        ctx.inputs_need_grad = [x.requires_grad for x in inputs]
+        ctx.cond_slots = tuple(plan.input_slots[n_inputs - n_cond:])
+
+        with torch.no_grad():
+            buf, log_jac = plan.execute(list(inputs), jac=jac)
+
+        outputs = [buf[i] for i in plan.output_slots]
+        # The unused outputs are needed as well to invert their ops
+        ctx.save_for_backward(*outputs, *[buf[i] for i in plan.unused_slots],
+                              *inputs[n_inputs - n_cond:])
+
+        if jac:
+            return tuple(outputs) + (log_jac,)
+        return tuple(outputs)
+
+    @staticmethod
+    def backward(ctx, *grad_outputs):
+        plan, jac = ctx.plan, ctx.jac
+        buf = [None] * plan.n_slots
+        grads = [None] * plan.n_slots
+        for i, y, g in zip(plan.output_slots, ctx.saved_tensors,
+                           grad_outputs):
+            buf[i], grads[i] = y.detach(), g
+        for i, y in zip(plan.unused_slots + ctx.cond_slots,
+                        ctx.saved_tensors[len(plan.output_slots):]):
+            buf[i] = y.detach()
+        grad_jac = grad_outputs[-1] if jac else None
+
+        param_grads = {}
+        for (module, gather, outs, emits_jac), ins in zip(
+                reversed(plan.jac_steps), reversed(plan.in_slots)):
+            # Reconstruct the inputs of the op from its outputs, the
+            # conditions (always the last inputs of an op) are passed along
+            conds = [i for i in ins if i in ctx.cond_slots]
+            c = [buf[i].requires_grad_() for i in conds]
+            with torch.no_grad():
+                x = module([buf[i] for i in outs] + c, rev=not plan.rev)
+            x = [t.detach().requires_grad_() for t in x] + c
+            for i in outs:
+                buf[i] = None
+
+            # Re-run the op with gradients to backpropagate through it
+            with torch.enable_grad():
+                if not jac:
+                    results = module(x, rev=plan.rev)
+                elif emits_jac:
+                    results, j = module(x, rev=plan.rev, jac=True)
+                else:
+                    results = module(x, rev=plan.rev)
+                    j = module.jacobian(x, rev=plan.rev)
+
+            # The log scales of the re-run would stay alive for every op
+            if hasattr(module, 'cache_log_scales'):
+                module._log_scales.clear()
+
+            tensors, tensor_grads = [], []
+            for k, i in enumerate(outs):
+                if grads[i] is not None and results[k].requires_grad:
+                    tensors.append(results[k])
+                    tensor_grads.append(grads[i])
+                grads[i] = None
+            if jac and torch.is_tensor(j) and j.requires_grad:
+                tensors.append(j)
+                tensor_grads.append(grad_jac.expand_as(j))
+
+            params = [p for p in module.parameters() if p.requires_grad]
+            if tensors:
+                g = torch.autograd.grad(tensors, x + params, tensor_grads,
+                                        allow_unused=True)
+            else:
+                g = [None] * (len(x) + len(params))
+
+            for i, t, g_x in zip(ins, x, g):
+                if i in ctx.cond_slots:
+                    if g_x is not None:
+                        grads[i] = g_x if grads[i] is None else grads[i] + g_x
+                    continue
+                buf[i] = t.detach()
+                grads[i] = g_x
+            for p, g_p in zip(params, g[len(x):]):
+                if g_p is not None:
+                    param_grads[p] = (g_p if p not in param_grads
+                                      else param_grads[p] + g_p)
+
+        input_grads = [grads[i] if need else None for i, need in
+                       zip(plan.input_slots, ctx.inputs_need_grad)]
+        return ((None, None, None, None) + tuple(input_grads)
+                + tuple(param_grads.get(p) for p in ctx.params))
+
+
 class ReversibleGraphNet(nn.Module):
     '''This class represents the invertible net itself. It is a subclass of
     torch.nn.Module and supports the same methods. The forward method has an
     additional option 'rev', whith which the net can be computed in reverse.'''
 
-    def __init__(self, node_list, ind_in=None, ind_out=None, verbose=True):
+    def __init__(self, node_list, ind_in=None, ind_out=None, verbose=True,
+                 reversible_backprop=False, reuse_buffers=False,
+                 parallel_branches=False, output_order='source'):
         '''node_list should be a list of all nodes involved, and ind_in,
         ind_out are the indexes of the special nodes InputNode and OutputNode
-        in this list.'''
+        in this list. With reversible_backprop=True, no intermediate
+        activations are stored for the backward pass, they are recomputed from
+        the outputs instead (see ReversibleBackprop). With reuse_buffers=True,
+        calls without gradients write the outputs of the coupling blocks and
+        permutations into buffers that are reused between the blocks and
+        across calls, instead of allocating new ones for every block (see
+        ExecutionPlan.execute). With parallel_branches=True, independent
+        branches of the graph (e.g. after a split_layer) run concurrently on
+        a thread pool of the net, unless one of the two other options is
+        active for the call.
+
+        output_order sets the order of the outputs (and of the inputs of the
+        reverse direction). With 'source', the default, they are sorted by
+        the position in node_list of the node feeding each OutputNode, as in
+        earlier versions of FrEIA. With 'nodes', they are sorted by the
+        position of the OutputNodes themselves. The two differ e.g. when the
+        OutputNode of a split_layer is listed after that of a later block.'''
         super(ReversibleGraphNet, self).__init__()
+        assert output_order in ('source', 'nodes'), (
+            "output_order must be 'source' or 'nodes'")
+        self.output_order = output_order
+        self.reversible_backprop = reversible_backprop
+        self.reuse_buffers = reuse_buffers
+        self.parallel_branches = parallel_branches
+        self._init_runtime_state()
 
         # Gather lists of input and output nodes
         if ind_in is not None:
@@ -194,23 +749,63 @@ class ReversibleGraphNet(nn.Module):
         for i, n in enumerate(node_list):
             n.id = i
 
-        # Recursively build the nodes nn.Modules and determine order of
-        # operations
+        # The cyclic garbage collector would keep rescanning the growing
+        # number of modules while they are built, which makes construction of
+        # very deep graphs superlinear
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._compile(node_list, verbose=verbose)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _init_runtime_state(self):
+        # All intermediate results live in a buffer local to each call, so
+        # one net can be used from several threads at once. Only a reference
+        # to the last buffer is kept per thread, for
+        # jacobian(run_forward=False)
+        self._last_run = threading.local()
+
+        # Plans restricted to a subset of the outputs, by (rev, outputs)
+        self._pruned_plans = {}
+
+        # FrEIA.profiling.Profiler that measures every op, if set
+        self.profiler = None
+
+        # Thread pool for parallel_branches, started on first use
+        self._executor = None
+
+    def _compile(self, node_list, verbose=True):
+        '''Build all nodes, determine the order of operations in both
+        directions and compile them into execution plans. Linear in the number
+        of nodes and edges.'''
+        # Build the nodes nn.Modules and determine order of operations
         ops = []
         for i in self.ind_out:
             node_list[i].build_modules(verbose=verbose)
             node_list[i].run_forward(ops)
 
-        # create list of Pytorch variables that are used
-        variables = set()
+        # create list of Pytorch variables that are used, with a lookup
+        # table from (origin ID, channel) to variable ID
+        variables = {}
         for o in ops:
-            variables = variables.union(set(o[1] + o[2]))
+            for v in o[1] + o[2]:
+                if v not in variables:
+                    variables[v] = len(variables)
         self.variables_ind = list(variables)
+        self.variables_ids = variables
 
-        self.indexed_ops = self.ops_to_indexed(ops)
+        # Variables of the ConditionNodes, also those that no node reads
+        self.ind_cond = [i for i, n in enumerate(node_list)
+                         if isinstance(n, ConditionNode)]
+        for i in self.ind_cond:
+            if (i, 0) not in variables:
+                variables[(i, 0)] = len(variables)
+                self.variables_ind.append((i, 0))
+        self.cond_vars = [variables[(i, 0)] for i in self.ind_cond]
 
-        self.module_list = nn.ModuleList([n.module for n in node_list])
-        self.variable_list = [Variable(requires_grad=True) for v in variables]
+        self.indexed_ops = self.ops_to_indexed(ops)
 
         # Find out the order of operations for reverse calculations
         ops_rev = []
@@ -218,103 +813,566 @@ class ReversibleGraphNet(nn.Module):
             node_list[i].run_backward(ops_rev)
         self.indexed_ops_rev = self.ops_to_indexed(ops_rev)
 
+        self._build_plans([n.module for n in node_list])
+
+    def _build_plans(self, modules):
+        '''Register the modules of all nodes and compile both directions
+        into flat execution plans. The conditions are passed to the plans of
+        both directions as additional inputs, after the regular ones.'''
+        self.module_list = nn.ModuleList(modules)
+        self.plan = ExecutionPlan(modules, self.indexed_ops,
+                                  self.input_vars + self.cond_vars,
+                                  self.return_vars,
+                                  len(self.variables_ind), rev=False)
+        self.plan_rev = ExecutionPlan(modules, self.indexed_ops_rev,
+                                      self.return_vars + self.cond_vars,
+                                      self.input_vars,
+                                      len(self.variables_ind), rev=True)
+
     def ops_to_indexed(self, ops):
         '''Helper function to translate the list of variables (origin ID, channel),
         to variable IDs.'''
         result = []
+        ids = self.variables_ids
+        ind_in, ind_out = set(self.ind_in), set(self.ind_out)
 
         for o in ops:
             try:
-                vars_in = [self.variables_ind.index(v) for v in o[1]]
-            except ValueError:
+                vars_in = [ids[v] for v in o[1]]
+            except KeyError:
                 vars_in = -1
 
-            vars_out = [self.variables_ind.index(v) for v in o[2]]
+            vars_out = [ids[v] for v in o[2]]
 
             # Collect input/output nodes in separate lists, but don't add to
             # indexed ops
-            if o[0] in self.ind_out:
-                self.return_vars.append(self.variables_ind.index(o[1][0]))
+            if o[0] in ind_out:
+                self.return_vars.append(ids[o[1][0]])
                 continue
-            if o[0] in self.ind_in:
-                self.input_vars.append(self.variables_ind.index(o[1][0]))
+            if o[0] in ind_in:
+                self.input_vars.append(ids[o[1][0]])
                 continue
 
             result.append((o[0], vars_in, vars_out))
 
         # Sort input/output variables so they correspond to initial node list
-        # order
-        self.return_vars.sort(key=lambda i: self.variables_ind[i][0])
+        # order. The variable of an output is that of the node feeding it,
+        # with output_order='nodes' the OutputNodes are looked up instead.
+        if self.output_order == 'nodes':
+            output_node = {}
+            for i in self.ind_out:
+                inp, c = self.node_list[i].inputs[0]
+                output_node[ids[(inp.id, c)]] = i
+            self.return_vars.sort(key=lambda i: output_node[i])
+        else:
+            self.return_vars.sort(key=lambda i: self.variables_ind[i][0])
         self.input_vars.sort(key=lambda i: self.variables_ind[i][0])
 
         return result
 
-    def forward(self, x, rev=False):
-        '''Forward or backward computation of the whole net.'''
-        if rev:
-            use_list = self.indexed_ops_rev
-            input_vars, output_vars = self.return_vars, self.input_vars
-        else:
-            use_list = self.indexed_ops
-            input_vars, output_vars = self.input_vars, self.return_vars
+    def output_slot(self, output, rev=False):
+        '''Slot index of one output of the given direction, specified either
+        by its position in the list of outputs or by the name of the
+        OutputNode (InputNode when running in reverse).'''
+        plan = self.plan_rev if rev else self.plan
+        if not isinstance(output, str):
+            return plan.output_slots[output]
+
+        for i in (self.ind_in if rev else self.ind_out):
+            node = self.node_list[i]
+            if node.name == output:
+                if rev:
+                    return self.variables_ids[(node.id, 0)]
+                inp, c = node.inputs[0]
+                return self.variables_ids[(inp.id, c)]
+        raise KeyError("No %s node named '%s'"
+                       % ('input' if rev else 'output', output))
+
+    def get_plan(self, rev=False, outputs=None):
+        '''The execution plan of the given direction. If outputs is given, a
+        list of output positions or node names (see output_slot), the plan is
+        pruned to the ops needed for these outputs only. Pruned plans are
+        compiled once and cached.'''
+        if outputs is None:
+            return self.plan_rev if rev else self.plan
+
+        key = (rev, tuple(outputs))
+        plan = self._pruned_plans.get(key)
+        if plan is None:
+            full_plan = self.plan_rev if rev else self.plan
+            slots = [self.output_slot(o, rev=rev) for o in outputs]
+            plan = full_plan.prune(slots)
+            self._pruned_plans[key] = plan
+        return plan
+
+    def forward(self, x, rev=False, jac=False, outputs=None, chunk_size=None,
+                out=None, c=None):
+        '''Forward or backward computation of the whole net. With jac=True,
+        the per-sample log jacobian determinant is computed in the same pass
+        and (outputs, log_jac) is returned.
+
+        outputs selects a subset of the outputs to compute, as a list of
+        positions or node names. Only the ops contributing to these are run,
+        and the log jacobian determinant is also only summed over them.
+
+        With chunk_size, the batch is run through the net in chunks of at most
+        that many samples, so the memory for intermediate results does not
+        depend on the batch size (without gradients). The results are written
+        into out, a tensor or list of tensors with the full batch size, or
+        into newly allocated ones if out is not given.
+
+        c is the data of the ConditionNodes of the net, a tensor or a list of
+        tensors in the order of the node list, needed in both directions.'''
+        plan = self.get_plan(rev, outputs)
+        input_vars = plan.input_slots[:len(plan.input_slots)
+                                      - len(self.cond_vars)]
 
         if isinstance(x, (list, tuple)):
             assert len(x) == len(input_vars), ("Got list of {len(x)} input tensors for"
                                                "{'inverse' if rev else 'forward'} pass, but expected "
                                                "{len(input_vars)}.")
-            for i in range(len(input_vars)):
-                self.variable_list[input_vars[i]] = x[i]
         else:
             assert len(input_vars) == 1, ("Got single input tensor for "
                                           "{'inverse' if rev else 'forward'} "
                                           "pass, but expected list of "
                                           "{len(input_vars)}.")
-            self.variable_list[input_vars[0]] = x
-
-        for o in use_list:
-            try:
-                results = self.module_list[o[0]]([self.variable_list[i]
-                                                  for i in o[1]], rev=rev)
-            except TypeError:
-                raise RuntimeError("Are you sure all used Nodes are in the "
-                                   "Node list?")
-            for i, r in zip(o[2], results):
-                self.variable_list[i] = r
-            # self.variable_list[o[2][0]] = self.variable_list[o[1][0]]
+            x = [x]
+        x = list(x) + self._conditions(c)
 
-        out = [self.variable_list[output_vars[i]]
-               for i in range(len(output_vars))]
-        if len(out) == 1:
-            return out[0]
+        if chunk_size is None and out is None:
+            out, log_jac = self._run(plan, x, jac)
         else:
-            return out
-
-    def jacobian(self, x=None, rev=False, run_forward=True):
-        '''Compute the jacobian determinant of the whole net.'''
-        jacobian = 0
+            out, log_jac = self._run_chunked(plan, x, jac, chunk_size, out)
 
-        if rev:
-            use_list = self.indexed_ops_rev
+        if len(out) == 1:
+            out = out[0]
+
+        if jac:
+            return out, log_jac
+        return out
+
+    def _conditions(self, c):
+        '''The list of condition tensors that is passed to the plans, with
+        the feature nets of the ConditionNodes applied.'''
+        if not self.cond_vars:
+            return []
+        if c is None:
+            raise RuntimeError("The net has %i ConditionNode(s), their data "
+                               "has to be passed as c" % len(self.cond_vars))
+        if torch.is_tensor(c):
+            c = [c]
+        assert len(c) == len(self.cond_vars), (
+            "Got %i condition tensors, but the net has %i ConditionNodes"
+            % (len(c), len(self.cond_vars)))
+
+        features = []
+        for i, t in zip(self.ind_cond, c):
+            feature_net = self.node_list[i].module
+            features.append(t if feature_net is None else feature_net(t))
+        return features
+
+    def _run(self, plan, x, jac):
+        '''Run plan on the list of inputs x, returns the list of outputs and
+        the log jacobian determinant (or None).'''
+        if self.reversible_backprop and torch.is_grad_enabled():
+            params = [p for p in self.parameters() if p.requires_grad]
+            out = list(ReversibleBackprop.apply(plan, jac, len(x),
+                                                len(self.cond_vars), *x,
+                                                *params))
+            log_jac = out.pop() if jac else None
+            # No intermediate results are kept for jacobian(run_forward=False)
+            self._last_run.buffer = None
         else:
-            use_list = self.indexed_ops
-
+            if self.profiler is not None:
+                buf, log_jac = self.profiler.execute(plan, x, jac=jac)
+                self._last_run.buffer = buf
+            elif self.reuse_buffers and not torch.is_grad_enabled():
+                # Like the last buffer, the pools are per thread. The
+                # intermediate results are overwritten, so they aren't kept
+                # for jacobian(run_forward=False).
+                pools = self._last_run.__dict__.setdefault('pools', {})
+                buf, log_jac = plan.execute(x, jac=jac,
+                                            pool=pools.setdefault(plan, {}))
+                self._last_run.buffer = None
+            else:
+                executor = (self._branch_executor()
+                            if self.parallel_branches else None)
+                buf, log_jac = plan.execute(x, jac=jac, executor=executor)
+                self._last_run.buffer = buf
+            out = [buf[i] for i in plan.output_slots]
+        return out, log_jac
+
+    def _branch_executor(self):
+        if self._executor is None:
+            # One thread less than the widest level, the calling thread
+            # runs one of its ops itself
+            width = max((len(level) for plan in (self.plan, self.plan_rev)
+                         for level in plan.levels), default=1)
+            self._executor = ThreadPoolExecutor(
+                max(width - 1, 1), thread_name_prefix='freia-branch')
+        return self._executor
+
+    def _run_chunked(self, plan, x, jac, chunk_size, out):
+        '''Same as _run, in chunks of chunk_size samples that are written
+        into the output tensors out (allocated after the first chunk if
+        None).'''
+        batch_size = x[0].shape[0]
+        if not chunk_size:
+            chunk_size = batch_size
+        if torch.is_tensor(out):
+            out = [out]
+        if out is not None:
+            assert len(out) == len(plan.output_slots), (
+                "Got %i output tensors, but the pass has %i outputs"
+                % (len(out), len(plan.output_slots)))
+            assert all(o.shape[0] == batch_size for o in out), (
+                "Output tensors must have the batch size of the input")
+
+        log_jac = None
+        for start in range(0, batch_size, chunk_size):
+            end = min(start + chunk_size, batch_size)
+            # Conditions with a batch size of one are shared by all chunks
+            results, chunk_jac = self._run(
+                plan, [t[start:end] if t.shape[0] == batch_size else t
+                       for t in x], jac)
+
+            if out is None:
+                out = [r.new_empty((batch_size,) + r.shape[1:])
+                       for r in results]
+            for o, r in zip(out, results):
+                o[start:end] = r
+            if jac:
+                if log_jac is None:
+                    log_jac = chunk_jac.new_empty(batch_size)
+                log_jac[start:end] = chunk_jac
+
+        # Only the last chunk would be left, which jacobian(run_forward=False)
+        # can't use
+        self._last_run.buffer = None
+        return out, log_jac
+
+    def jacobian(self, x=None, rev=False, run_forward=True, outputs=None,
+                 c=None):
+        '''Compute the log jacobian determinant of the whole net, per sample.
+        With run_forward=False, the intermediate results of the last call to
+        forward in the same thread are used instead. outputs restricts the
+        computation to the ops contributing to these outputs, and c gives the
+        conditions, as in forward.'''
         if run_forward:
             if x is None:
                 raise RuntimeError("You need to provide an input if you want "
                                    "to run a forward pass")
-            self.forward(x, rev=rev)
+            return self.forward(x, rev=rev, jac=True, outputs=outputs,
+                                c=c)[1]
 
-        for o in use_list:
-            try:
-                jacobian += self.module_list[o[0]].jacobian(
-                    [self.variable_list[i] for i in o[1]], rev=rev
-                )
-            except TypeError:
-                raise RuntimeError("Are you sure all used Nodes are in the "
-                                   "Node list?")
+        buf = getattr(self._last_run, 'buffer', None)
+        if buf is None:
+            raise RuntimeError("No intermediate results of a forward pass "
+                               "available in this thread")
+
+        plan = self.get_plan(rev, outputs)
+        if self.profiler is not None:
+            return self.profiler.jacobian(plan, buf)
+
+        jacobian = 0
+        for module, gather, outs in plan.steps:
+            jacobian = jacobian + module.jacobian(gather(buf), rev=rev)
 
         return jacobian
 
+    def set_precision(self, subnet_dtype=None, log_jac_dtype=None):
+        '''Precision policy of all coupling layers. Their subnets run in
+        subnet_dtype under autocast (e.g. torch.bfloat16), while the affine
+        combination and the clamping stay in the precision of the data, so
+        the net stays invertible. The log jacobian determinant is summed in
+        log_jac_dtype (e.g. torch.float64). None means the precision of the
+        data. The subnets of the exported graphs (export_forward etc.) run
+        in the precision of the data, as autocast is not traced, while their
+        log jacobian determinant is still summed in log_jac_dtype.'''
+        for module in self.modules():
+            if hasattr(module, 'subnet_dtype'):
+                module.subnet_dtype = subnet_dtype
+            if hasattr(module, 'log_jac_dtype'):
+                module.log_jac_dtype = log_jac_dtype
+        return self
+
+    def set_checkpointing(self, enabled=True, nodes=None):
+        '''Turn checkpointing of the subnets (see Node) on or off for the
+        coupling layers of all nodes, or only of the nodes with the names in
+        nodes. Saves the memory of the hidden activations of the subnets in
+        training, at the cost of evaluating every subnet twice.'''
+        for node in self.node_list:
+            if nodes is not None and node.name not in nodes:
+                continue
+            if isinstance(node, (InputNode, OutputNode)):
+                continue
+            node.checkpoint_subnets = enabled
+            if hasattr(node.module, 'checkpoint_subnets'):
+                node.module.checkpoint_subnets = enabled
+        return self
+
+    def set_log_scale_cache(self, enabled=True):
+        '''Let the coupling layers keep the log scales of their last forward
+        pass with autograd, so that jacobian(run_forward=False) after a call
+        of forward doesn't run the subnets again. Each kept entry is used once
+        by jacobian, until then the log scales of every layer stay in memory,
+        also if the outputs of the pass are dropped. Has no effect for the
+        passes with reversible backprop.'''
+        for module in self.modules():
+            if hasattr(module, 'cache_log_scales'):
+                module.cache_log_scales = enabled
+        return self
+
+    def invertibility_error(self, x, rev=False, c=None):
+        '''Reconstruction error of the round trip x -> z -> x (z -> x -> z
+        with rev=True), over all inputs, for the conditions c. Returns a dict
+        with the maximum and mean absolute error and the maximum error
+        relative to the largest absolute input value.'''
+        if not isinstance(x, (list, tuple)):
+            x = [x]
+        with torch.no_grad():
+            z = self.forward(x, rev=rev, c=c)
+            x_rec = self.forward(z, rev=not rev, c=c)
+        if not isinstance(x_rec, (list, tuple)):
+            x_rec = [x_rec]
+
+        errors = torch.cat([(a - b).abs().flatten()
+                            for a, b in zip(x, x_rec)])
+        scale = max(a.abs().max().item() for a in x)
+        return {'max_abs': errors.max().item(),
+                'mean_abs': errors.mean().item(),
+                'max_rel': errors.max().item() / scale}
+
+    def optimized(self, verbose=False):
+        '''Returns an equivalent net for inference, with fixed permutations
+        and linear transforms fused and inverse reshape pairs removed (see
+        FrEIA.optimize). The net itself is not changed.'''
+        from FrEIA.optimize import optimize_graph
+        return optimize_graph(self, verbose=verbose)
+
+    @contextlib.contextmanager
+    def profile(self, trace=True):
+        '''Context manager that measures every op of the net while it is
+        active, see FrEIA.profiling. Yields the Profiler:
+
+            with net.profile() as prof:
+                net(x)
+            print(prof.summary())
+
+        Passes that run through ReversibleBackprop (reversible_backprop with
+        gradients enabled) are not measured.'''
+        from FrEIA.profiling import Profiler
+        self.profiler = Profiler(self, trace=trace)
+        try:
+            yield self.profiler
+        finally:
+            self.profiler = None
+
+    def export_forward(self, jac=False):
+        '''Returns a standalone torch.fx.GraphModule that runs the forward
+        direction of the net (and returns (outputs, log_jac) if jac is set).
+        The graph is straight-line code without any of the Python bookkeeping
+        of ReversibleGraphNet, so it can be passed to torch.jit.script /
+        torch.jit.freeze or to fx based optimizations. It shares the
+        parameters of the net.
+
+        The graph of a conditional net takes the list [x..., features...],
+        where the features are the outputs of the feature nets of the
+        ConditionNodes (or the conditions themselves for ConditionNodes
+        without one), which are not part of the graph.'''
+        return self._export(rev=False, jac=jac)
+
+    def export_reverse(self, jac=False):
+        '''Same as export_forward, for the reverse direction.'''
+        return self._export(rev=True, jac=jac)
+
+    def _export(self, rev, jac):
+        plan = self.plan_rev if rev else self.plan
+        n_inputs = len(plan.input_slots)
+
+        class Direction(nn.Module):
+            def __init__(self, net):
+                super(Direction, self).__init__()
+                self.net = net
+
+            def forward(self, x):
+                if n_inputs == 1:
+                    x = [x]
+                else:
+                    x = [x[i] for i in range(n_inputs)]
+                buf, log_jac = plan.execute(x, jac=jac)
+
+                out = [buf[i] for i in plan.output_slots]
+                if len(out) == 1:
+                    out = out[0]
+                if jac:
+                    return out, log_jac
+                return out
+
+        graph_module = torch.fx.symbolic_trace(Direction(self))
+        if n_inputs > 1:
+            for node in graph_module.graph.nodes:
+                if node.op == 'placeholder':
+                    node.type = List[torch.Tensor]
+            graph_module.recompile()
+        return graph_module.train(self.training)
+
+    def __getstate__(self):
+        # The per-thread results of the last call can't be pickled or copied
+        state = self.__dict__.copy()
+        del state['_last_run']
+        state['profiler'] = None
+        state['_executor'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(ReversibleGraphNet, self).__setstate__(state)
+        self._last_run = threading.local()
+
+    # Attributes that describe the compiled graph, everything else that is
+    # set on a net (e.g. by subclasses) is saved along with it as is
+    _graph_attributes = {'training', 'reversible_backprop', 'ind_in',
+                         'ind_out', 'ind_cond', 'input_vars', 'return_vars',
+                         'cond_vars', 'node_list',
+                         'variables_ind', 'variables_ids', 'indexed_ops',
+                         'indexed_ops_rev', 'plan', 'plan_rev', 'profiler'}
+
+    def save(self, path):
+        '''Save the compiled graph (node specifications, dimensions, order of
+        operations and variable indices) together with the state_dict, so
+        that ReversibleGraphNet.load can restore the net without building
+        the graph again. The module classes and arguments are pickled by
+        reference, so they have to be importable when loading.'''
+        nodes = []
+        for node in self.node_list:
+            spec = {'name': node.name}
+            if isinstance(node, InputNode):
+                spec['type'] = 'input'
+                spec['dims'] = tuple(node.data.shape)
+            elif isinstance(node, ConditionNode):
+                spec['type'] = 'condition'
+                spec['dims'] = node.dims
+                spec['feature_net'] = node.module
+            else:
+                spec['type'] = ('output' if isinstance(node, OutputNode)
+                                else 'node')
+                spec['inputs'] = [(n.id, c) for n, c in node.inputs]
+                spec['input_dims'] = node.input_dims
+                spec['module_type'] = node.module_type
+                spec['module_args'] = node.module_args
+                spec['checkpoint_subnets'] = node.checkpoint_subnets
+                spec['conditions'] = [n.id for n in node.conditions]
+                spec['dims_c'] = node.dims_c
+            nodes.append(spec)
+
+        graph = {'nodes': nodes,
+                 'ind_in': self.ind_in,
+                 'ind_out': self.ind_out,
+                 'ind_cond': self.ind_cond,
+                 'input_vars': self.input_vars,
+                 'return_vars': self.return_vars,
+                 'cond_vars': self.cond_vars,
+                 'variables_ind': self.variables_ind,
+                 'indexed_ops': self.indexed_ops,
+                 'indexed_ops_rev': self.indexed_ops_rev,
+                 'reversible_backprop': self.reversible_backprop,
+                 'training': self.training,
+                 'attributes': {k: v for k, v in self.__dict__.items()
+                                if not k.startswith('_')
+                                and k not in self._graph_attributes}}
+        torch.save({'graph': graph, 'state_dict': self.state_dict()}, path)
+
+    @classmethod
+    def load(cls, path, map_location=None):
+        '''Restore a net saved with save, map_location is passed on to
+        torch.load. Only the modules of the nodes are constructed from their
+        saved arguments, the graph traversal and compilation is skipped and
+        nothing is printed. The saved tensors are memory-mapped instead of
+        read in full. Called on a subclass, an instance of that subclass is
+        returned, with the attributes it had when it was saved.'''
+        artefact = torch.load(path, map_location=map_location,
+                              weights_only=False, mmap=True)
+        graph = artefact['graph']
+        state_dict = artefact['state_dict']
+
+        node_list = []
+        for i, spec in enumerate(graph['nodes']):
+            if spec['type'] == 'input':
+                node = InputNode(*spec['dims'], name=spec['name'])
+            elif spec['type'] == 'output':
+                node = OutputNode([], name=spec['name'])
+            elif spec['type'] == 'condition':
+                node = ConditionNode(*spec['dims'], name=spec['name'],
+                                     feature_net=spec['feature_net'])
+            else:
+                node = Node([], spec['module_type'], spec['module_args'],
+                            name=spec['name'],
+                            checkpoint_subnets=spec['checkpoint_subnets'])
+            node.id = i
+            node_list.append(node)
+
+        for node, spec in zip(node_list, graph['nodes']):
+            if spec['type'] in ('input', 'condition'):
+                continue
+            node.inputs = [(node_list[j], c) for j, c in spec['inputs']]
+            for k, (n, c) in enumerate(node.inputs):
+                n.outputs.append((node, k))
+            node.conditions = [node_list[j] for j in spec['conditions']]
+
+            # The saved tensors replace the parameters anyway, so the modules
+            # are built on the meta device without initializing them. Modules
+            # that can't be built there are built normally.
+            try:
+                with torch.device('meta'):
+                    node._instantiate(spec['input_dims'], spec['dims_c'])
+            except Exception:
+                node._instantiate(spec['input_dims'], spec['dims_c'])
+
+        net = cls.__new__(cls)
+        nn.Module.__init__(net)
+        net.__dict__.update(graph['attributes'])
+        net.reversible_backprop = graph['reversible_backprop']
+        net._init_runtime_state()
+
+        net.node_list = node_list
+        net.ind_in, net.ind_out = graph['ind_in'], graph['ind_out']
+        net.ind_cond = graph['ind_cond']
+        net.input_vars = graph['input_vars']
+        net.return_vars = graph['return_vars']
+        net.cond_vars = graph['cond_vars']
+        net.variables_ind = graph['variables_ind']
+        net.variables_ids = {v: i for i, v in enumerate(net.variables_ind)}
+        net.indexed_ops = graph['indexed_ops']
+        net.indexed_ops_rev = graph['indexed_ops_rev']
+        net._build_plans([n.module for n in node_list])
+
+        # Take over the saved tensors with their dtype and device
+        net.load_state_dict(state_dict, assign=True)
+
+        # Tensors that are not saved (e.g. non-persistent buffers) are still
+        # on the meta device, these modules are built again normally
+        rebuilt = False
+        for i, node in enumerate(node_list):
+            module = node.module
+            if module is None or not any(
+                    t.is_meta for t in chain(module.parameters(),
+                                             module.buffers())):
+                continue
+            node._instantiate(node.input_dims, node.dims_c)
+            prefix = 'module_list.%i.' % i
+            node.module.load_state_dict(
+                {k[len(prefix):]: v for k, v in state_dict.items()
+                 if k.startswith(prefix)}, assign=True)
+            rebuilt = True
+        if rebuilt:
+            net._build_plans([n.module for n in node_list])
+
+        # Move everything else (e.g. the fixed permutations) to the device of
+        # the saved tensors
+        if state_dict:
+            net.to(next(iter(state_dict.values())).device)
+        return net.train(graph['training'])
+
 
 # Testing example
 if __name__ == '__main__':
@@ -6,5 +6,6 @@ needed compared to the base class is an @staticmethod otuput_dims, and the
 from .fixed_transforms import *
 from .reshapes import *
 from .coupling_layers import *
+from .invertible_linear import *
 from .graph_topology import *
 from .coeff_functs import *
@@ -67,6 +67,56 @@ class F_conv(nn.Module):
         return out
 
 
+class F_conv1d(nn.Module):
+    '''As F_conv, with 1-D convolutions for inputs of shape (channels,
+    length), e.g. time series. The weights are shared along the length, so
+    the number of parameters does not grow with it.'''
+
+    def __init__(self, in_channels, channels, channels_hidden=None,
+                 kernel_size=3, leaky_slope=0.1, batch_norm=False):
+        super(F_conv1d, self).__init__()
+
+        if not channels_hidden:
+            channels_hidden = channels
+
+        pad = kernel_size // 2
+        self.leaky_slope = leaky_slope
+        self.conv1 = nn.Conv1d(in_channels, channels_hidden,
+                               kernel_size=kernel_size, padding=pad,
+                               bias=not batch_norm)
+        self.conv2 = nn.Conv1d(channels_hidden, channels_hidden,
+                               kernel_size=kernel_size, padding=pad,
+                               bias=not batch_norm)
+        self.conv3 = nn.Conv1d(channels_hidden, channels,
+                               kernel_size=kernel_size, padding=pad,
+                               bias=not batch_norm)
+
+        if batch_norm:
+            self.bn1 = nn.BatchNorm1d(channels_hidden)
+            self.bn1.weight.data.fill_(1)
+            self.bn2 = nn.BatchNorm1d(channels_hidden)
+            self.bn2.weight.data.fill_(1)
+            self.bn3 = nn.BatchNorm1d(channels)
+            self.bn3.weight.data.fill_(1)
+        self.batch_norm = batch_norm
+
+    def forward(self, x):
+        out = self.conv1(x)
+        if self.batch_norm:
+            out = self.bn1(out)
+        out = F.leaky_relu(out, self.leaky_slope)
+
+        out = self.conv2(out)
+        if self.batch_norm:
+            out = self.bn2(out)
+        out = F.leaky_relu(out, self.leaky_slope)
+
+        out = self.conv3(out)
+        if self.batch_norm:
+            out = self.bn3(out)
+        return out
+
+
 class F_fully_connected(nn.Module):
     '''Fully connected tranformation, not reversible, but used below.'''
 
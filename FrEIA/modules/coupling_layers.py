@@ -1,9 +1,138 @@
+import weakref
+from functools import partial
 from math import exp
 
 import torch
+import torch.fx
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint as _checkpoint
 
 from .coeff_functs import F_conv, F_fully_connected
+from .fixed_transforms import output_buffer
+
+
+def run_subnet(F, x, dtype=None, checkpoint=False):
+    '''Evaluate the subnet F of a coupling layer. If dtype is given (e.g.
+    torch.bfloat16), F runs under autocast in that precision, and the result
+    is cast back to the dtype of x. The affine combination, the clamping in e
+    and the log jacobian then stay in the precision of the data, so the layer
+    remains exactly invertible: the reverse pass evaluates F on the same
+    inputs as the forward pass.
+
+    With checkpoint=True, the hidden activations of F are not kept for the
+    backward pass, only its input. F is evaluated again during backward
+    (with the same dropout masks) to get them.'''
+    if checkpoint and torch.is_grad_enabled():
+        return _checkpoint(run_subnet, F, x, dtype, use_reentrant=False)
+    if dtype is None or isinstance(x, torch.fx.Proxy):
+        # Exports are traced without autocast, in the precision of the data
+        return F(x)
+    with torch.autocast(x.device.type, dtype=dtype):
+        out = F(x)
+    return out.to(x.dtype)
+
+
+def _output_halves(out, x, len1, len2):
+    '''The tensor to write the output of a coupling layer with input x into
+    (see output_buffer), and its two halves along the channels. All None if
+    out is None, then the halves are concatenated into a new tensor.'''
+    y = output_buffer(out, x)
+    if y is None:
+        return None, None, None
+    return y, y.narrow(1, 0, len1), y.narrow(1, len1, len2)
+
+
+def _condition_channels(dims_in, dims_c):
+    '''Number of channels the conditions add to the input of the subnets'''
+    assert all(tuple(d[1:]) == tuple(dims_in[0][1:]) for d in dims_c), (
+        "Conditions must have the same spatial dimensions as the input")
+    return sum(d[0] for d in dims_c)
+
+
+def _with_condition(x, c):
+    '''x with the conditions c appended along the channels, where
+    conditions with a batch size of one are broadcast to that of x'''
+    if not c:
+        return x
+    return torch.cat([x] + [t.expand((x.shape[0],) + t.shape[1:])
+                            for t in c], 1)
+
+
+def _add(a, b, out=None):
+    '''a + b, written into out if given. Like the helpers below, it never
+    passes out=None to torch, which the exported (scripted) graphs reject.'''
+    if out is None:
+        return a + b
+    return torch.add(a, b, out=out)
+
+
+def _sub(a, b, out=None):
+    '''a - b, written into out if given'''
+    if out is None:
+        return a - b
+    return torch.sub(a, b, out=out)
+
+
+def _affine(scale, x, shift, out=None):
+    '''scale * x + shift, written into out if given'''
+    if out is None:
+        return scale * x + shift
+    return torch.addcmul(shift, scale, x, out=out)
+
+
+def _affine_inv(y, shift, scale, out=None):
+    '''(y - shift) / scale, written into out if given'''
+    if out is None:
+        return (y - shift) / scale
+    return torch.sub(y, shift, out=out).div_(scale)
+
+
+class _LogScaleCache:
+    '''The log scales of the last forward pass of a coupling layer, so that
+    a following call of jacobian on the same input only has to reduce them
+    instead of running the subnets again. Opt-in with the cache_log_scales
+    attribute of the layer (see ReversibleGraphNet.set_log_scale_cache), as
+    the log scales are kept alive until then, and only filled while autograd
+    is enabled. The log jacobian from the cache is part of the same autograd
+    graph as the output, as with forward(jac=True).
+
+    An entry is used at most once, and only for the very same input tensors
+    (including the conditions) and direction, if neither the inputs nor any
+    parameter of the layer (e.g. by an optimizer step) were modified in place
+    since, and the precision is the same.'''
+
+    def __init__(self):
+        self.entry = None
+
+    @staticmethod
+    def _key(layer, x, rev):
+        return (rev, tuple(t._version for t in x), layer.subnet_dtype,
+                tuple(p._version for p in layer.parameters()))
+
+    def store(self, layer, x, rev, log_scales):
+        if layer.cache_log_scales and torch.is_grad_enabled():
+            self.entry = (tuple(weakref.ref(t) for t in x),
+                          self._key(layer, x, rev), log_scales)
+        else:
+            self.entry = None
+
+    def lookup(self, layer, x, rev):
+        '''The cached log scales for the list of inputs x, or None. Empties
+        the cache.'''
+        entry, self.entry = self.entry, None
+        if (entry is None or not torch.is_grad_enabled()
+                or len(entry[0]) != len(x)
+                or any(ref() is not t for ref, t in zip(entry[0], x))
+                or entry[1] != self._key(layer, x, rev)):
+            return None
+        return entry[2]
+
+    def clear(self):
+        self.entry = None
+
+    def __getstate__(self):
+        # Neither weak references nor the tensors of the last call are copied
+        return {'entry': None}
 
 
 class rev_layer(nn.Module):
@@ -12,6 +141,11 @@ class rev_layer(nn.Module):
     revesible (see lifting scheme). F itself does not have to be revesible. See
     F_* classes above for examples.'''
 
+    # Precision of the subnets, see run_subnet (None: that of the data), and
+    # whether their activations are recomputed in backward instead of stored
+    subnet_dtype = None
+    checkpoint_subnets = False
+
     def __init__(self, dims_in, F_class=F_conv, F_args={}):
         super(rev_layer, self).__init__()
         channels = dims_in[0][0]
@@ -21,21 +155,29 @@ class rev_layer(nn.Module):
         self.F = F_class(self.split_len2, self.split_len1, **F_args)
         self.G = F_class(self.split_len1, self.split_len2, **F_args)
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False, out=None):
         x1, x2 = (x[0].narrow(1, 0, self.split_len1),
                   x[0].narrow(1, self.split_len1, self.split_len2))
+        # Without autograd, the halves can be written into out directly
+        y, y1, y2 = _output_halves(out, x[0], self.split_len1,
+                                   self.split_len2)
 
+        subnet = partial(run_subnet, dtype=self.subnet_dtype,
+                         checkpoint=self.checkpoint_subnets)
         if not rev:
-            y1 = x1 + self.F(x2)
-            y2 = x2 + self.G(y1)
+            y1 = _add(x1, subnet(self.F, x2), y1)
+            y2 = _add(x2, subnet(self.G, y1), y2)
         else:
-            y2 = x2 - self.G(x1)
-            y1 = x1 - self.F(y2)
+            y2 = _sub(x2, subnet(self.G, x1), y2)
+            y1 = _sub(x1, subnet(self.F, y2), y1)
 
-        return [torch.cat((y1, y2), 1)]
+        out = [torch.cat((y1, y2), 1) if y is None else y]
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        return torch.zeros(x.shape[0])
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -47,25 +189,40 @@ class rev_multiplicative_layer(nn.Module):
     layer with a multiplicative term presented in the real-NVP paper is much
     more general. This class uses some non-reversible transformation F, but
     splits the channels up to make it revesible (see lifting scheme). F itself
-    does not have to be revesible. See F_* classes above for examples.'''
+    does not have to be revesible. See F_* classes above for examples.
+
+    With dims_c (set by Node for its conditions), the subnets get the
+    condition tensors, which follow the input in the list x, as additional
+    input channels.'''
+
+    # Precision of the subnets, see run_subnet, and of the sum over the log
+    # jacobian (None: that of the data), whether the activations of the
+    # subnets are recomputed in backward instead of stored, and whether the
+    # log scales are kept for jacobian (see _LogScaleCache)
+    subnet_dtype = None
+    log_jac_dtype = None
+    checkpoint_subnets = False
+    cache_log_scales = False
 
     def __init__(self, dims_in, F_class=F_fully_connected, F_args={},
-                 clamp=5.):
+                 clamp=5., dims_c=[]):
         super(rev_multiplicative_layer, self).__init__()
         channels = dims_in[0][0]
 
         self.split_len1 = channels // 2
         self.split_len2 = channels - channels // 2
         self.ndims = len(dims_in[0])
+        len_c = _condition_channels(dims_in, dims_c)
 
         self.clamp = clamp
         self.max_s = exp(clamp)
         self.min_s = exp(-clamp)
 
-        self.s1 = F_class(self.split_len1, self.split_len2, **F_args)
-        self.t1 = F_class(self.split_len1, self.split_len2, **F_args)
-        self.s2 = F_class(self.split_len2, self.split_len1, **F_args)
-        self.t2 = F_class(self.split_len2, self.split_len1, **F_args)
+        self.s1 = F_class(self.split_len1 + len_c, self.split_len2, **F_args)
+        self.t1 = F_class(self.split_len1 + len_c, self.split_len2, **F_args)
+        self.s2 = F_class(self.split_len2 + len_c, self.split_len1, **F_args)
+        self.t2 = F_class(self.split_len2 + len_c, self.split_len1, **F_args)
+        self._log_scales = _LogScaleCache()
 
     def e(self, s):
         # return torch.exp(torch.clamp(s, -self.clamp, self.clamp))
@@ -76,32 +233,51 @@ class rev_multiplicative_layer(nn.Module):
         '''log of the nonlinear function e'''
         return self.clamp * 0.636 * torch.atan(s)
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False, out=None):
         x1, x2 = (x[0].narrow(1, 0, self.split_len1),
                   x[0].narrow(1, self.split_len1, self.split_len2))
+        # See rev_layer
+        y, y1, y2 = _output_halves(out, x[0], self.split_len1,
+                                   self.split_len2)
 
+        subnet = partial(run_subnet, dtype=self.subnet_dtype,
+                         checkpoint=self.checkpoint_subnets)
+        c = x[1:]
         if not rev:
-            y1 = self.e(self.s2(x2)) * x1 + self.t2(x2)
-            y2 = self.e(self.s1(y1)) * x2 + self.t1(y1)
+            x2_c = _with_condition(x2, c)
+            s2 = subnet(self.s2, x2_c)
+            y1 = _affine(self.e(s2), x1, subnet(self.t2, x2_c), y1)
+            y1_c = _with_condition(y1, c)
+            s1 = subnet(self.s1, y1_c)
+            y2 = _affine(self.e(s1), x2, subnet(self.t1, y1_c), y2)
         else:  # names of x and y are swapped!
-            y2 = (x2 - self.t1(x1)) / self.e(self.s1(x1))
-            y1 = (x1 - self.t2(y2)) / self.e(self.s2(y2))
-        return [torch.cat((y1, y2), 1)]
+            x1_c = _with_condition(x1, c)
+            s1 = subnet(self.s1, x1_c)
+            y2 = _affine_inv(x2, subnet(self.t1, x1_c), self.e(s1), y2)
+            y2_c = _with_condition(y2, c)
+            s2 = subnet(self.s2, y2_c)
+            y1 = _affine_inv(x1, subnet(self.t2, y2_c), self.e(s2), y1)
+
+        out = [torch.cat((y1, y2), 1) if y is None else y]
+        self._log_scales.store(self, x, rev, (s1, s2))
+        if jac:
+            return out, self.log_jac(s1, s2, rev=rev)
+        return out
+
+    def log_jac(self, s1, s2, rev=False):
+        '''Per-sample log jacobian determinant from the raw log scales of both
+        halves'''
+        dims = tuple(range(1, self.ndims+1))
+        dtype = self.log_jac_dtype
+        jac = (torch.sum(self.log_e(s1), dim=dims, dtype=dtype)
+               + torch.sum(self.log_e(s2), dim=dims, dtype=dtype))
+        return -jac if rev else jac
 
     def jacobian(self, x, rev=False):
-        x1, x2 = (x[0].narrow(1, 0, self.split_len1),
-                  x[0].narrow(1, self.split_len1, self.split_len2))
-
-        if not rev:
-            s2 = self.s2(x2)
-            y1 = self.e(s2) * x1 + self.t2(x2)
-            jac = self.log_e(self.s1(y1)) + self.log_e(s2)
-        else:
-            s1 = self.s1(x1)
-            y2 = (x2 - self.t1(x1)) / self.e(s1)
-            jac = -self.log_e(s1) - self.log_e(self.s2(y2))
-
-        return torch.sum(jac, dim=tuple(range(1, self.ndims+1)))
+        log_scales = self._log_scales.lookup(self, x, rev)
+        if log_scales is not None:
+            return self.log_jac(*log_scales, rev=rev)
+        return self.forward(x, rev=rev, jac=True)[1]
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -109,11 +285,18 @@ class rev_multiplicative_layer(nn.Module):
 
 
 class glow_coupling_layer(nn.Module):
+    # See rev_multiplicative_layer
+    subnet_dtype = None
+    log_jac_dtype = None
+    checkpoint_subnets = False
+    cache_log_scales = False
+
     def __init__(self, dims_in, F_class=F_fully_connected, F_args={},
-                 clamp=5.):
+                 clamp=5., dims_c=[]):
         super(glow_coupling_layer, self).__init__()
         channels = dims_in[0][0]
         self.ndims = len(dims_in[0])
+        len_c = _condition_channels(dims_in, dims_c)
 
         self.split_len1 = channels // 2
         self.split_len2 = channels - channels // 2
@@ -122,8 +305,11 @@ class glow_coupling_layer(nn.Module):
         self.max_s = exp(clamp)
         self.min_s = exp(-clamp)
 
-        self.s1 = F_class(self.split_len1, self.split_len2*2, **F_args)
-        self.s2 = F_class(self.split_len2, self.split_len1*2, **F_args)
+        self.s1 = F_class(self.split_len1 + len_c, self.split_len2*2,
+                          **F_args)
+        self.s2 = F_class(self.split_len2 + len_c, self.split_len1*2,
+                          **F_args)
+        self._log_scales = _LogScaleCache()
 
     def e(self, s):
         return torch.exp(self.clamp * 0.636 * torch.atan(s / self.clamp))
@@ -131,56 +317,323 @@ class glow_coupling_layer(nn.Module):
     def log_e(self, s):
         return self.clamp * 0.636 * torch.atan(s / self.clamp)
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False, out=None):
         x1, x2 = (x[0].narrow(1, 0, self.split_len1),
                   x[0].narrow(1, self.split_len1, self.split_len2))
+        # See rev_layer
+        y, y1, y2 = _output_halves(out, x[0], self.split_len1,
+                                   self.split_len2)
 
+        subnet = partial(run_subnet, dtype=self.subnet_dtype,
+                         checkpoint=self.checkpoint_subnets)
+
+        c = x[1:]
         if not rev:
-            r2 = self.s2(x2)
+            r2 = subnet(self.s2, _with_condition(x2, c))
             s2, t2 = r2[:, :self.split_len1], r2[:, self.split_len1:]
-            y1 = self.e(s2) * x1 + t2
+            y1 = _affine(self.e(s2), x1, t2, y1)
 
-            r1 = self.s1(y1)
+            r1 = subnet(self.s1, _with_condition(y1, c))
             s1, t1 = r1[:, :self.split_len2], r1[:, self.split_len2:]
-            y2 = self.e(s1) * x2 + t1
+            y2 = _affine(self.e(s1), x2, t1, y2)
 
         else:  # names of x and y are swapped!
-            r1 = self.s1(x1)
+            r1 = subnet(self.s1, _with_condition(x1, c))
             s1, t1 = r1[:, :self.split_len2], r1[:, self.split_len2:]
-            y2 = (x2 - t1) / self.e(s1)
+            y2 = _affine_inv(x2, t1, self.e(s1), y2)
 
-            r2 = self.s2(y2)
+            r2 = subnet(self.s2, _with_condition(y2, c))
             s2, t2 = r2[:, :self.split_len1], r2[:, self.split_len1:]
-            y1 = (x1 - t2) / self.e(s2)
-
-        return [torch.cat((y1, y2), 1)]
+            y1 = _affine_inv(x1, t2, self.e(s2), y1)
+
+        out = [torch.cat((y1, y2), 1) if y is None else y]
+        self._log_scales.store(self, x, rev, (s1, s2))
+        if jac:
+            return out, self.log_jac(s1, s2, rev=rev)
+        return out
+
+    def log_jac(self, s1, s2, rev=False):
+        '''Per-sample log jacobian determinant from the raw log scales of both
+        halves'''
+        dims = tuple(range(1, self.ndims+1))
+        dtype = self.log_jac_dtype
+        jac = (torch.sum(self.log_e(s1), dim=dims, dtype=dtype)
+               + torch.sum(self.log_e(s2), dim=dims, dtype=dtype))
+        return -jac if rev else jac
 
     def jacobian(self, x, rev=False):
+        log_scales = self._log_scales.lookup(self, x, rev)
+        if log_scales is not None:
+            return self.log_jac(*log_scales, rev=rev)
+        return self.forward(x, rev=rev, jac=True)[1]
+
+    def output_dims(self, input_dims):
+        assert len(input_dims) == 1, "Can only use 1 input"
+        return input_dims
+
+
+class affine_coupling_layer(nn.Module):
+    '''Same transformation as rev_multiplicative_layer, but the scale and
+    the shift of each half come from one subnet with a head of twice the
+    width (as in glow_coupling_layer), i.e. two subnets per block instead of
+    four. The log of the scale is computed once and shared between the scale
+    and the log jacobian. Note that the default hidden width of
+    F_fully_connected doubles along with the head, pass the internal_size of
+    the rev_multiplicative_layer subnets in F_args to halve the cost.
+    Conditions are supported as in rev_multiplicative_layer.'''
+
+    # See rev_multiplicative_layer
+    subnet_dtype = None
+    log_jac_dtype = None
+    checkpoint_subnets = False
+    cache_log_scales = False
+
+    def __init__(self, dims_in, F_class=F_fully_connected, F_args={},
+                 clamp=5., dims_c=[]):
+        super(affine_coupling_layer, self).__init__()
+        channels = dims_in[0][0]
+        self.ndims = len(dims_in[0])
+        len_c = _condition_channels(dims_in, dims_c)
+
+        self.split_len1 = channels // 2
+        self.split_len2 = channels - channels // 2
+        self.clamp = clamp
+
+        self.s1 = F_class(self.split_len1 + len_c, self.split_len2*2,
+                          **F_args)
+        self.s2 = F_class(self.split_len2 + len_c, self.split_len1*2,
+                          **F_args)
+        self._log_scales = _LogScaleCache()
+
+    def coefficients(self, r, n):
+        '''log scale, scale and shift from the output r of a subnet, whose
+        first n channels are the raw log scale'''
+        log_scale = self.clamp * 0.636 * torch.atan(r[:, :n])
+        return log_scale, torch.exp(log_scale), r[:, n:]
+
+    def forward(self, x, rev=False, jac=False, out=None):
         x1, x2 = (x[0].narrow(1, 0, self.split_len1),
                   x[0].narrow(1, self.split_len1, self.split_len2))
+        # See rev_layer
+        y, y1, y2 = _output_halves(out, x[0], self.split_len1,
+                                   self.split_len2)
 
-        if not rev:
-            r2 = self.s2(x2)
-            s2, t2 = r2[:, :self.split_len1], r2[:, self.split_len1:]
-            y1 = self.e(s2) * x1 + t2
+        subnet = partial(run_subnet, dtype=self.subnet_dtype,
+                         checkpoint=self.checkpoint_subnets)
 
-            r1 = self.s1(y1)
-            s1, t1 = r1[:, :self.split_len2], r1[:, self.split_len2:]
+        c = x[1:]
+        if not rev:
+            log_s2, s2, t2 = self.coefficients(
+                subnet(self.s2, _with_condition(x2, c)), self.split_len1)
+            y1 = _affine(s2, x1, t2, y1)
+            log_s1, s1, t1 = self.coefficients(
+                subnet(self.s1, _with_condition(y1, c)), self.split_len2)
+            y2 = _affine(s1, x2, t1, y2)
 
         else:  # names of x and y are swapped!
-            r1 = self.s1(x1)
-            s1, t1 = r1[:, :self.split_len2], r1[:, self.split_len2:]
-            y2 = (x2 - t1) / self.e(s1)
+            log_s1, s1, t1 = self.coefficients(
+                subnet(self.s1, _with_condition(x1, c)), self.split_len2)
+            y2 = _affine_inv(x2, t1, s1, y2)
+            log_s2, s2, t2 = self.coefficients(
+                subnet(self.s2, _with_condition(y2, c)), self.split_len1)
+            y1 = _affine_inv(x1, t2, s2, y1)
+
+        out = [torch.cat((y1, y2), 1) if y is None else y]
+        self._log_scales.store(self, x, rev, (log_s1, log_s2))
+        if jac:
+            return out, self.log_jac(log_s1, log_s2, rev=rev)
+        return out
+
+    def log_jac(self, log_s1, log_s2, rev=False):
+        '''Per-sample log jacobian determinant from the log scales of both
+        halves'''
+        dims = tuple(range(1, self.ndims+1))
+        dtype = self.log_jac_dtype
+        jac = (torch.sum(log_s1, dim=dims, dtype=dtype)
+               + torch.sum(log_s2, dim=dims, dtype=dtype))
+        return -jac if rev else jac
+
+    def jacobian(self, x, rev=False):
+        log_scales = self._log_scales.lookup(self, x, rev)
+        if log_scales is not None:
+            return self.log_jac(*log_scales, rev=rev)
+        return self.forward(x, rev=rev, jac=True)[1]
+
+    def output_dims(self, input_dims):
+        assert len(input_dims) == 1, "Can only use 1 input"
+        return input_dims
 
-            r2 = self.s2(y2)
-            s2, t2 = r2[:, :self.split_len1], r2[:, self.split_len1:]
 
-        jac = (torch.sum(self.log_e(s1), dim=1)
-               + torch.sum(self.log_e(s2), dim=1))
-        for i in range(self.ndims-1):
-            jac = torch.sum(jac, dim=1)
+def _rq_spline(x, params, rev, bound, min_bin=1e-3, min_deriv=1e-3):
+    '''Monotonic rational-quadratic spline (Durkan et al., Neural Spline
+    Flows) applied elementwise to x, or its inverse for rev. params has one
+    more dimension than x, holding the unnormalized widths, heights and
+    inner derivatives of the K bins (3K - 1 values) of each element. The
+    spline maps [-bound, bound] onto itself, outside it is the identity.
+    Returns the result and the elementwise log derivative of the forward
+    spline at the input (rev=False) or at the result (rev=True).'''
+    n_bins = (params.shape[-1] + 1) // 3
+    # Contiguous parameter groups, torch.softmax and softplus are several
+    # times slower along a short strided last dimension. Unpacked explicitly,
+    # the result of split can't be iterated when traced (export_forward)
+    u_w, u_h, u_d = params.split((n_bins, n_bins, n_bins - 1), dim=-1)
+    u_w, u_h, u_d = u_w.contiguous(), u_h.contiguous(), u_d.contiguous()
+
+    def knots(unnormalized):
+        sizes = torch.exp(unnormalized
+                          - unnormalized.amax(dim=-1, keepdim=True))
+        sizes = sizes / sizes.sum(dim=-1, keepdim=True)
+        sizes = min_bin + (1 - min_bin * n_bins) * sizes
+        cum = 2 * bound * torch.cumsum(sizes[..., :-1], dim=-1) - bound
+        # Exact bounds despite rounding, so that the bins cover the interval
+        cum = torch.nn.functional.pad(cum, (1, 0), value=-bound)
+        cum = torch.nn.functional.pad(cum, (0, 1), value=bound)
+        return cum, cum[..., 1:] - cum[..., :-1]
+
+    cum_w, widths = knots(u_w)
+    cum_h, heights = knots(u_h)
+    # Derivative 1 at the bounds, matching the linear tails
+    derivs = torch.nn.functional.pad(
+        min_deriv + torch.nn.functional.softplus(u_d), (1, 1), value=1.)
+
+    inside = (x >= -bound) & (x <= bound)
+    x_in = x.clamp(-bound, bound)
+
+    # Bin of every element, the number of inner knots of its own spline at
+    # or below it. Same as searchsorted(right=True), which has no ONNX op,
+    # and faster for the usual few bins.
+    cum = cum_h if rev else cum_w
+    idx = (x_in.unsqueeze(-1) >= cum[..., 1:-1]).sum(dim=-1, keepdim=True)
+
+    def at(t):
+        return t.gather(-1, idx).squeeze(-1)
+
+    x_k, w_k, y_k, h_k = at(cum_w), at(widths), at(cum_h), at(heights)
+    d_k, d_k1 = at(derivs[..., :-1]), at(derivs[..., 1:])
+    slope = h_k / w_k
+
+    if not rev:
+        theta = (x_in - x_k) / w_k
+        theta_1m = theta * (1 - theta)
+        denom = slope + (d_k1 + d_k - 2 * slope) * theta_1m
+        y = y_k + h_k * (slope * theta**2 + d_k * theta_1m) / denom
+    else:
+        dy = x_in - y_k
+        a = h_k * (slope - d_k) + dy * (d_k1 + d_k - 2 * slope)
+        b = h_k * d_k - dy * (d_k1 + d_k - 2 * slope)
+        c = -slope * dy
+        disc = (b**2 - 4 * a * c).clamp(min=0)
+        theta = (2 * c) / (-b - torch.sqrt(disc))
+        theta_1m = theta * (1 - theta)
+        denom = slope + (d_k1 + d_k - 2 * slope) * theta_1m
+        y = theta * w_k + x_k
+
+    log_deriv = (2 * torch.log(slope)
+                 + torch.log(d_k1 * theta**2 + 2 * slope * theta_1m
+                             + d_k * (1 - theta)**2)
+                 - 2 * torch.log(denom))
+
+    return (torch.where(inside, y, x),
+            torch.where(inside, log_deriv, torch.zeros_like(log_deriv)))
+
+
+class spline_coupling_layer(nn.Module):
+    '''Coupling block as affine_coupling_layer, but each half is transformed
+    by a monotonic rational-quadratic spline with num_bins bins on
+    [-bound, bound] (identity outside) instead of an affine function. The
+    subnets output the 3*num_bins - 1 spline parameters of every channel.
+    The bins are looked up by comparison with the knots, and inverse and log
+    jacobian are analytic, for the whole batch at once. A spline block is more
+    expressive than an affine one, so fewer blocks are needed for
+    multimodal distributions.
+
+    The subnet outputs are 3*num_bins - 1 times wider than the halves, so
+    the default hidden width of F_fully_connected (twice the output) gets
+    large: pass internal_size in F_args. Conditions are supported as in
+    rev_multiplicative_layer.'''
+
+    # See rev_multiplicative_layer
+    subnet_dtype = None
+    log_jac_dtype = None
+    checkpoint_subnets = False
+    cache_log_scales = False
 
-        return jac
+    def __init__(self, dims_in, F_class=F_fully_connected, F_args={},
+                 num_bins=8, bound=3., dims_c=[]):
+        super(spline_coupling_layer, self).__init__()
+        channels = dims_in[0][0]
+        self.ndims = len(dims_in[0])
+        len_c = _condition_channels(dims_in, dims_c)
+
+        self.split_len1 = channels // 2
+        self.split_len2 = channels - channels // 2
+        self.num_bins = num_bins
+        self.bound = bound
+
+        n_params = 3 * num_bins - 1
+        self.s1 = F_class(self.split_len1 + len_c, self.split_len2 * n_params,
+                          **F_args)
+        self.s2 = F_class(self.split_len2 + len_c, self.split_len1 * n_params,
+                          **F_args)
+        self._log_scales = _LogScaleCache()
+
+    def spline(self, x, r, rev):
+        '''Spline of the half x with the parameters from the output r of a
+        subnet, and its elementwise log derivative'''
+        # Channel-major layout: the parameters of channel i are at
+        # r[:, i*n_params:(i+1)*n_params]
+        params = r.reshape(x.shape[:2] + (3 * self.num_bins - 1,)
+                           + x.shape[2:]).movedim(2, -1)
+        return _rq_spline(x, params, rev, self.bound)
+
+    def forward(self, x, rev=False, jac=False, out=None):
+        x1, x2 = (x[0].narrow(1, 0, self.split_len1),
+                  x[0].narrow(1, self.split_len1, self.split_len2))
+        # See rev_layer
+        y, y1_out, y2_out = _output_halves(out, x[0], self.split_len1,
+                                           self.split_len2)
+
+        subnet = partial(run_subnet, dtype=self.subnet_dtype,
+                         checkpoint=self.checkpoint_subnets)
+
+        c = x[1:]
+        if not rev:
+            y1, log_d2 = self.spline(
+                x1, subnet(self.s2, _with_condition(x2, c)), False)
+            y2, log_d1 = self.spline(
+                x2, subnet(self.s1, _with_condition(y1, c)), False)
+
+        else:  # names of x and y are swapped!
+            y2, log_d1 = self.spline(
+                x2, subnet(self.s1, _with_condition(x1, c)), True)
+            y1, log_d2 = self.spline(
+                x1, subnet(self.s2, _with_condition(y2, c)), True)
+
+        if y is None:
+            out = [torch.cat((y1, y2), 1)]
+        else:
+            y1_out.copy_(y1)
+            y2_out.copy_(y2)
+            out = [y]
+        self._log_scales.store(self, x, rev, (log_d1, log_d2))
+        if jac:
+            return out, self.log_jac(log_d1, log_d2, rev=rev)
+        return out
+
+    def log_jac(self, log_d1, log_d2, rev=False):
+        '''Per-sample log jacobian determinant from the elementwise log
+        derivatives of the splines of both halves'''
+        dims = tuple(range(1, self.ndims+1))
+        dtype = self.log_jac_dtype
+        jac = (torch.sum(log_d1, dim=dims, dtype=dtype)
+               + torch.sum(log_d2, dim=dims, dtype=dtype))
+        return -jac if rev else jac
+
+    def jacobian(self, x, rev=False):
+        log_derivs = self._log_scales.lookup(self, x, rev)
+        if log_derivs is not None:
+            return self.log_jac(*log_derivs, rev=rev)
+        return self.forward(x, rev=rev, jac=True)[1]
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
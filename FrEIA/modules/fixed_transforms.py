@@ -2,6 +2,25 @@ import numpy as np
 import torch
 import torch.nn as nn
 
+# Private generator for the fixed permutations. Seeding it gives the same
+# permutations as seeding the global numpy generator did, without touching the
+# global state or reseeding from system entropy for every layer.
+_perm_rng = np.random.RandomState()
+
+
+def output_buffer(out, like):
+    '''Tensor to write the result of a module into, for modules called with
+    an out argument (see ExecutionPlan.execute): out itself if it has the
+    shape, dtype and device of the tensor like, a new tensor otherwise (e.g.
+    for a different batch size), and None if out is None, i.e. the result is
+    allocated as usual. Writing into out only works without autograd.'''
+    if out is None:
+        return None
+    if (out.shape != like.shape or out.dtype != like.dtype
+            or out.device != like.device):
+        return torch.empty_like(like)
+    return out
+
 
 class permute_layer(nn.Module):
     '''permutes input vector in a random but fixed way'''
@@ -11,26 +30,34 @@ class permute_layer(nn.Module):
 
         self.in_channels = dims_in[0][0]
 
-        np.random.seed(seed)
-        self.perm = np.random.permutation(self.in_channels)
-        np.random.seed()
-
-        self.perm_inv = np.zeros_like(self.perm)
-        for i, p in enumerate(self.perm):
-            self.perm_inv[p] = i
-
-        self.perm = torch.LongTensor(self.perm)
-        self.perm_inv = torch.LongTensor(self.perm_inv)
-
-    def forward(self, x, rev=False):
-        if not rev:
-            return [x[0][:, self.perm]]
+        _perm_rng.seed(seed)
+        perm = _perm_rng.permutation(self.in_channels)
+        perm_inv = np.argsort(perm)
+
+        # Non-persistent buffers follow .to()/.cuda() of the module, but are
+        # not part of the state_dict, as they are determined by the seed
+        self.register_buffer('perm', torch.LongTensor(perm),
+                             persistent=False)
+        self.register_buffer('perm_inv', torch.LongTensor(perm_inv),
+                             persistent=False)
+
+    def forward(self, x, rev=False, jac=False, out=None):
+        # index_select is a plain gather, advanced indexing with x[:, perm]
+        # takes the much slower general path
+        perm = self.perm_inv if rev else self.perm
+        y = output_buffer(out, x[0])
+        # No out=None in the call, the exported (scripted) graphs reject it
+        if y is None:
+            out = [torch.index_select(x[0], 1, perm)]
         else:
-            return [x[0][:, self.perm_inv]]
+            out = [torch.index_select(x[0], 1, perm, out=y)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO: use batch size, set as nn.Parameter so cuda() works
-        return 0.
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -48,21 +75,25 @@ class linear_transform(nn.Module):
         self.M_inv = nn.Parameter(M.t().inverse(), requires_grad=False)
         self.b = nn.Parameter(b, requires_grad=False)
 
-        self.logDetM = nn.Parameter(torch.log(torch.potrf(M).diag()).sum(),
+        self.logDetM = nn.Parameter(torch.slogdet(M)[1],
                                     requires_grad=False)
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if not rev:
-            return [x[0].mm(self.M) + self.b]
+            out = [x[0].mm(self.M) + self.b]
         else:
-            return [(x[0]-self.b).mm(self.M_inv)]
+            out = [(x[0]-self.b).mm(self.M_inv)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO use batch size
+        jac = self.logDetM.expand(x[0].shape[0])
         if rev:
-            return -self.logDetM
+            return -jac
         else:
-            return self.logDetM
+            return jac
 
     def output_dims(self, input_dims):
         return input_dims
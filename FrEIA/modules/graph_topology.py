@@ -12,15 +12,18 @@ class channel_split_layer(nn.Module):
         assert len(dims_in) == 1, "Use channel_merge_layer instead"
         self.channels = dims_in[0][0]
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if rev:
-            return [torch.cat(x, dim=1)]
+            out = [torch.cat(x, dim=1)]
         else:
-            return [x[0][:, :self.channels//2], x[0][:, self.channels//2:]]
+            out = [x[0][:, :self.channels//2], x[0][:, self.channels//2:]]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO batch size
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Use channel_merge_layer instead"
@@ -37,15 +40,18 @@ class channel_merge_layer(nn.Module):
         self.ch1 = dims_in[0][0]
         self.ch2 = dims_in[1][0]
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if rev:
-            return [x[0][:, :self.ch1], x[0][:, self.ch1:]]
+            out = [x[0][:, :self.ch1], x[0][:, self.ch1:]]
         else:
-            return [torch.cat(x, dim=1)]
+            out = [torch.cat(x, dim=1)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO batch size
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 2, "Can only merge 2 inputs"
@@ -77,16 +83,19 @@ class split_layer(nn.Module):
         self.split_size_or_sections = split_size_or_sections
         self.dim = dim
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if rev:
-            return [torch.cat(x, dim=self.dim+1)]
+            out = [torch.cat(x, dim=self.dim+1)]
         else:
-            return torch.split(x[0], self.split_size_or_sections,
-                               dim=self.dim+1)
+            out = torch.split(x[0], self.split_size_or_sections,
+                              dim=self.dim+1)
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO batch size
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, ("Split layer takes exactly one input "
@@ -122,16 +131,19 @@ class cat_layer(nn.Module):
         self.split_size_or_sections = [dims_in[i][dim]
                                        for i in range(len(dims_in))]
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if rev:
-            return torch.split(x[0], self.split_size_or_sections,
-                               dim=self.dim+1)
+            out = torch.split(x[0], self.split_size_or_sections,
+                              dim=self.dim+1)
         else:
-            return [torch.cat(x, dim=self.dim+1)]
+            out = [torch.cat(x, dim=self.dim+1)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO batch size
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) > 1, ("Concatenation only makes sense for "
@@ -0,0 +1,155 @@
+import torch
+import torch.fx
+import torch.nn as nn
+
+from .fixed_transforms import output_buffer
+
+
+class lu_linear_layer(nn.Module):
+    '''Learnable invertible linear transformation y = Wx of the channels,
+    with W parameterized by its LU decomposition W = P L (U + diag(s)): a
+    fixed permutation P, a lower triangular L with unit diagonal, a strictly
+    upper triangular U and the diagonal s = sign * exp(log_s). W is
+    initialized as a random rotation, i.e. a learnable permute_layer. For
+    inputs with spatial dimensions, it is applied as a 1x1 convolution.
+
+    The log jacobian determinant is the sum of log_s (times the number of
+    pixels), and the inverse takes two triangular solves, so no step needs
+    a determinant or inverse of a dense matrix. In eval mode without
+    autograd, W and its inverse are computed once and kept until the
+    parameters change, so that both directions are a single matrix product.
+    The rotation is drawn from the global torch generator, or from its own
+    one if seed is given.'''
+
+    def __init__(self, dims_in, seed=None):
+        super().__init__()
+
+        self.in_channels = dims_in[0][0]
+        self.ndims = len(dims_in[0])
+        self.n_pixels = 1
+        for n in dims_in[0][1:]:
+            self.n_pixels *= n
+        d = self.in_channels
+
+        # Without a seed, the global generator of torch is used
+        rng = None if seed is None else torch.Generator().manual_seed(seed)
+        W = torch.linalg.qr(torch.randn(d, d, generator=rng,
+                                        dtype=torch.float64))[0]
+        P, L, U = torch.linalg.lu(W)
+        s = torch.diagonal(U)
+
+        # P[i, perm[i]] = 1, so (P z)_i = z_perm[i]
+        dtype = torch.get_default_dtype()
+        perm = P.argmax(1)
+        self.register_buffer('perm', perm)
+        self.register_buffer('perm_inv', torch.argsort(perm))
+        self.register_buffer('sign_s', torch.sign(s).to(dtype))
+
+        self.L = nn.Parameter(torch.tril(L, -1).to(dtype))
+        self.U = nn.Parameter(torch.triu(U, 1).to(dtype))
+        self.log_s = nn.Parameter(torch.log(torch.abs(s)).to(dtype))
+
+        self._cache = None
+
+    def _factors(self):
+        '''L and U + diag(s) as full triangular matrices'''
+        eye = torch.eye(self.in_channels, dtype=self.L.dtype,
+                        device=self.L.device)
+        # eye * s instead of torch.diag, which the ONNX exporter lacks
+        return (torch.tril(self.L, -1) + eye,
+                torch.triu(self.U, 1) + eye * self._s())
+
+    def _s(self):
+        '''The diagonal of U'''
+        return self.sign_s * torch.exp(self.log_s)
+
+    def _weight(self, rev):
+        '''W^T, or W^-T for rev, as a dense matrix'''
+        L, U = self._factors()
+        if not rev:
+            return (L @ U)[self.perm].t()
+        eye = torch.eye(self.in_channels, dtype=L.dtype, device=L.device)
+        L_inv = torch.linalg.solve_triangular(L, eye, upper=False,
+                                              unitriangular=True)
+        U_inv = torch.linalg.solve_triangular(U, eye, upper=True)
+        return (U_inv @ L_inv)[:, self.perm].t()
+
+    def _weights(self):
+        '''W^T and W^-T for the eval mode, computed again if the parameters
+        were changed (e.g. by an optimizer step, load_state_dict or .to())'''
+        key = tuple((id(p), p._version, p.dtype, p.device)
+                    for p in (self.L, self.U, self.log_s))
+        if self._cache is None or self._cache[0] != key:
+            with torch.no_grad():
+                self._cache = (key, self._weight(False).contiguous(),
+                               self._weight(True).contiguous())
+        return self._cache[1], self._cache[2]
+
+    def _cached(self, x):
+        '''Whether x can be transformed with the cached weights: in eval
+        mode, without autograd (they are computed without it) and outside of
+        torch.func transforms such as the vmap of Ensemble, where the
+        parameters are batched tensors of each call'''
+        return (not self.training and not torch.is_grad_enabled()
+                and not isinstance(x, torch.fx.Proxy)
+                and not torch._C._are_functorch_transforms_active())
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to(), .double() etc. don't change the version of the parameters
+        self._cache = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _transform(self, x, rev):
+        '''Apply W (or W^-1 for rev) to the rows of the 2D tensor x'''
+        if not self.training:
+            if self._cached(x):
+                W_t, W_inv_t = self._weights()
+                return x.mm(W_inv_t if rev else W_t)
+            # A plain matrix product with the weight computed in the graph.
+            # When traced for export, torch.jit.freeze folds it into a
+            # constant.
+            return x.mm(self._weight(rev))
+
+        self._cache = None
+        if not rev:
+            # x W^T = x U^T L^T P^T, with the diagonals of U and L applied
+            # as products, without building the full triangular matrices
+            z = torch.addmm(x * self._s(), x, torch.triu(self.U, 1).t())
+            z = torch.addmm(z, z, torch.tril(self.L, -1).t())
+            return torch.index_select(z, 1, self.perm)
+        L, U = self._factors()
+        z = torch.index_select(x, 1, self.perm_inv)
+        z = torch.linalg.solve_triangular(L.t(), z, upper=True, left=False,
+                                          unitriangular=True)
+        return torch.linalg.solve_triangular(U.t(), z, upper=False,
+                                             left=False)
+
+    def forward(self, x, rev=False, jac=False, out=None):
+        x0 = x[0]
+        if self.ndims == 1:
+            y = output_buffer(out, x0)
+            if y is not None and self._cached(x0):
+                W_t, W_inv_t = self._weights()
+                y = torch.mm(x0, W_inv_t if rev else W_t, out=y)
+            else:
+                y = self._transform(x0, rev)
+        else:
+            # 1x1 convolution: the same transformation for every pixel
+            z = x0.movedim(1, -1)
+            y = self._transform(z.reshape(-1, self.in_channels), rev)
+            y = y.reshape(z.shape).movedim(-1, 1)
+        out = [y]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
+
+    def jacobian(self, x, rev=False):
+        jac = (self.n_pixels * self.log_s.sum()).expand(x[0].shape[0])
+        if rev:
+            return -jac
+        return jac
+
+    def output_dims(self, input_dims):
+        assert len(input_dims) == 1, "Can only use 1 input"
+        return input_dims
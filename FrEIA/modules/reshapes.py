@@ -13,47 +13,35 @@ class i_revnet_downsampling(nn.Module):
         self.block_size = 2
         self.block_size_sq = self.block_size**2
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         input = x[0]
+        bs = self.block_size
         if not rev:
-            output = input.permute(0, 2, 3, 1)
-            (batch_size, s_height, s_width, s_depth) = output.size()
-            d_depth = s_depth * self.block_size_sq
-            d_height = int(s_height / self.block_size)
-            t_1 = output.split(self.block_size, 2)
-            stack = [t_t.contiguous().view(batch_size, d_height, d_depth)
-                     for t_t in t_1]
-            output = torch.stack(stack, 1)
-            output = output.permute(0, 2, 1, 3)
-            output = output.permute(0, 3, 1, 2)
-            return [output.contiguous()]
-            # (own attempt)
-            # return torch.cat([
-            #         x[:, :,  ::2,  ::2],
-            #         x[:, :, 1::2,  ::2],
-            #         x[:, :,  ::2, 1::2],
-            #         x[:, :, 1::2, 1::2]
-            #     ], dim=1)
+            # (batch, c, h/2, 2, w/2, 2) -> (batch, 2, 2, c, h/2, w/2)
+            output = input.view(input.shape[0], input.shape[1],
+                                input.shape[2] // bs, bs,
+                                input.shape[3] // bs, bs)
+            output = output.permute(0, 3, 5, 1, 2, 4)
+            out = [output.reshape(input.shape[0],
+                                  input.shape[1] * self.block_size_sq,
+                                  input.shape[2] // bs,
+                                  input.shape[3] // bs)]
         else:
-            output = input.permute(0, 2, 3, 1)
-            (batch_size, d_height, d_width, d_depth) = output.size()
-            s_depth = int(d_depth / self.block_size_sq)
-            s_width = int(d_width * self.block_size)
-            s_height = int(d_height * self.block_size)
-            t_1 = output.contiguous().view(batch_size, d_height, d_width,
-                                           self.block_size_sq, s_depth)
-            spl = t_1.split(self.block_size, 3)
-            stack = [t_t.contiguous().view(batch_size, d_height, s_width,
-                                           s_depth) for t_t in spl]
-            output = torch.stack(stack, 0).transpose(0, 1)
-            output = output.permute(0, 2, 1, 3, 4).contiguous()
-            output = output.view(batch_size, s_height, s_width, s_depth)
-            output = output.permute(0, 3, 1, 2)
-            return [output.contiguous()]
+            output = input.view(input.shape[0], bs, bs,
+                                input.shape[1] // self.block_size_sq,
+                                input.shape[2], input.shape[3])
+            output = output.permute(0, 3, 4, 1, 5, 2)
+            out = [output.reshape(input.shape[0],
+                                  input.shape[1] // self.block_size_sq,
+                                  input.shape[2] * bs,
+                                  input.shape[3] * bs)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO respect batch dimension and .cuda()
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -69,12 +57,15 @@ class i_revnet_upsampling(i_revnet_downsampling):
     def __init__(self, dims_in):
         super(i_revnet_upsampling, self).__init__(dims_in)
 
-    def forward(self, x, rev=False):
-        return super(i_revnet_upsampling, self).forward(x, rev=not rev)
+    def forward(self, x, rev=False, jac=False):
+        out = super(i_revnet_upsampling, self).forward(x, rev=not rev)
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO respect batch dimension and .cuda()
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -115,34 +106,38 @@ class haar_multiplex_layer(nn.Module):
             for i in range(4):
                 permutation += [i+4*j for j in range(self.in_channels)]
 
-            self.perm = torch.LongTensor(permutation)
-            self.perm_inv = torch.LongTensor(permutation)
+            perm = torch.LongTensor(permutation)
+            perm_inv = torch.empty_like(perm)
+            perm_inv[perm] = torch.arange(len(perm))
 
-            for i, p in enumerate(self.perm):
-                self.perm_inv[p] = i
+            self.register_buffer('perm', perm, persistent=False)
+            self.register_buffer('perm_inv', perm_inv, persistent=False)
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if not rev:
             out = F.conv2d(x[0], self.haar_weights,
                            bias=None, stride=2, groups=self.in_channels)
             if self.permute:
-                return [out[:, self.perm]]
+                out = [out.index_select(1, self.perm)]
             else:
-                return [out]
+                out = [out]
 
         else:
             if self.permute:
-                x_perm = x[0][:, self.perm_inv]
+                x_perm = x[0].index_select(1, self.perm_inv)
             else:
                 x_perm = x[0]
 
-            return [F.conv_transpose2d(x_perm, self.haar_weights,
-                                       bias=None, stride=2,
-                                       groups=self.in_channels)]
+            out = [F.conv_transpose2d(x_perm, self.haar_weights,
+                                      bias=None, stride=2,
+                                      groups=self.in_channels)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO respect batch dimension and .cuda()
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -176,18 +171,21 @@ class haar_restore_layer(nn.Module):
         self.haar_weights = nn.Parameter(self.haar_weights)
         self.haar_weights.requires_grad = False
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if rev:
-            return [F.conv2d(x[0], self.haar_weights,
-                             bias=None, stride=2, groups=self.in_channels)]
+            out = [F.conv2d(x[0], self.haar_weights,
+                            bias=None, stride=2, groups=self.in_channels)]
         else:
-            return [F.conv_transpose2d(x[0], self.haar_weights,
-                                       bias=None, stride=2,
-                                       groups=self.in_channels)]
+            out = [F.conv_transpose2d(x[0], self.haar_weights,
+                                      bias=None, stride=2,
+                                      groups=self.in_channels)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO respect batch dimension and .cuda()
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         assert len(input_dims) == 1, "Can only use 1 input"
@@ -197,21 +195,219 @@ class haar_restore_layer(nn.Module):
         return [(c2, w2, h2)]
 
 
+class i_revnet_downsampling_1d(nn.Module):
+    '''The i-RevNet downsampling (squeeze) for inputs of shape (channels,
+    length): every two neighbouring samples of a channel become two
+    channels of half the length.'''
+
+    def __init__(self, dims_in):
+        super(i_revnet_downsampling_1d, self).__init__()
+        self.block_size = 2
+
+    def forward(self, x, rev=False, jac=False):
+        input = x[0]
+        bs = self.block_size
+        if not rev:
+            # (batch, c, l/2, 2) -> (batch, 2, c, l/2)
+            output = input.view(input.shape[0], input.shape[1],
+                                input.shape[2] // bs, bs)
+            output = output.permute(0, 3, 1, 2)
+            out = [output.reshape(input.shape[0], input.shape[1] * bs,
+                                  input.shape[2] // bs)]
+        else:
+            output = input.view(input.shape[0], bs, input.shape[1] // bs,
+                                input.shape[2])
+            output = output.permute(0, 2, 3, 1)
+            out = [output.reshape(input.shape[0], input.shape[1] // bs,
+                                  input.shape[2] * bs)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
+
+    def jacobian(self, x, rev=False):
+        return x[0].new_zeros(x[0].shape[0])
+
+    def output_dims(self, input_dims):
+        assert len(input_dims) == 1, "Can only use 1 input"
+        c, l = input_dims[0]
+        c2, l2 = c*2, l//2
+        assert c*l == c2*l2, "Uneven input length"
+        return [(c2, l2)]
+
+
+class i_revnet_upsampling_1d(i_revnet_downsampling_1d):
+    '''Just the exact opposite of the i_revnet_downsampling_1d layer.'''
+
+    def __init__(self, dims_in):
+        super(i_revnet_upsampling_1d, self).__init__(dims_in)
+
+    def forward(self, x, rev=False, jac=False):
+        out = super(i_revnet_upsampling_1d, self).forward(x, rev=not rev)
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
+
+    def output_dims(self, input_dims):
+        assert len(input_dims) == 1, "Can only use 1 input"
+        c, l = input_dims[0]
+        c2, l2 = c//2, l*2
+        assert c*l == c2*l2, "Uneven number of channels"
+        return [(c2, l2)]
+
+
+def _haar_weights_1d(channels):
+    '''Weights of the grouped convolution for the orthonormal 1-D Haar
+    transform: mean and difference of every two samples, per channel'''
+    weights = torch.ones(2, 1, 2)
+    weights[1, 0, 1] = -1
+    weights *= 2**-0.5
+    return torch.cat([weights]*channels, 0)
+
+
+class haar_multiplex_layer_1d(nn.Module):
+    '''Uses Haar wavelets to split each channel of an input of shape
+    (channels, length) into 2 channels, with half the length.'''
+
+    def __init__(self, dims_in, order_by_wavelet=False):
+        super(haar_multiplex_layer_1d, self).__init__()
+
+        self.in_channels = dims_in[0][0]
+        # Fixed, so not part of the state_dict
+        self.register_buffer('haar_weights',
+                             _haar_weights_1d(self.in_channels),
+                             persistent=False)
+
+        self.permute = order_by_wavelet
+
+        if self.permute:
+            permutation = []
+            for i in range(2):
+                permutation += [i+2*j for j in range(self.in_channels)]
+
+            perm = torch.LongTensor(permutation)
+            perm_inv = torch.empty_like(perm)
+            perm_inv[perm] = torch.arange(len(perm))
+
+            self.register_buffer('perm', perm, persistent=False)
+            self.register_buffer('perm_inv', perm_inv, persistent=False)
+
+    def forward(self, x, rev=False, jac=False):
+        if not rev:
+            out = F.conv1d(x[0], self.haar_weights,
+                           bias=None, stride=2, groups=self.in_channels)
+            if self.permute:
+                out = [out.index_select(1, self.perm)]
+            else:
+                out = [out]
+
+        else:
+            if self.permute:
+                x_perm = x[0].index_select(1, self.perm_inv)
+            else:
+                x_perm = x[0]
+
+            out = [F.conv_transpose1d(x_perm, self.haar_weights,
+                                      bias=None, stride=2,
+                                      groups=self.in_channels)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
+
+    def jacobian(self, x, rev=False):
+        return x[0].new_zeros(x[0].shape[0])
+
+    def output_dims(self, input_dims):
+        assert len(input_dims) == 1, "Can only use 1 input"
+        c, l = input_dims[0]
+        c2, l2 = c*2, l//2
+        assert c*l == c2*l2, "Uneven input length"
+        return [(c2, l2)]
+
+
+class haar_restore_layer_1d(nn.Module):
+    '''Uses Haar wavelets to merge 2 channels into one, with double the
+    length.'''
+
+    def __init__(self, dims_in):
+        super(haar_restore_layer_1d, self).__init__()
+
+        self.in_channels = dims_in[0][0] // 2
+        self.register_buffer('haar_weights',
+                             _haar_weights_1d(self.in_channels),
+                             persistent=False)
+
+    def forward(self, x, rev=False, jac=False):
+        if rev:
+            out = [F.conv1d(x[0], self.haar_weights,
+                            bias=None, stride=2, groups=self.in_channels)]
+        else:
+            out = [F.conv_transpose1d(x[0], self.haar_weights,
+                                      bias=None, stride=2,
+                                      groups=self.in_channels)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
+
+    def jacobian(self, x, rev=False):
+        return x[0].new_zeros(x[0].shape[0])
+
+    def output_dims(self, input_dims):
+        assert len(input_dims) == 1, "Can only use 1 input"
+        c, l = input_dims[0]
+        c2, l2 = c//2, l*2
+        assert c*l == c2*l2, "Uneven number of channels"
+        return [(c2, l2)]
+
+
 class flattening_layer(nn.Module):
     '''Flattens N-D tensors into 1-D tensors.'''
     def __init__(self, dims_in):
         super(flattening_layer, self).__init__()
         self.size = dims_in[0]
 
-    def forward(self, x, rev=False):
+    def forward(self, x, rev=False, jac=False):
         if not rev:
-            return [x[0].view(x[0].shape[0], -1)]
+            out = [x[0].view(x[0].shape[0], -1)]
         else:
-            return [x[0].view(x[0].shape[0], *self.size)]
+            out = [x[0].view(x[0].shape[0], *self.size)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
 
     def jacobian(self, x, rev=False):
-        # TODO respect batch dimension and .cuda()
-        return 0
+        return x[0].new_zeros(x[0].shape[0])
 
     def output_dims(self, input_dims):
         return [(int(np.prod(input_dims[0])),)]
+
+
+class unflattening_layer(nn.Module):
+    '''Reshapes 1-D tensors into N-D tensors of the given shape, the
+    counterpart of flattening_layer. E.g. shape=(1, ndata) turns a vector
+    into a single-channel time series for 1-D convolutional blocks.'''
+    def __init__(self, dims_in, shape):
+        super(unflattening_layer, self).__init__()
+        self.size = tuple(shape)
+        assert int(np.prod(dims_in[0])) == int(np.prod(self.size)), (
+            "Shape must have as many elements as the input")
+
+    def forward(self, x, rev=False, jac=False):
+        if not rev:
+            out = [x[0].reshape(x[0].shape[0], *self.size)]
+        else:
+            out = [x[0].reshape(x[0].shape[0], -1)]
+
+        if jac:
+            return out, self.jacobian(x, rev=rev)
+        return out
+
+    def jacobian(self, x, rev=False):
+        return x[0].new_zeros(x[0].shape[0])
+
+    def output_dims(self, input_dims):
+        return [self.size]
@@ -0,0 +1,80 @@
+'''Multi-scale architectures for 1-D INNs, as in Real-NVP and Glow. The
+coupling blocks are grouped into scales, and after every scale but the last,
+a fraction of the dimensions is split off (factored out) with a split_layer
+and sent straight to the output. The blocks of later scales only run on the
+remaining dimensions, so the cost of training and sampling drops roughly
+geometrically with depth, e.g. with factor_out=0.5 every scale costs half as
+much per block as the one before.'''
+
+from FrEIA.framework import InputNode, OutputNode, Node
+from FrEIA.modules import permute_layer, split_layer, cat_layer
+
+
+def multiscale_nodes(n_dims, coupling_layer, coupling_args, n_blocks,
+                     n_scales=2, factor_out=0.5, merge_outputs=False,
+                     name='multiscale'):
+    '''Node list of a multi-scale net on vectors of n_dims dimensions, to be
+    passed to ReversibleGraphNet. The n_blocks coupling blocks (each followed
+    by a permute_layer, except for the last one) are spread evenly over
+    n_scales scales, earlier scales get the extra blocks. After each scale
+    but the last, the fraction factor_out of its dimensions is factored out.
+
+    coupling_args are the arguments of the coupling blocks, either a dict or
+    a function of the number of dimensions of a scale returning the dict,
+    e.g. to set the width of the subnets per scale.
+
+    The net has one OutputNode per scale, in the order the dimensions are
+    factored out, the one of the last scale at the end. With
+    merge_outputs=True, they are concatenated with a cat_layer into a single
+    output of n_dims dimensions in the same order instead, e.g. to replace a
+    single-scale net without changing the shape of its output.'''
+    assert 1 <= n_scales <= n_blocks, (
+        "Need at least one coupling block per scale")
+    if not callable(coupling_args):
+        args = coupling_args
+
+        def coupling_args(width):
+            return args
+
+    nodes = [InputNode(n_dims, name='%s_input' % name)]
+    factored = []
+    width = n_dims
+    prev = nodes[0].out0
+    block = 0
+    for scale in range(n_scales):
+        scale_blocks = n_blocks // n_scales + (scale < n_blocks % n_scales)
+        for i in range(scale_blocks):
+            nodes.append(Node([prev], coupling_layer, coupling_args(width),
+                              name='%s_coupling_%d' % (name, block)))
+            prev = nodes[-1].out0
+            if block != n_blocks - 1:
+                nodes.append(Node([prev], permute_layer, {'seed': block},
+                                  name='%s_permute_%d' % (name, block)))
+                prev = nodes[-1].out0
+            block += 1
+
+        if scale == n_scales - 1:
+            break
+
+        n_out = int(round(factor_out * width))
+        assert 0 < n_out <= width - 2, (
+            "Scale %d of %d dimensions can't factor out %d of them, and "
+            "keep 2 for the coupling blocks" % (scale, width, n_out))
+        split = Node([prev], split_layer,
+                     {'split_size_or_sections': [width - n_out, n_out],
+                      'dim': 0},
+                     name='%s_split_%d' % (name, scale))
+        nodes.append(split)
+        factored.append(split.out1)
+        prev = split.out0
+        width -= n_out
+
+    if merge_outputs and factored:
+        nodes.append(Node(factored + [prev], cat_layer, {'dim': 0},
+                          name='%s_cat' % name))
+        nodes.append(OutputNode([nodes[-1].out0], name='%s_output' % name))
+    else:
+        for scale, out in enumerate(factored + [prev]):
+            nodes.append(OutputNode([out],
+                                    name='%s_output_%d' % (name, scale)))
+    return nodes
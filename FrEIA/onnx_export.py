@@ -0,0 +1,92 @@
+'''Export of ReversibleGraphNets to standalone ONNX graphs, so that a trained
+net can be run with ONNX Runtime (e.g. for posterior sampling on CPU-only
+machines) without PyTorch, FrEIA or the training code. The onnx package is
+only needed when actually exporting.'''
+
+import inspect
+
+import torch
+import torch.nn as nn
+
+
+class _WithFeatureNets(nn.Module):
+    '''Runs the feature nets of the ConditionNodes on the conditions before
+    the exported graph of a conditional net, which takes the features.'''
+
+    def __init__(self, graph_module, feature_nets, n_inputs):
+        super(_WithFeatureNets, self).__init__()
+        self.graph_module = graph_module
+        self.feature_nets = nn.ModuleList(
+            nn.Identity() if f is None else f for f in feature_nets)
+        self.n_inputs = n_inputs
+
+    def forward(self, x):
+        features = [f(c) for f, c in zip(self.feature_nets,
+                                         x[self.n_inputs:])]
+        return self.graph_module(list(x[:self.n_inputs]) + features)
+
+
+def _example_inputs(net, rev, batch_size=2):
+    '''Zero tensors with the shapes the net expects in the given direction,
+    followed by the conditions. A batch size > 1 keeps the exporter from
+    specializing on batch size 1.'''
+    if rev:
+        dims = [net.node_list[i].input_dims[0] for i in net.ind_out]
+    else:
+        dims = [net.node_list[i].data.shape for i in net.ind_in]
+    dims += [net.node_list[i].dims for i in net.ind_cond]
+    return [torch.zeros(batch_size, *d) for d in dims]
+
+
+def export_onnx(net, path, rev=False, jac=False, opset_version=17):
+    '''Write one direction of net to an ONNX file at path. The inputs are
+    called input_0, input_1, ..., the outputs output_0, output_1, ... and,
+    with jac=True, log_jac. The data of the ConditionNodes of a conditional
+    net are the inputs condition_0, condition_1, ..., their feature nets are
+    part of the exported graph. The batch dimension of all of them is
+    dynamic. The net is exported in eval mode.'''
+    graph_module = net.export_reverse(jac) if rev else net.export_forward(jac)
+    n_inputs = len(net.ind_out) if rev else len(net.ind_in)
+    if net.ind_cond:
+        graph_module = _WithFeatureNets(
+            graph_module, [net.node_list[i].module for i in net.ind_cond],
+            n_inputs)
+    graph_module.eval()
+
+    inputs = _example_inputs(net, rev)
+    n_outputs = len(net.ind_in) if rev else len(net.ind_out)
+    input_names = (['input_%d' % i for i in range(n_inputs)]
+                   + ['condition_%d' % i for i in range(len(net.ind_cond))])
+    output_names = ['output_%d' % i for i in range(n_outputs)]
+    if jac:
+        output_names.append('log_jac')
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names}
+
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # The fx graphs are exported with the TorchScript based exporter,
+        # the dynamo exporter doesn't support dynamic_axes
+        kwargs['dynamo'] = False
+
+    args = (inputs[0],) if len(inputs) == 1 else (inputs,)
+    with torch.no_grad():
+        torch.onnx.export(graph_module, args, path,
+                          input_names=input_names,
+                          output_names=output_names,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version, **kwargs)
+    return path
+
+
+def export_all(net, prefix, opset_version=17):
+    '''Export the forward pass, the reverse pass and the forward pass with log
+    jacobian determinant of net to prefix + '_forward.onnx', '_reverse.onnx'
+    and '_forward_jac.onnx'. Returns the paths, keyed by 'forward', 'reverse'
+    and 'forward_jac'.'''
+    paths = {}
+    for key, rev, jac in (('forward', False, False),
+                          ('reverse', True, False),
+                          ('forward_jac', False, True)):
+        paths[key] = export_onnx(net, '%s_%s.onnx' % (prefix, key), rev=rev,
+                                 jac=jac, opset_version=opset_version)
+    return paths
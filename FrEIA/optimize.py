@@ -0,0 +1,303 @@
+'''Inference-time graph optimizations for ReversibleGraphNets. optimize_graph
+returns a new, equivalent net with fewer nodes, by repeatedly applying:
+
+ * Consecutive permute_layers are composed into one, and permutations that
+   end up as the identity are removed.
+ * permute_layers next to a linear_transform are folded into its matrix and
+   bias, and consecutive linear_transforms are multiplied into one.
+ * Back-to-back pairs of a reshape and its inverse (downsampling/upsampling,
+   Haar multiplex/restore, both also in 1-D, channel split/merge, split/cat,
+   flattening/unflattening) cancel each other.
+
+The modules of the optimized net are copies, so the original net stays
+unchanged. The fused linear_transforms agree with the original ops up to
+floating point rounding, all other rewrites are exact.'''
+
+import copy
+
+import torch
+import torch.nn as nn
+
+from FrEIA.framework import (InputNode, OutputNode, ConditionNode, Node,
+                             ReversibleGraphNet)
+from FrEIA.modules import (permute_layer, linear_transform,
+                           i_revnet_downsampling, i_revnet_upsampling,
+                           haar_multiplex_layer, haar_restore_layer,
+                           i_revnet_downsampling_1d, i_revnet_upsampling_1d,
+                           haar_multiplex_layer_1d, haar_restore_layer_1d,
+                           flattening_layer, unflattening_layer,
+                           channel_split_layer, channel_merge_layer,
+                           split_layer, cat_layer)
+
+
+class _prebuilt:
+    '''Stands in for the module class of a Node, and returns a module that
+    was already built instead of constructing a new one.'''
+
+    def __init__(self, module):
+        self.module = module
+        self.__name__ = type(module).__name__
+
+    def __call__(self, dims_in, dims_c=None):
+        return self.module
+
+
+class _Op:
+    '''Node of the graph while it is rewritten. inputs are (op, channel)
+    pairs, like the inputs of Node, and conditions the ops of its
+    ConditionNodes.'''
+
+    def __init__(self, name, module, inputs, n_outputs, node=None,
+                 conditions=()):
+        self.name = name
+        self.module = module
+        self.inputs = inputs
+        self.n_outputs = n_outputs
+        self.node = node
+        self.conditions = list(conditions)
+
+
+def _permutation(like, perm):
+    m = copy.deepcopy(like)
+    m.perm = perm
+    m.perm_inv = torch.argsort(perm)
+    return m
+
+
+def _linear(like, M, M_inv, b, log_det):
+    m = copy.deepcopy(like)
+    m.M = nn.Parameter(M, requires_grad=False)
+    m.M_inv = nn.Parameter(M_inv, requires_grad=False)
+    m.b = nn.Parameter(b, requires_grad=False)
+    m.logDetM = nn.Parameter(log_det, requires_grad=False)
+    return m
+
+
+def _fuse_fixed(first, second):
+    '''Single module equivalent to the permute_layer or linear_transform
+    first, followed by second. Note that linear_transform stores the
+    transposed matrix, y = x.mm(M) + b.'''
+    if isinstance(first, permute_layer) and isinstance(second, permute_layer):
+        return _permutation(second, first.perm[second.perm])
+
+    if isinstance(first, permute_layer):
+        # x[:, p].mm(M) == x.mm(M[p_inv])
+        p_inv = first.perm_inv
+        return _linear(second, second.M[p_inv], second.M_inv[:, p_inv],
+                       second.b, second.logDetM)
+
+    if isinstance(second, permute_layer):
+        # (x.mm(M) + b)[:, p] == x.mm(M[:, p]) + b[p]
+        p = second.perm
+        return _linear(first, first.M[:, p], first.M_inv[p], first.b[p],
+                       first.logDetM)
+
+    return _linear(second, first.M.mm(second.M),
+                   second.M_inv.mm(first.M_inv),
+                   first.b.matmul(second.M) + second.b,
+                   first.logDetM + second.logDetM)
+
+
+def _is_identity(module):
+    return (type(module) is permute_layer
+            and torch.equal(module.perm, torch.arange(
+                len(module.perm), device=module.perm.device)))
+
+
+def _is_inverse(first, second):
+    '''Whether the reshape second undoes the reshape first exactly.'''
+    types = (type(first), type(second))
+    if types in [(i_revnet_downsampling, i_revnet_upsampling),
+                 (i_revnet_upsampling, i_revnet_downsampling),
+                 (i_revnet_downsampling_1d, i_revnet_upsampling_1d),
+                 (i_revnet_upsampling_1d, i_revnet_downsampling_1d),
+                 (channel_split_layer, channel_merge_layer),
+                 (unflattening_layer, flattening_layer)]:
+        return True
+    if types in [(haar_multiplex_layer, haar_restore_layer),
+                 (haar_multiplex_layer_1d, haar_restore_layer_1d)]:
+        return not first.permute
+    if types in [(haar_restore_layer, haar_multiplex_layer),
+                 (haar_restore_layer_1d, haar_multiplex_layer_1d)]:
+        return not second.permute
+    if types == (flattening_layer, unflattening_layer):
+        return tuple(first.size) == second.size
+    if types == (channel_merge_layer, channel_split_layer):
+        return first.ch1 == second.channels // 2
+    if types in [(split_layer, cat_layer), (cat_layer, split_layer)]:
+        return (first.dim == second.dim
+                and (list(first.split_size_or_sections)
+                     == list(second.split_size_or_sections)))
+    return False
+
+
+class _Graph:
+    '''The graph of a built net while it is rewritten. The ops are kept in
+    insertion order, users maps each op to the ops reading its outputs, once
+    per input.'''
+
+    def __init__(self, net):
+        ops = {node: _Op(node.name, node.module, [],
+                         getattr(node, 'n_outputs', 0), node)
+               for node in net.node_list}
+        for node, op in ops.items():
+            if not isinstance(node, InputNode):
+                op.inputs = [(ops[n], c) for n, c in node.inputs]
+                op.conditions = [ops[n] for n in node.conditions]
+
+        self.ops = dict.fromkeys(ops.values())
+        self.users = {op: [] for op in self.ops}
+        for op in self.ops:
+            for src, c in op.inputs:
+                self.users[src].append(op)
+
+    @staticmethod
+    def is_op(op):
+        return not isinstance(op.node, (InputNode, OutputNode, ConditionNode))
+
+    def add(self, op):
+        self.ops[op] = None
+        self.users[op] = []
+        for src, c in op.inputs:
+            self.users[src].append(op)
+
+    def remove(self, removed, redirect):
+        '''Remove the ops in removed. Every input (op, c) of the remaining
+        ops that refers to a removed op is replaced by redirect[op](c).'''
+        for op in removed:
+            for src, c in op.inputs:
+                if src not in removed:
+                    self.users[src].remove(op)
+
+        for op in removed:
+            for user in set(self.users.pop(op)):
+                if user in removed:
+                    continue
+                inputs = []
+                for src, c in user.inputs:
+                    if src is op:
+                        src, c = redirect[op](c)
+                        self.users[src].append(user)
+                    inputs.append((src, c))
+                user.inputs = inputs
+            del self.ops[op]
+
+    def single_producer(self, op):
+        '''The op producing all inputs of op, if it is a regular op that
+        feeds nothing else.'''
+        if not op.inputs:
+            return None
+        first = op.inputs[0][0]
+        if (not self.is_op(first)
+                or any(src is not first for src, c in op.inputs)
+                or len(self.users[first]) != len(op.inputs)):
+            return None
+        return first
+
+    def rewrite(self, op):
+        '''Apply the first rule that matches op, returns whether the graph
+        changed.'''
+        if _is_identity(op.module):
+            self.remove([op], {op: lambda c: op.inputs[c]})
+            return True
+
+        first = self.single_producer(op)
+        if first is None:
+            return False
+
+        fixed = (permute_layer, linear_transform)
+        if type(first.module) in fixed and type(op.module) in fixed:
+            fused = _Op('%s+%s' % (first.name, op.name),
+                        _fuse_fixed(first.module, op.module),
+                        list(first.inputs), 1)
+            self.add(fused)
+            self.remove([first, op], {op: lambda c: (fused, c)})
+            return True
+
+        if (_is_inverse(first.module, op.module)
+                and [c for src, c in op.inputs] == list(range(
+                    first.n_outputs))):
+            self.remove([first, op], {op: lambda c: first.inputs[c]})
+            return True
+
+        return False
+
+    def optimize(self):
+        changed = True
+        while changed:
+            changed = False
+            for op in list(self.ops):
+                if op in self.ops and self.is_op(op) and self.rewrite(op):
+                    changed = True
+
+    def to_nodes(self, output_order):
+        '''Build new nodes for the graph. The producers of the outputs and
+        then the OutputNodes are put last, both in the order of output_order,
+        so that a ReversibleGraphNet sorts the outputs the same way with
+        either output_order.'''
+        out_ops = sorted((op for op in self.ops
+                          if isinstance(op.node, OutputNode)),
+                         key=lambda op: output_order.index(op.node))
+        producers = []
+        for op in out_ops:
+            src = op.inputs[0][0]
+            if self.is_op(src) and src not in producers:
+                producers.append(src)
+
+        ordered = ([op for op in self.ops
+                    if isinstance(op.node, (InputNode, ConditionNode))]
+                   + [op for op in self.ops
+                      if self.is_op(op) and op not in producers]
+                   + producers + out_ops)
+
+        nodes = {}
+        for op in ordered:
+            if isinstance(op.node, InputNode):
+                nodes[op] = InputNode(*op.node.data.shape, name=op.name)
+            elif isinstance(op.node, ConditionNode):
+                nodes[op] = ConditionNode(*op.node.dims, name=op.name,
+                                          feature_net=op.module)
+            elif isinstance(op.node, OutputNode):
+                nodes[op] = OutputNode([], name=op.name)
+            else:
+                nodes[op] = Node([], _prebuilt(op.module), {}, name=op.name)
+
+        # The inputs are only connected now, as the ops are not sorted
+        # topologically
+        for op in ordered:
+            nodes[op].inputs = [(nodes[src], c) for src, c in op.inputs]
+            nodes[op].conditions = [nodes[src] for src in op.conditions]
+            if isinstance(op.node, OutputNode):
+                for c, (src, ch) in enumerate(nodes[op].inputs):
+                    src.outputs.append((nodes[op], c))
+        return [nodes[op] for op in ordered]
+
+
+def optimize_graph(net, verbose=False):
+    '''Returns an equivalent ReversibleGraphNet with the rewrites described
+    above applied, on copies of the modules of net. Meant for inference, the
+    fused linear_transforms have no trainable parameters anyway, but the
+    structure of the net changes.'''
+    net = copy.deepcopy(net)
+    by_slot = {}
+    for i in net.ind_out:
+        node = net.node_list[i]
+        src, c = node.inputs[0]
+        by_slot[net.variables_ids[(src.id, c)]] = node
+    output_order = [by_slot[i] for i in net.plan.output_slots]
+
+    graph = _Graph(net)
+    n_before = sum(1 for op in graph.ops if graph.is_op(op))
+    graph.optimize()
+    n_after = sum(1 for op in graph.ops if graph.is_op(op))
+    if verbose:
+        print('Optimized graph from %i to %i ops' % (n_before, n_after))
+
+    optimized = ReversibleGraphNet(graph.to_nodes(output_order),
+                                   verbose=False,
+                                   reversible_backprop=net.reversible_backprop,
+                                   reuse_buffers=net.reuse_buffers,
+                                   parallel_branches=net.parallel_branches,
+                                   output_order=getattr(net, 'output_order',
+                                                        'source'))
+    return optimized.train(net.training)
@@ -0,0 +1,258 @@
+'''Pipeline-parallel inference for ReversibleGraphNets on CPU. The op list of
+one direction is cut into contiguous stages, each stage runs in its own worker
+process, and micro-batches stream through the stages. The tensors between the
+stages are passed through torch.multiprocessing queues, i.e. in shared memory.
+
+A single pass through a deep net is sequential per block and intra-op
+threading saturates early for small widths, so for large sampling jobs this
+keeps many cores busy at once instead.'''
+
+import queue
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+
+def measure_op_costs(net, x, rev=False, repeats=3):
+    '''Wall time in seconds of every op of the compiled plan of net in the
+    given direction, for the input x (best of repeats).'''
+    plan = net.plan_rev if rev else net.plan
+    if not isinstance(x, (list, tuple)):
+        x = [x]
+
+    costs = [float('inf')] * len(plan.steps)
+    with torch.no_grad():
+        for r in range(repeats):
+            buf = [None] * plan.n_slots
+            for i, t in zip(plan.input_slots, x):
+                buf[i] = t
+            for k, (module, gather, outs) in enumerate(plan.steps):
+                t0 = time.perf_counter()
+                results = module(gather(buf), rev=plan.rev)
+                costs[k] = min(costs[k], time.perf_counter() - t0)
+                for j, i in enumerate(outs):
+                    buf[i] = results[j]
+    return costs
+
+
+def balance_stages(costs, n_stages):
+    '''Cut the list of op costs into at most n_stages contiguous stages, so
+    that the cost of the most expensive stage is minimal. Returns the stages
+    as (start, end) index ranges.'''
+    n_stages = max(1, min(n_stages, len(costs)))
+
+    def cut(limit):
+        stages, start, total = [], 0, 0.
+        for k, c in enumerate(costs):
+            if total + c > limit and k > start:
+                stages.append((start, k))
+                start, total = k, 0.
+            total += c
+        stages.append((start, len(costs)))
+        return stages
+
+    # Bisect the smallest stage cost limit that needs at most n_stages stages
+    low, high = max(costs), sum(costs)
+    for i in range(50):
+        mid = 0.5 * (low + high)
+        if len(cut(mid)) <= n_stages:
+            high = mid
+        else:
+            low = mid
+    return cut(high)
+
+
+class PipelineError(RuntimeError):
+    '''An op of a pipeline stage raised, with the formatted traceback of
+    the worker process as the message.'''
+
+
+def _stage_worker(stage, steps, live_out, rev, n_threads, in_queue,
+                  out_queue):
+    '''Main loop of one stage worker. Receives (index, slots) tuples, where
+    slots is a dict from slot index to tensor, until it gets None. If an op
+    raises, (index, PipelineError) is sent downstream instead of the slots,
+    later stages pass it on unchanged.'''
+    torch.set_num_threads(n_threads)
+    with torch.no_grad():
+        while True:
+            item = in_queue.get()
+            if item is None:
+                out_queue.put(None)
+                break
+
+            index, slots = item
+            if isinstance(slots, PipelineError):
+                out_queue.put(item)
+                continue
+            try:
+                for module, in_slots, out_slots in steps:
+                    results = module([slots[i] for i in in_slots], rev=rev)
+                    for j, i in enumerate(out_slots):
+                        slots[i] = results[j]
+                out = {i: slots[i] for i in live_out}
+            except Exception:
+                out = PipelineError("Stage %d failed:\n%s"
+                                    % (stage, traceback.format_exc()))
+            out_queue.put((index, out))
+
+
+class PipelineExecutor:
+    '''Runs one direction of a ReversibleGraphNet as a pipeline of n_stages
+    worker processes. The stages are balanced by the measured cost of every
+    op on example_input (one micro-batch worth of data, random if not given).
+    Inference only, i.e. no gradients, and not for nets with ConditionNodes.
+
+    If an op raises, the call raises a PipelineError with its traceback,
+    and if a worker process dies, a RuntimeError, instead of waiting for
+    results that never come. poll_interval is the time in seconds between
+    checks whether the workers are still alive while waiting.
+
+    Use as a context manager, or call close() to stop the workers:
+
+        with PipelineExecutor(net, 4, rev=True) as pipeline:
+            x = pipeline(z)
+    '''
+
+    def __init__(self, net, n_stages, rev=False, micro_batch_size=256,
+                 example_input=None, threads_per_stage=1,
+                 start_method='spawn', poll_interval=1.):
+        if net.cond_vars:
+            raise NotImplementedError("PipelineExecutor does not support "
+                                      "nets with ConditionNodes")
+        self.rev = rev
+        self.poll_interval = poll_interval
+        self.micro_batch_size = micro_batch_size
+        self.max_in_flight = 2 * n_stages
+        plan = net.plan_rev if rev else net.plan
+        self.plan = plan
+        self.input_slots = plan.input_slots
+        self.output_slots = plan.output_slots
+
+        if example_input is None:
+            if rev:
+                dims = [net.node_list[i].input_dims[0] for i in net.ind_out]
+            else:
+                dims = [net.node_list[i].data.shape for i in net.ind_in]
+            example_input = [torch.randn(micro_batch_size, *d) for d in dims]
+        self.costs = measure_op_costs(net, example_input, rev=rev)
+        self.stages = balance_stages(self.costs, n_stages)
+
+        # Slots that have to be passed on after each stage: everything that
+        # is read by a later stage or is an output of the whole net
+        last_use = {i: len(plan.steps) for i in plan.output_slots}
+        for k, ins in enumerate(plan.in_slots):
+            for i in ins:
+                last_use[i] = max(last_use.get(i, -1), k)
+        produced = list(plan.input_slots)
+
+        ctx = mp.get_context(start_method)
+        self.queues = [ctx.Queue() for s in range(len(self.stages) + 1)]
+        self.workers = []
+        for s, (start, end) in enumerate(self.stages):
+            steps = [(plan.modules[k], plan.in_slots[k], plan.out_slots[k])
+                     for k in range(start, end)]
+            for k in range(start, end):
+                produced.extend(plan.out_slots[k])
+            live_out = [i for i in produced if last_use.get(i, -1) >= end]
+            produced = live_out
+
+            worker = ctx.Process(target=_stage_worker,
+                                 args=(s, steps, live_out, rev,
+                                       threads_per_stage, self.queues[s],
+                                       self.queues[s+1]),
+                                 daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __call__(self, x):
+        '''Same as net(x, rev=rev), computed through the pipeline.'''
+        if not self.workers:
+            raise RuntimeError("The pipeline is closed")
+        if not isinstance(x, (list, tuple)):
+            x = [x]
+
+        # Tensors that are part of an autograd graph can't cross processes
+        x = [t.detach() for t in x]
+        batch_size = x[0].shape[0]
+        if batch_size == 0:
+            # Nothing to send through the pipeline, the outputs (empty, with
+            # the right shapes) are computed right here
+            with torch.no_grad():
+                buf = self.plan.execute(x)[0]
+            out = [buf[i] for i in self.output_slots]
+            return out[0] if len(out) == 1 else out
+
+        chunks = [[t[i:i+self.micro_batch_size] for t in x]
+                  for i in range(0, batch_size, self.micro_batch_size)]
+
+        results = [None] * len(chunks)
+        n_sent, n_received = 0, 0
+        while n_received < len(chunks):
+            # Keep a bounded number of micro-batches in the pipeline
+            while (n_sent < len(chunks)
+                   and n_sent - n_received < self.max_in_flight):
+                slots = dict(zip(self.input_slots, chunks[n_sent]))
+                self.queues[0].put((n_sent, slots))
+                n_sent += 1
+
+            index, slots = self._get()
+            n_received += 1
+            if isinstance(slots, PipelineError):
+                # Collect the micro-batches still in the pipeline, so that
+                # they don't end up in the results of the next call
+                for i in range(n_sent - n_received):
+                    self._get()
+                raise slots
+            results[index] = [slots[i] for i in self.output_slots]
+
+        out = [torch.cat([r[k] for r in results])
+               for k in range(len(self.output_slots))]
+        if len(out) == 1:
+            return out[0]
+        return out
+
+    def _get(self):
+        '''Next item from the last stage. Raises a RuntimeError if a worker
+        died, after stopping the others.'''
+        while True:
+            try:
+                return self.queues[-1].get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead = [s for s, w in enumerate(self.workers)
+                        if not w.is_alive()]
+                if dead:
+                    codes = [self.workers[s].exitcode for s in dead]
+                    self._terminate()
+                    raise RuntimeError("Pipeline stage(s) %s died (exit "
+                                       "code(s) %s)" % (dead, codes))
+
+    def _terminate(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        self.workers = []
+
+    def close(self):
+        '''Stop all worker processes.'''
+        if not self.workers:
+            return
+        self.queues[0].put(None)
+        try:
+            while self._get() is not None:
+                pass
+        except RuntimeError:
+            # A worker died, the others were stopped already
+            return
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
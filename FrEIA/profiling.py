@@ -0,0 +1,196 @@
+'''Per-node profiling of ReversibleGraphNets. While a Profiler is attached to
+a net (see ReversibleGraphNet.profile), every op is timed individually and
+recorded by node name and phase ('forward', 'reverse', with '_jac' appended
+when the log jacobian determinant is computed in the same pass, or
+'jacobian' / 'jacobian_rev' for jacobian(run_forward=False)).
+
+For every (node, phase) the call count, wall time, bytes of the output
+tensors and the change in allocated device memory are accumulated. The
+memory delta is only available for CUDA tensors, PyTorch has no allocator
+statistics for the CPU. The individual calls can be exported as a Chrome
+trace (chrome://tracing or https://ui.perfetto.dev).
+
+Without a profiler attached, the net runs the plain execution plan, so the
+only overhead is one attribute check per call.'''
+
+import json
+import threading
+import time
+
+import torch
+
+from FrEIA.framework import ExecutionPlan
+
+
+def _tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors
+               if torch.is_tensor(t))
+
+
+class NodeStats:
+    '''Accumulated measurements of one node in one phase.'''
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.
+        self.output_bytes = 0
+        self.memory_delta = None
+
+    def add(self, duration, output_bytes, memory_delta):
+        self.calls += 1
+        self.time += duration
+        self.output_bytes += output_bytes
+        if memory_delta is not None:
+            self.memory_delta = (self.memory_delta or 0) + memory_delta
+
+
+class Profiler:
+    '''Collects per-node measurements for one ReversibleGraphNet. With
+    trace=False, only the accumulated statistics are kept and no events for
+    the Chrome trace.'''
+
+    def __init__(self, net, trace=True):
+        self.node_names = [n.name for n in net.node_list]
+        self.trace = trace
+        self.stats = {}
+        self.events = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        '''Drop all measurements.'''
+        with self._lock:
+            self.stats = {}
+            self.events = []
+            self._start = time.perf_counter()
+
+    def _record(self, node_id, phase, start, duration, output_bytes,
+                memory_delta):
+        name = self.node_names[node_id]
+        with self._lock:
+            key = (name, phase)
+            if key not in self.stats:
+                self.stats[key] = NodeStats()
+            self.stats[key].add(duration, output_bytes, memory_delta)
+
+            if self.trace:
+                args = {'output_bytes': output_bytes}
+                if memory_delta is not None:
+                    args['memory_delta'] = memory_delta
+                self.events.append({
+                    'name': name, 'cat': phase, 'ph': 'X',
+                    'ts': (start - self._start) * 1e6, 'dur': duration * 1e6,
+                    'pid': 0, 'tid': threading.get_ident(), 'args': args})
+
+    def _timed(self, node_id, phase, device, returns_jac, fn, *args,
+               **kwargs):
+        '''Call fn and record it for the given node. CUDA is synchronized
+        around the call, so that the time is that of the actual kernels. If
+        returns_jac is set, fn returns (outputs, log_jac), and only the
+        outputs are counted in output_bytes.'''
+        cuda = device.type == 'cuda'
+        if cuda:
+            torch.cuda.synchronize(device)
+            memory = torch.cuda.memory_allocated(device)
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        if cuda:
+            torch.cuda.synchronize(device)
+        duration = time.perf_counter() - start
+
+        memory_delta = (torch.cuda.memory_allocated(device) - memory
+                        if cuda else None)
+        outputs = result[0] if returns_jac else result
+        if torch.is_tensor(outputs):
+            outputs = [outputs]
+        self._record(node_id, phase, start, duration,
+                     _tensor_bytes(outputs), memory_delta)
+        return result
+
+    def execute(self, plan, inputs, jac=False):
+        '''Same as plan.execute, with every op measured.'''
+        phase = 'reverse' if plan.rev else 'forward'
+        if jac:
+            phase += '_jac'
+        device = inputs[0].device
+        rev = plan.rev
+
+        buf = [None] * plan.n_slots
+        for i, x in zip(plan.input_slots, inputs):
+            buf[i] = x
+
+        log_jac = 0 if jac else None
+        for node_id, (module, gather, outs, emits_jac) in zip(
+                plan.node_ids, plan.jac_steps):
+            x = gather(buf)
+            if not jac:
+                results = self._timed(node_id, phase, device, False,
+                                      module, x, rev=rev)
+            elif emits_jac:
+                results, j = self._timed(node_id, phase, device, True,
+                                         module, x, rev=rev, jac=True)
+                log_jac = log_jac + j
+            else:
+                results, j = self._timed(node_id, phase, device, True,
+                                         self._forward_and_jacobian, module,
+                                         x, rev)
+                log_jac = log_jac + j
+            for k, i in enumerate(outs):
+                buf[i] = results[k]
+
+        if jac:
+            log_jac = ExecutionPlan.per_sample(log_jac, inputs[0])
+        return buf, log_jac
+
+    @staticmethod
+    def _forward_and_jacobian(module, x, rev):
+        return module(x, rev=rev), module.jacobian(x, rev=rev)
+
+    def jacobian(self, plan, buf):
+        '''Sum of module.jacobian over the ops of plan, on the intermediate
+        results in buf, with every op measured.'''
+        phase = 'jacobian_rev' if plan.rev else 'jacobian'
+        device = next(t for t in buf if t is not None).device
+
+        jacobian = 0
+        for node_id, (module, gather, outs) in zip(plan.node_ids,
+                                                    plan.steps):
+            jacobian = jacobian + self._timed(node_id, phase, device, False,
+                                              module.jacobian, gather(buf),
+                                              rev=plan.rev)
+        return jacobian
+
+    def chrome_trace(self):
+        '''All recorded calls in the Chrome trace event format.'''
+        with self._lock:
+            return {'traceEvents': list(self.events),
+                    'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        '''Write the Chrome trace to a JSON file.'''
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self, sort_by='time'):
+        '''Table of the accumulated statistics per node and phase, sorted by
+        'time', 'calls', 'output_bytes' or 'name'.'''
+        with self._lock:
+            rows = list(self.stats.items())
+        if sort_by == 'name':
+            rows.sort(key=lambda r: r[0])
+        else:
+            rows.sort(key=lambda r: getattr(r[1], sort_by), reverse=True)
+
+        total = sum(s.time for k, s in rows) or 1.
+        width = max([len(k[0]) for k, s in rows] + [4])
+        lines = ['%-*s  %-12s %8s %12s %10s %7s %12s %12s'
+                 % (width, 'node', 'phase', 'calls', 'total [ms]',
+                    'mean [us]', '%', 'out [MB]', 'mem [MB]')]
+        for (name, phase), s in rows:
+            memory = ('%12.3f' % (s.memory_delta / 2**20)
+                      if s.memory_delta is not None else '%12s' % '-')
+            lines.append('%-*s  %-12s %8d %12.3f %10.1f %7.1f %12.3f %s'
+                         % (width, name, phase, s.calls, s.time * 1e3,
+                            s.time / s.calls * 1e6, 100. * s.time / total,
+                            s.output_bytes / 2**20, memory))
+        return '\n'.join(lines)
@@ -0,0 +1,57 @@
+'''Throughput of affine_coupling_layer (two subnets with a split head per
+block) against rev_multiplicative_layer (four subnets), in RadynversionNet-like
+chains of coupling blocks and permutations. The block is checked against
+autograd in checks.py.
+
+Run with: python benchmarks/bench_affine_coupling.py'''
+
+import time
+
+import torch
+
+from FrEIA.modules import rev_multiplicative_layer, affine_coupling_layer
+
+from nets import coupling_args, chain_net
+
+
+def build_net(block, n_blocks, width):
+    # The hidden width of the rev_multiplicative_layer subnets, by default
+    # it would double along with the head of the affine_coupling_layer ones
+    return chain_net(width, n_blocks, block,
+                     coupling_args(2 * (width - width // 2)))
+
+
+def throughput(net, x, rev, train, repeats=5):
+    '''Samples per second of one direction, best of repeats'''
+    def step():
+        if train:
+            z, log_jac = net(x, rev=rev, jac=True)
+            (0.5 * z.pow(2).sum() - log_jac.sum()).backward()
+        else:
+            with torch.no_grad():
+                net(x, rev=rev)
+
+    step()
+    best = float('inf')
+    for r in range(repeats):
+        t = time.perf_counter()
+        step()
+        best = min(best, time.perf_counter() - t)
+    return x.shape[0] / best
+
+
+def main(n_blocks=8, width=128, batch_size=1024):
+    x = torch.randn(batch_size, width)
+    print('%-26s %12s %14s %14s %14s' % ('block', 'parameters',
+                                         'forward / s', 'reverse / s',
+                                         'training / s'))
+    for block in (rev_multiplicative_layer, affine_coupling_layer):
+        net = build_net(block, n_blocks, width)
+        n_params = sum(p.numel() for p in net.parameters())
+        print('%-26s %12d %14.0f %14.0f %14.0f' % (
+            block.__name__, n_params, throughput(net, x, False, False),
+            throughput(net, x, True, False), throughput(net, x, False, True)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''Tensor allocations and time of inference (without gradients) through a
+16-block net, with and without reuse_buffers. The allocations are counted by
+intercepting every ATen op: each returned tensor that is not a view of or
+written into one of the op's arguments is a new allocation.
+
+Run with: python benchmarks/bench_buffer_reuse.py'''
+
+import time
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from FrEIA.modules import rev_multiplicative_layer, glow_coupling_layer
+
+from nets import chain_net
+
+
+class CountAllocations(TorchDispatchMode):
+
+    def __init__(self):
+        super(CountAllocations, self).__init__()
+        self.count = 0
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        result = func(*args, **(kwargs or {}))
+        outputs = result if isinstance(result, (list, tuple)) else [result]
+        for r, t in zip(func._schema.returns, outputs):
+            if torch.is_tensor(t) and r.alias_info is None:
+                self.count += 1
+                self.bytes += t.numel() * t.element_size()
+        return result
+
+
+def build_net(block, n_blocks=16, width=256, reuse_buffers=False):
+    return chain_net(width, n_blocks, block,
+                     reuse_buffers=reuse_buffers).eval()
+
+
+def timed(fn, repeats=20):
+    fn()
+    best = float('inf')
+    for r in range(repeats):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main(batch_size=1024, width=256):
+    print('%-26s %-8s %-6s %8s %12s %10s'
+          % ('block', 'pass', 'reuse', 'allocs', 'alloc [MB]', 'time [ms]'))
+    x = torch.randn(batch_size, width)
+    for block in (rev_multiplicative_layer, glow_coupling_layer):
+        for rev in (False, True):
+            for reuse in (False, True):
+                net = build_net(block, width=width, reuse_buffers=reuse)
+                with torch.no_grad():
+                    # The first call allocates the buffers
+                    net(x, rev=rev)
+                    counter = CountAllocations()
+                    with counter:
+                        net(x, rev=rev)
+                    duration = timed(lambda: net(x, rev=rev))
+                print('%-26s %-8s %-6s %8d %12.2f %10.2f'
+                      % (block.__name__, 'reverse' if rev else 'forward',
+                         reuse, counter.count, counter.bytes / 2**20,
+                         duration * 1e3))
+
+
+if __name__ == '__main__':
+    main()
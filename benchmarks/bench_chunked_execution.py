@@ -0,0 +1,47 @@
+'''Peak memory and time of sampling (reverse pass without gradients) for
+growing batch sizes, in one go and in chunks of 4096 samples written into a
+preallocated output. Every run happens in a fresh process, and the peak
+resident memory of that process is reported.
+
+Run with: python benchmarks/bench_chunked_execution.py'''
+
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+
+from nets import chain_net
+
+
+def run(batch_size, chunk_size, width, result):
+    torch.set_num_threads(1)
+    net = chain_net(width, 8).eval()
+    z = torch.randn(batch_size, width)
+    out = torch.empty_like(z) if chunk_size else None
+
+    t = time.perf_counter()
+    with torch.no_grad():
+        net(z, rev=True, chunk_size=chunk_size, out=out)
+    result.put((time.perf_counter() - t,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def main(width=384, chunk_size=4096):
+    ctx = mp.get_context('spawn')
+    print('%8s %8s %10s %14s' % ('batch', 'chunk', 'time [s]',
+                                 'peak RSS [MB]'))
+    for batch_size in (8192, 32768, 131072):
+        for chunk in (None, chunk_size):
+            result = ctx.Queue()
+            p = ctx.Process(target=run,
+                            args=(batch_size, chunk, width, result))
+            p.start()
+            duration, peak = result.get()
+            p.join()
+            print('%8d %8s %10.2f %14.0f' % (batch_size, chunk or '-',
+                                             duration, peak))
+
+
+if __name__ == '__main__':
+    main()
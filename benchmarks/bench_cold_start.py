@@ -0,0 +1,74 @@
+'''Cold-start time of a trained net in a fresh process: building the graph
+from the node definitions (with the default verbose=True, printed to
+/dev/null) and loading the state_dict, against ReversibleGraphNet.load of
+the saved compiled graph.
+
+Run with: python benchmarks/bench_cold_start.py'''
+
+import contextlib
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+import torch
+
+from FrEIA.framework import ReversibleGraphNet
+
+from nets import chain_net
+
+
+def build_net(n_blocks, width=384):
+    return chain_net(width, n_blocks, seed=None, verbose=True)
+
+
+def rebuild(n_blocks, state_path):
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+        net = build_net(n_blocks)
+    net.load_state_dict(torch.load(state_path))
+    return net
+
+
+def run(method, n_blocks, state_path, net_path, result):
+    torch.set_num_threads(1)
+    t = time.perf_counter()
+    if method == 'rebuild':
+        net = rebuild(n_blocks, state_path)
+    else:
+        net = ReversibleGraphNet.load(net_path)
+    duration = time.perf_counter() - t
+
+    with torch.no_grad():
+        net(torch.zeros(1, 384))
+    result.put(duration)
+
+
+def main():
+    ctx = mp.get_context('spawn')
+    print('%8s %12s %10s %9s' % ('blocks', 'rebuild [s]', 'load [s]',
+                                 'speedup'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_blocks in (5, 20, 80):
+            with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+                net = build_net(n_blocks)
+            state_path = os.path.join(tmp, 'state.pt')
+            net_path = os.path.join(tmp, 'net.pt')
+            torch.save(net.state_dict(), state_path)
+            net.save(net_path)
+
+            times = {}
+            for method in ('rebuild', 'load'):
+                result = ctx.Queue()
+                p = ctx.Process(target=run, args=(method, n_blocks,
+                                                  state_path, net_path,
+                                                  result))
+                p.start()
+                times[method] = result.get()
+                p.join()
+            print('%8d %12.3f %10.3f %8.2fx' % (
+                n_blocks, times['rebuild'], times['load'],
+                times['rebuild'] / times['load']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''Time to draw 5,000 posterior samples for one observation, with a
+RadynversionNet-like INN that carries the 128-sample observation in a padded
+384-dim vector, against a conditional INN whose invertible part only spans
+the 3 parameters and gets the observation through a ConditionNode. The
+feature net of the ConditionNode runs once per call on the single
+observation, and its output is broadcast to all latent draws.
+
+Run with: python benchmarks/bench_conditional.py'''
+
+import time
+
+import torch
+import torch.nn as nn
+
+from FrEIA.framework import ConditionNode
+from FrEIA.modules import affine_coupling_layer
+
+from nets import coupling_args, chain_net
+
+ndim_x, ndim_y, ndim_z, ndim_tot = 3, 128, 3, 384
+
+
+def padded_net(n_blocks=8):
+    '''As RadynversionNet, everything in one padded vector'''
+    return chain_net(ndim_tot, n_blocks, affine_coupling_layer,
+                     coupling_args(ndim_tot)).eval()
+
+
+def conditional_net(n_blocks=8, n_features=64, internal_size=128):
+    torch.manual_seed(0)
+    feature_net = nn.Sequential(nn.Linear(ndim_y, 256), nn.ReLU(),
+                                nn.Linear(256, n_features))
+    cond = ConditionNode(ndim_y, name='observation', feature_net=feature_net)
+    return chain_net(ndim_x, n_blocks, affine_coupling_layer,
+                     coupling_args(internal_size), conditions=[cond],
+                     seed=None).eval()
+
+
+def best_of(fn, repeats=5):
+    fn()
+    best = float('inf')
+    for r in range(repeats):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main(n_samples=5000):
+    observation = torch.randn(1, ndim_y)
+
+    # The padded net gets the observation repeated for every draw, next to
+    # the latent draws, as in the sampling code of cINNamon.py
+    padded = padded_net()
+    z_padded = torch.zeros(n_samples, ndim_tot)
+    z_padded[:, :ndim_z] = torch.randn(n_samples, ndim_z)
+    z_padded[:, -ndim_y:] = observation
+
+    conditional = conditional_net()
+    z = torch.randn(n_samples, ndim_x)
+
+    # The feature net has to run once per call, on the one observation
+    feature_calls = []
+    feature_net = conditional.node_list[conditional.ind_cond[0]].module
+    feature_net.register_forward_hook(
+        lambda m, inp, out: feature_calls.append(inp[0].shape[0]))
+    with torch.no_grad():
+        conditional(z, rev=True, c=observation)
+    assert feature_calls == [1], feature_calls
+
+    with torch.no_grad():
+        t_padded = best_of(lambda: padded(z_padded, rev=True))
+        t_conditional = best_of(lambda: conditional(z, rev=True,
+                                                    c=observation))
+
+    print('%-14s %12s %12s %16s' % ('net', 'parameters', 'time [ms]',
+                                    'us per sample'))
+    for name, net, t in (('padded', padded, t_padded),
+                         ('conditional', conditional, t_conditional)):
+        n_params = sum(p.numel() for p in net.parameters())
+        print('%-14s %12d %12.2f %16.2f' % (name, n_params, t * 1e3,
+                                            t / n_samples * 1e6))
+    print('speedup %.1fx' % (t_padded / t_conditional))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''Parameters and throughput of a coupling block on time series of ndata
+samples, with the dense subnets of RadynversionNet against weight-shared
+1-D convolutions. The dense block is an affine_coupling_layer on the flat
+vector, with the F_fully_connected_leaky subnets of gw_version/Inn2.py
+(rebuilt here, as that module needs scipy and h5py) and the hidden width
+RadynversionNet uses. The convolutional block unflattens the vector into one
+channel, Haar-transforms it twice into 4 channels of ndata/4 samples, runs
+the affine_coupling_layer with F_conv1d subnets, and restores and flattens
+the result. Both are timed for a training step (forward with jacobian and
+backward) and for inference.
+
+Run with: python benchmarks/bench_conv1d.py'''
+
+import time
+
+import torch
+import torch.nn as nn
+
+from FrEIA.framework import InputNode, OutputNode, Node, ReversibleGraphNet
+from FrEIA.modules import (affine_coupling_layer, F_conv1d,
+                           unflattening_layer, flattening_layer,
+                           haar_multiplex_layer_1d, haar_restore_layer_1d)
+
+from nets import coupling_args, chain_net
+
+
+class dense_leaky(nn.Module):
+    '''The layers of F_fully_connected_leaky in gw_version/Inn2.py'''
+
+    def __init__(self, size_in, size, internal_size=None, leaky_slope=0.01):
+        super().__init__()
+        if not internal_size:
+            internal_size = 2*size
+        self.layers = nn.Sequential(
+            nn.Linear(size_in, internal_size), nn.LeakyReLU(leaky_slope),
+            nn.Linear(internal_size, internal_size), nn.LeakyReLU(leaky_slope),
+            nn.Linear(internal_size, internal_size), nn.LeakyReLU(leaky_slope),
+            nn.Linear(internal_size, internal_size), nn.LeakyReLU(leaky_slope),
+            nn.Linear(internal_size, size))
+
+    def forward(self, x):
+        return self.layers(x)
+
+
+def dense_net(ndata):
+    internal_size = 2 * (ndata - ndata // 2)
+    return chain_net(ndata, 1, affine_coupling_layer,
+                     coupling_args(internal_size, F_class=dense_leaky),
+                     final_permute=False)
+
+
+def conv_net(ndata, channels_hidden=32):
+    torch.manual_seed(0)
+    nodes = [InputNode(ndata, name='input')]
+    nodes.append(Node([nodes[-1].out0], unflattening_layer,
+                      {'shape': (1, ndata)}, name='unflatten'))
+    nodes.append(Node([nodes[-1].out0], haar_multiplex_layer_1d, {},
+                      name='haar_1'))
+    nodes.append(Node([nodes[-1].out0], haar_multiplex_layer_1d, {},
+                      name='haar_2'))
+    nodes.append(Node([nodes[-1].out0], affine_coupling_layer,
+                      {'F_class': F_conv1d, 'clamp': 2.0,
+                       'F_args': {'channels_hidden': channels_hidden}},
+                      name='coupling'))
+    nodes.append(Node([nodes[-1].out0], haar_restore_layer_1d, {},
+                      name='restore_2'))
+    nodes.append(Node([nodes[-1].out0], haar_restore_layer_1d, {},
+                      name='restore_1'))
+    nodes.append(Node([nodes[-1].out0], flattening_layer, {},
+                      name='flatten'))
+    nodes.append(OutputNode([nodes[-1].out0], name='output'))
+    return ReversibleGraphNet(nodes, verbose=False)
+
+
+def throughput(net, x, train, repeats=5):
+    '''Samples per second, best of repeats'''
+    def step():
+        if train:
+            z, log_jac = net(x, jac=True)
+            (0.5 * z.pow(2).sum() - log_jac.sum()).backward()
+        else:
+            with torch.no_grad():
+                net(x)
+
+    step()
+    best = float('inf')
+    for r in range(repeats):
+        t = time.perf_counter()
+        step()
+        best = min(best, time.perf_counter() - t)
+    return x.shape[0] / best
+
+
+def main(batch_size=64):
+    print('%6s %-6s %12s %14s %14s' % ('ndata', 'subnet', 'parameters',
+                                       'training / s', 'inference / s'))
+    for ndata in (128, 1024, 4096):
+        x = torch.randn(batch_size, ndata)
+        for name, build in (('dense', dense_net), ('conv1d', conv_net)):
+            net = build(ndata)
+            n_params = sum(p.numel() for p in net.parameters())
+            print('%6d %-6s %12d %14.0f %14.0f' % (
+                ndata, name, n_params, throughput(net, x, True),
+                throughput(net, x, False)))
+            del net
+
+
+if __name__ == '__main__':
+    main()
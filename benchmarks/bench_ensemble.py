@@ -0,0 +1,59 @@
+'''Training and posterior sampling throughput of K nets run one after another
+against the same nets stacked into one vectorized Ensemble.
+
+Run with: python benchmarks/bench_ensemble.py'''
+
+import time
+
+import torch
+
+from FrEIA.ensemble import Ensemble
+
+from nets import chain_net
+
+
+def best_time(f, repeats=3):
+    f()
+    times = []
+    for i in range(repeats):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def nll(z, log_jac):
+    return torch.mean(0.5 * torch.sum(z**2, -1) - log_jac)
+
+
+def main(width=384, batch_size=64):
+    print('%4s %16s %16s %18s %18s' % ('K', 'seq. train [s]', 'ens. train [s]',
+                                       'seq. sample [s]', 'ens. sample [s]'))
+    for n_members in (2, 8):
+        nets = [chain_net(width, 5, seed=k) for k in range(n_members)]
+        ensemble = Ensemble(nets)
+        x = torch.randn(n_members, batch_size, width)
+        z = torch.randn(batch_size, width)
+
+        def train_sequential():
+            for k, net in enumerate(nets):
+                nll(*net(x[k], jac=True)).backward()
+
+        def train_ensemble():
+            nll(*ensemble(x, jac=True)).backward()
+
+        def sample_sequential():
+            with torch.no_grad():
+                torch.cat([net(z, rev=True) for net in nets])
+
+        def sample_ensemble():
+            with torch.no_grad():
+                ensemble(z, rev=True, shared=True, pool=True)
+
+        print('%4d %16.3f %16.3f %18.3f %18.3f' % (
+            n_members, best_time(train_sequential), best_time(train_ensemble),
+            best_time(sample_sequential), best_time(sample_ensemble)))
+
+
+if __name__ == '__main__':
+    main()
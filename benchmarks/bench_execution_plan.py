@@ -0,0 +1,84 @@
+'''Per-call overhead of the compiled ExecutionPlan against the previous
+interpreted execution of indexed_ops, for chains of 8, 64 and 256 nodes.
+
+Run with: python benchmarks/bench_execution_plan.py'''
+
+import timeit
+
+import torch
+import torch.nn as nn
+
+from FrEIA.framework import InputNode, OutputNode, Node, ReversibleGraphNet
+
+
+class identity_layer(nn.Module):
+    '''Does no work at all, so that only the graph execution is timed.'''
+
+    def __init__(self, dims_in):
+        super(identity_layer, self).__init__()
+
+    def forward(self, x, rev=False):
+        return x
+
+    def jacobian(self, x, rev=False):
+        return 0
+
+    def output_dims(self, input_dims):
+        return input_dims
+
+
+def build_chain(n_nodes, width=8):
+    nodes = [InputNode(width, name='input')]
+    for i in range(n_nodes):
+        nodes.append(Node([nodes[-1].out0], identity_layer, {},
+                          name='identity_%d' % i))
+    nodes.append(OutputNode([nodes[-1].out0], name='output'))
+    return ReversibleGraphNet(nodes, verbose=False)
+
+
+def legacy_forward(net, x, rev=False):
+    '''The per-op list building execution used before the compiled plans.'''
+    if rev:
+        use_list = net.indexed_ops_rev
+        input_vars, output_vars = net.return_vars, net.input_vars
+    else:
+        use_list = net.indexed_ops
+        input_vars, output_vars = net.input_vars, net.return_vars
+
+    variable_list = [None] * len(net.variables_ind)
+    variable_list[input_vars[0]] = x
+    for o in use_list:
+        try:
+            results = net.module_list[o[0]]([variable_list[i]
+                                             for i in o[1]], rev=rev)
+        except TypeError:
+            raise RuntimeError("Are you sure all used Nodes are in the "
+                               "Node list?")
+        for i, r in zip(o[2], results):
+            variable_list[i] = r
+    return variable_list[output_vars[0]]
+
+
+def main(batch_size=1, repeats=1000):
+    torch.set_num_threads(1)
+    print('%8s %6s %14s %14s %9s' % ('nodes', 'dir', 'legacy [us]',
+                                     'plan [us]', 'speedup'))
+    for n_nodes in (8, 64, 256):
+        net = build_chain(n_nodes)
+        x = torch.randn(batch_size, 8)
+        with torch.no_grad():
+            for rev in (False, True):
+                assert legacy_forward(net, x, rev=rev) is net(x, rev=rev)
+                t_old = min(timeit.repeat(
+                    lambda: legacy_forward(net, x, rev=rev),
+                    number=repeats, repeat=5)) / repeats
+                t_new = min(timeit.repeat(
+                    lambda: net(x, rev=rev),
+                    number=repeats, repeat=5)) / repeats
+                print('%8d %6s %14.1f %14.1f %8.2fx' % (
+                    n_nodes, 'rev' if rev else 'fwd', 1e6 * t_old,
+                    1e6 * t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
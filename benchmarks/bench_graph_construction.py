@@ -0,0 +1,36 @@
+'''Construction time of ReversibleGraphNet for deep chains of nodes. Graph
+compilation is linear in the number of nodes and edges, so the time per node
+should stay flat as the depth grows.
+
+Run with: python benchmarks/bench_graph_construction.py'''
+
+import time
+
+from FrEIA.framework import InputNode, OutputNode, Node, ReversibleGraphNet
+from FrEIA.modules import permute_layer
+
+
+def build_chain(n_nodes, width=8):
+    nodes = [InputNode(width, name='input')]
+    for i in range(n_nodes):
+        nodes.append(Node([nodes[-1].out0], permute_layer, {'seed': i},
+                          name='permute_%d' % i))
+    nodes.append(OutputNode([nodes[-1].out0], name='output'))
+    return nodes
+
+
+def main():
+    print('%8s %12s %12s %16s' % ('nodes', 'nodes [s]', 'net [s]',
+                                  'per node [us]'))
+    for n_nodes in (500, 1000, 2000, 5000, 10000):
+        t0 = time.perf_counter()
+        nodes = build_chain(n_nodes)
+        t1 = time.perf_counter()
+        ReversibleGraphNet(nodes, verbose=False)
+        t2 = time.perf_counter()
+        print('%8d %12.3f %12.3f %16.1f' % (n_nodes, t1 - t0, t2 - t1,
+                                            1e6 * (t2 - t0) / n_nodes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+'''Time of the log jacobian determinant from the intermediate results of the
+last forward pass (jacobian(run_forward=False)), which reduces the log scales
+the coupling layers kept from that pass (set_log_scale_cache), compared to
+the forward pass itself, in the training setting (autograd enabled). The
+cache is emptied by jacobian, so every jacobian follows a forward pass.
+
+Run with: python benchmarks/bench_jacobian_cache.py'''
+
+import time
+
+import torch
+
+from FrEIA.modules import (rev_multiplicative_layer, glow_coupling_layer,
+                           affine_coupling_layer)
+
+from nets import chain_net
+
+
+def best_of(fn, before=None, repeats=10):
+    best = float('inf')
+    for r in range(repeats):
+        if before is not None:
+            before()
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main(batch_size=1024, width=128):
+    x = torch.randn(batch_size, width)
+    print('%-26s %14s %14s' % ('block', 'forward [ms]', 'jacobian [ms]'))
+    for block in (rev_multiplicative_layer, glow_coupling_layer,
+                  affine_coupling_layer):
+        net = chain_net(width, 8, block).set_log_scale_cache()
+        forward = best_of(lambda: net(x))
+        jacobian = best_of(lambda: net.jacobian(run_forward=False),
+                           before=lambda: net(x))
+        print('%-26s %14.2f %14.2f' % (block.__name__, forward * 1e3,
+                                       jacobian * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''Cost of a learnable invertible linear layer per training step and per
+inference call: lu_linear_layer (log jacobian from the diagonal of U,
+inverse by triangular solves, W and its inverse cached in eval mode)
+against a dense learnable matrix that needs slogdet and inverse of W
+(O(d^3)) in every step, and the fixed permute_layer it replaces.
+
+Run with: python benchmarks/bench_lu_linear.py'''
+
+import time
+
+import torch
+import torch.nn as nn
+
+from FrEIA.modules import lu_linear_layer, permute_layer
+
+
+class dense_linear(nn.Module):
+    '''Learnable y = Wx with dense W, as linear_transform with a trainable M'''
+
+    def __init__(self, dims_in):
+        super().__init__()
+        d = dims_in[0][0]
+        self.W = nn.Parameter(torch.linalg.qr(torch.randn(d, d))[0])
+
+    def forward(self, x, rev=False, jac=False):
+        W = torch.inverse(self.W) if rev else self.W
+        out = [x[0].mm(W.t())]
+        if jac:
+            log_det = torch.slogdet(self.W)[1].expand(x[0].shape[0])
+            return out, -log_det if rev else log_det
+        return out
+
+
+def best_of(fn, repeats=20):
+    fn()
+    best = float('inf')
+    for r in range(repeats):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main(batch_size=256):
+    print('%6s %-16s %12s %14s %14s' % ('width', 'layer', 'train [ms]',
+                                        'forward [ms]', 'reverse [ms]'))
+    for width in (128, 384, 1024):
+        x = torch.randn(batch_size, width)
+        for name, module in (('permute_layer',
+                              permute_layer([(width,)], seed=0)),
+                             ('dense_linear', dense_linear([(width,)])),
+                             ('lu_linear_layer',
+                              lu_linear_layer([(width,)], seed=0))):
+            has_params = any(True for p in module.parameters())
+
+            def train_step():
+                module.train()
+                y, log_jac = module([x], jac=True)
+                loss = (0.5 * y[0].pow(2).sum(1) - log_jac).mean()
+                if has_params:
+                    loss.backward()
+
+            def inference(rev):
+                module.eval()
+                with torch.no_grad():
+                    module([x], rev=rev)
+
+            print('%6d %-16s %12.3f %14.3f %14.3f' % (
+                width, name, best_of(train_step) * 1e3,
+                best_of(lambda: inference(False)) * 1e3,
+                best_of(lambda: inference(True)) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
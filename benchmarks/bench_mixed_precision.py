@@ -0,0 +1,61 @@
+'''Training and sampling throughput of a chain of coupling blocks with the
+subnets in float32 and in bfloat16 (set_precision), together with the
+invertibility error of both directions and the deviation of the log
+jacobian determinant from a float64 reference.
+
+Run with: python benchmarks/bench_mixed_precision.py'''
+
+import copy
+import time
+
+import torch
+
+from nets import chain_net
+
+
+def throughput(f, batch_size, repeats=5):
+    f()
+    t = time.perf_counter()
+    for i in range(repeats):
+        f()
+    return repeats * batch_size / (time.perf_counter() - t)
+
+
+def main(width=384, batch_size=512):
+    reference = chain_net(width, 8).double()
+    x = torch.randn(batch_size, width)
+    z = torch.randn(batch_size, width)
+    with torch.no_grad():
+        log_jac_ref = reference(x.double(), jac=True)[1]
+
+    print('%-10s %12s %12s %14s %14s %14s' % (
+        'subnets', 'train [1/s]', 'sample [1/s]', 'x->z->x err',
+        'z->x->z err', 'log_jac err'))
+    for dtype in (None, torch.bfloat16):
+        net = copy.deepcopy(reference).float()
+        net.set_precision(subnet_dtype=dtype, log_jac_dtype=torch.float64)
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-4)
+
+        def train_step():
+            out, log_jac = net(x, jac=True)
+            loss = torch.mean(0.5 * torch.sum(out**2, 1) - log_jac)
+            optimizer.zero_grad()
+            loss.backward()
+
+        def sample():
+            with torch.no_grad():
+                net(z, rev=True)
+
+        with torch.no_grad():
+            log_jac = net(x, jac=True)[1]
+        print('%-10s %12.0f %12.0f %14.2e %14.2e %14.2e' % (
+            'float32' if dtype is None else 'bfloat16',
+            throughput(train_step, batch_size),
+            throughput(sample, batch_size),
+            net.invertibility_error(x)['max_rel'],
+            net.invertibility_error(z, rev=True)['max_rel'],
+            (log_jac - log_jac_ref).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''Cost of a RadynversionNet-like chain of 8 affine_coupling_layer blocks on
+384 dimensions, built by multiscale_nodes with 1 (the plain chain) to 4
+scales, where half of the dimensions are factored out after every scale but
+the last. The subnets have the hidden width RadynversionNet uses, i.e. that
+of their scale. Reported are the multiply-accumulates of the subnets per
+sample, and the time of a training step and of sampling.
+
+Run with: python benchmarks/bench_multiscale.py'''
+
+import time
+
+import torch
+import torch.nn as nn
+
+from FrEIA.framework import ReversibleGraphNet
+from FrEIA.modules import affine_coupling_layer
+from FrEIA.multiscale import multiscale_nodes
+
+from nets import coupling_args
+
+
+def build_net(n_scales, n_dims=384, n_blocks=8):
+    torch.manual_seed(0)
+
+    def scale_args(width):
+        return coupling_args(2 * (width - width // 2))
+
+    nodes = multiscale_nodes(n_dims, affine_coupling_layer, scale_args,
+                             n_blocks, n_scales=n_scales, merge_outputs=True)
+    return ReversibleGraphNet(nodes, verbose=False)
+
+
+def best_of(fn, repeats=5):
+    fn()
+    best = float('inf')
+    for r in range(repeats):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main(batch_size=512, n_samples=5000):
+    x = torch.randn(batch_size, 384)
+    z = torch.randn(n_samples, 384)
+    print('%7s %14s %12s %15s %14s' % ('scales', 'MMACs/sample',
+                                       'train [ms]', 'sampling [ms]',
+                                       'inversion err'))
+    for n_scales in (1, 2, 3, 4):
+        net = build_net(n_scales)
+        macs = sum(m.weight.numel() for m in net.modules()
+                   if isinstance(m, nn.Linear))
+
+        def train_step():
+            out, log_jac = net(x, jac=True)
+            loss = torch.mean(0.5 * torch.sum(out**2, dim=1) - log_jac)
+            loss.backward()
+
+        def sample():
+            with torch.no_grad():
+                return net(z, rev=True)
+
+        with torch.no_grad():
+            err = (net(sample()) - z).abs().max().item()
+        print('%7d %14.2f %12.1f %15.1f %14.1e' % (
+            n_scales, macs / 1e6, best_of(train_step) * 1e3,
+            best_of(sample) * 1e3, err))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''Parity and latency of the ONNX exports (run with ONNX Runtime) against
+eager PyTorch, for a RadynversionNet-like chain of rev_multiplicative_layers
+and permutations. The largest deviation is only reported here, checks.py
+asserts the parity for this and a chain of spline_coupling_layers. Needs the
+onnx and onnxruntime packages.
+
+Run with: python benchmarks/bench_onnx_export.py'''
+
+import os
+import tempfile
+import timeit
+import warnings
+
+import numpy as np
+import onnxruntime
+import torch
+
+from FrEIA.onnx_export import export_all
+
+from nets import chain_net
+
+
+CASES = (('forward', False, False), ('reverse', True, False),
+         ('forward_jac', False, True))
+
+
+def sessions_of(net):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = export_all(net, os.path.join(tmp, 'net'))
+        return {key: onnxruntime.InferenceSession(
+                    path, providers=['CPUExecutionProvider'])
+                for key, path in paths.items()}
+
+
+def max_error(net, sessions, x, key, rev, jac):
+    expected = net(x, rev=rev, jac=jac)
+    expected = list(expected) if jac else [expected]
+    got = sessions[key].run(None, {'input_0': x.numpy()})
+    return max(np.abs(e.numpy() - g).max() for e, g in zip(expected, got))
+
+
+def main(width=384, repeats=5):
+    warnings.simplefilter('ignore')
+    net = chain_net(width, 8, final_permute=False).eval()
+    sessions = sessions_of(net)
+
+    print('%12s %6s %12s %12s %12s %9s' % ('graph', 'batch', 'max error',
+                                           'torch [ms]', 'onnx [ms]',
+                                           'speedup'))
+    with torch.no_grad():
+        for batch_size in (1, 100, 5000):
+            x = torch.randn(batch_size, width)
+            for key, rev, jac in CASES:
+                feed = {'input_0': x.numpy()}
+                error = max_error(net, sessions, x, key, rev, jac)
+
+                t_torch = min(timeit.repeat(lambda: net(x, rev=rev, jac=jac),
+                                            number=repeats,
+                                            repeat=3)) / repeats
+                t_onnx = min(timeit.repeat(
+                    lambda: sessions[key].run(None, feed),
+                    number=repeats, repeat=3)) / repeats
+                print('%12s %6d %12.2e %12.2f %12.2f %8.2fx' % (
+                    key, batch_size, error, 1e3 * t_torch, 1e3 * t_onnx,
+                    t_torch / t_onnx))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''Latency of a net before and after optimize_graph, in both directions. The
+net is a chain of blocks as produced by stacking sub-graphs that each start
+and end with a permutation, with a fixed whitening linear_transform at the
+input and its inverse at the output (see nets.whitened_net). That the
+optimized net gives the same results is checked in checks.py.
+
+Run with: python benchmarks/bench_optimize.py'''
+
+import timeit
+
+import torch
+
+from nets import whitened_net
+
+
+def time_call(f, repeats=20):
+    return min(timeit.repeat(f, number=repeats, repeat=5)) / repeats
+
+
+def main(width=384):
+    torch.set_num_threads(1)
+    net = whitened_net(width, 8).eval()
+    optimized = net.optimized()
+    print('ops: %d -> %d' % (len(net.plan.steps), len(optimized.plan.steps)))
+
+    print('%6s %6s %14s %18s %9s' % ('batch', 'dir', 'original [us]',
+                                     'optimized [us]', 'speedup'))
+    with torch.no_grad():
+        for batch_size in (1, 64, 1024):
+            x = torch.randn(batch_size, width)
+            for rev in (False, True):
+                t_orig = time_call(lambda: net(x, rev=rev))
+                t_opt = time_call(lambda: optimized(x, rev=rev))
+                print('%6d %6s %14.1f %18.1f %8.2fx' % (
+                    batch_size, 'rev' if rev else 'fwd', 1e6 * t_orig,
+                    1e6 * t_opt, t_orig / t_opt))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''Throughput of a net with independent branches (a split_layer into n
+branches of coupling blocks, joined by a cat_layer), run serially and with
+parallel_branches=True, for a growing number of branches. Intra-op threading
+is limited to one thread, so any gain comes from running the branches at the
+same time. Needs at least as many cores as branches to show it.
+
+Run with: python benchmarks/bench_parallel_branches.py'''
+
+import os
+import time
+
+import torch
+
+from FrEIA.framework import InputNode, OutputNode, Node, ReversibleGraphNet
+from FrEIA.modules import (glow_coupling_layer, permute_layer, split_layer,
+                           cat_layer, F_fully_connected)
+
+
+def build_net(n_branches, depth, width, parallel_branches):
+    torch.manual_seed(0)
+    nodes = [InputNode(n_branches * width, name='input')]
+    split = Node([nodes[0].out0], split_layer,
+                 {'split_size_or_sections': [width] * n_branches, 'dim': 0},
+                 name='split')
+    nodes.append(split)
+
+    ends = []
+    for b in range(n_branches):
+        prev = (split, b)
+        for i in range(depth):
+            nodes.append(Node([prev], glow_coupling_layer,
+                              {'F_class': F_fully_connected, 'clamp': 2.0},
+                              name='coupling_%d_%d' % (b, i)))
+            nodes.append(Node([nodes[-1].out0], permute_layer,
+                              {'seed': i}, name='permute_%d_%d' % (b, i)))
+            prev = nodes[-1].out0
+        ends.append(prev)
+
+    nodes.append(Node(ends, cat_layer, {'dim': 0}, name='cat'))
+    nodes.append(OutputNode([nodes[-1].out0], name='output'))
+    return ReversibleGraphNet(nodes, verbose=False,
+                              parallel_branches=parallel_branches).eval()
+
+
+def timed(fn, repeats=10):
+    fn()
+    best = float('inf')
+    for r in range(repeats):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main(depth=4, width=256, batch_size=2048):
+    torch.set_num_threads(1)
+    print('%d cores' % os.cpu_count())
+    print('%10s %12s %13s %10s' % ('branches', 'serial [ms]',
+                                   'parallel [ms]', 'speedup'))
+    for n_branches in (2, 4, 8):
+        x = torch.randn(batch_size, n_branches * width)
+        times = []
+        for parallel in (False, True):
+            net = build_net(n_branches, depth, width, parallel)
+            with torch.no_grad():
+                times.append(timed(lambda: net(x)))
+        print('%10d %12.2f %13.2f %10.2f' % (n_branches, times[0] * 1e3,
+                                             times[1] * 1e3,
+                                             times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''Throughput of pipeline-parallel reverse passes (posterior sampling) over
+worker processes against single-process execution. The gain depends on the
+number of free cores, each stage uses one thread.
+
+Run with: python benchmarks/bench_pipeline.py'''
+
+import time
+
+import torch
+
+from FrEIA.pipeline import PipelineExecutor
+
+from nets import chain_net
+
+
+def main(n_samples=20000, width=128, micro_batch_size=500):
+    net = chain_net(width, 16).eval()
+    z = torch.randn(n_samples, width)
+
+    torch.set_num_threads(1)
+    with torch.no_grad():
+        t0 = time.perf_counter()
+        expected = net(z, rev=True)
+        t_single = time.perf_counter() - t0
+    print('%8s %14s %14s' % ('stages', 'samples / s', 'max error'))
+    print('%8s %14.0f %14s' % ('single', n_samples / t_single, '-'))
+
+    for n_stages in (2, 4, 8):
+        with PipelineExecutor(net, n_stages, rev=True,
+                              micro_batch_size=micro_batch_size) as pipeline:
+            pipeline(z[:micro_batch_size])
+            t0 = time.perf_counter()
+            x = pipeline(z)
+            t_pipeline = time.perf_counter() - t0
+        print('%8d %14.0f %14.2e' % (n_stages, n_samples / t_pipeline,
+                                     (x - expected).abs().max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''Per-call time of a chain of coupling blocks and permutations without a
+profiler, with a profiler that only accumulates statistics and with one that
+also records a Chrome trace, followed by the summary table.
+
+Run with: python benchmarks/bench_profiling.py'''
+
+import timeit
+
+import torch
+
+from nets import chain_net
+
+
+def time_call(f, repeats=50):
+    return min(timeit.repeat(f, number=repeats, repeat=5)) / repeats
+
+
+def main(width=64, batch_size=16):
+    torch.set_num_threads(1)
+    net = chain_net(width, 8).eval()
+    x = torch.randn(batch_size, width)
+
+    with torch.no_grad():
+        print('%-14s %12s' % ('profiling', 'call [us]'))
+        print('%-14s %12.1f' % ('off', 1e6 * time_call(lambda: net(x))))
+        with net.profile(trace=False):
+            print('%-14s %12.1f' % ('stats', 1e6 * time_call(lambda: net(x))))
+        with net.profile() as prof:
+            print('%-14s %12.1f' % ('stats+trace',
+                                    1e6 * time_call(lambda: net(x))))
+            z = net(x)
+            net(z, rev=True)
+            net.jacobian(run_forward=False, rev=True)
+
+    print()
+    print(prof.summary())
+
+
+if __name__ == '__main__':
+    main()
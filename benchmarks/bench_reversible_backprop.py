@@ -0,0 +1,57 @@
+'''Activation memory and training throughput of the reversible backprop mode
+against the default mode, for chains of coupling blocks and permutations of
+increasing depth. Activation memory is measured as the total size of all
+tensors autograd keeps for the backward pass.
+
+Run with: python benchmarks/bench_reversible_backprop.py'''
+
+import time
+
+import torch
+
+from FrEIA.modules import rev_multiplicative_layer, glow_coupling_layer
+
+from nets import chain_net
+
+
+def build_net(n_blocks, width, reversible_backprop):
+    return chain_net(width, n_blocks,
+                     (glow_coupling_layer, rev_multiplicative_layer),
+                     reversible_backprop=reversible_backprop)
+
+
+def training_step(net, x):
+    '''Maximum likelihood loss, returns bytes kept for backward and time'''
+    saved = [0]
+
+    def pack(t):
+        saved[0] += t.numel() * t.element_size()
+        return t
+
+    t0 = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        z, log_jac = net(x, jac=True)
+        loss = torch.mean(0.5 * torch.sum(z**2, dim=1) - log_jac)
+    loss.backward()
+    return saved[0], time.perf_counter() - t0
+
+
+def main(width=64, batch_size=800, repeats=3):
+    print('%8s %10s %18s %18s' % ('blocks', 'mode', 'activations [MB]',
+                                  'samples / s'))
+    for n_blocks in (4, 8, 16, 32):
+        x = torch.randn(batch_size, width)
+        for reversible in (False, True):
+            torch.manual_seed(0)
+            net = build_net(n_blocks, width, reversible)
+            training_step(net, x)
+            results = [training_step(net, x) for i in range(repeats)]
+            memory = results[0][0]
+            duration = min(r[1] for r in results)
+            print('%8d %10s %18.2f %18.0f' % (
+                n_blocks, 'reversible' if reversible else 'default',
+                memory / 2**20, batch_size / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+'''Latency of the eager ReversibleGraphNet against the scripted and frozen
+exports of both directions, for a chain of coupling blocks and permutations.
+Their parity with eager execution is checked in checks.py.
+
+Run with: python benchmarks/bench_scripted_export.py'''
+
+import timeit
+import warnings
+
+import torch
+
+from nets import chain_net
+
+
+def main(width=64, repeats=50):
+    warnings.simplefilter('ignore')
+    torch.set_num_threads(1)
+    net = chain_net(width, 8).eval()
+    scripted = {
+        False: torch.jit.freeze(torch.jit.script(net.export_forward())),
+        True: torch.jit.freeze(torch.jit.script(net.export_reverse())),
+    }
+
+    print('%6s %6s %14s %16s %9s' % ('batch', 'dir', 'eager [us]',
+                                     'scripted [us]', 'speedup'))
+    with torch.no_grad():
+        for batch_size in (1, 16, 256):
+            x = torch.randn(batch_size, width)
+            for rev in (False, True):
+                t_eager = min(timeit.repeat(lambda: net(x, rev=rev),
+                                            number=repeats,
+                                            repeat=5)) / repeats
+                t_script = min(timeit.repeat(lambda: scripted[rev](x),
+                                             number=repeats,
+                                             repeat=5)) / repeats
+                print('%6d %6s %14.1f %16.1f %8.2fx' % (
+                    batch_size, 'rev' if rev else 'fwd', 1e6 * t_eager,
+                    1e6 * t_script, t_eager / t_script))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''Number of spline_coupling_layer blocks needed to match a stack of 8
+affine_coupling_layer blocks on a multimodal density, and the wall-clock
+cost of training and sampling either. Both are trained by maximum
+likelihood for the same number of steps on samples of a ring of 8 modes in
+two dimensions (like the multimodal phase posteriors), padded with 6
+dimensions of standard normal noise. The overlap score (normalized inner
+product of the two densities, as in chris_version/examples/gw_INN.py, here
+from 2D histograms) compares samples of the trained net to the target.
+
+Run with: python benchmarks/bench_spline_coupling.py'''
+
+import time
+from math import pi
+
+import numpy as np
+import torch
+
+from FrEIA.modules import affine_coupling_layer, spline_coupling_layer
+
+from nets import coupling_args, chain_net
+
+width = 8
+
+
+def target(n):
+    '''Ring of 8 modes in the first two dimensions, noise in the others'''
+    angle = 2 * pi * torch.randint(8, (n,)).float() / 8
+    x = torch.randn(n, width)
+    x[:, 0] = 2 * torch.cos(angle) + 0.15 * x[:, 0]
+    x[:, 1] = 2 * torch.sin(angle) + 0.15 * x[:, 1]
+    return x
+
+
+def build_net(block, n_blocks, internal_size=64):
+    clamp = 2.0 if block is affine_coupling_layer else None
+    return chain_net(width, n_blocks, block,
+                     coupling_args(internal_size, clamp))
+
+
+def overlap(a, b, bins=60, extent=3.):
+    '''Overlap score of the densities of two sets of 2D samples'''
+    edges = np.linspace(-extent, extent, bins + 1)
+    p = np.histogram2d(a[:, 0], a[:, 1], bins=(edges, edges))[0]
+    q = np.histogram2d(b[:, 0], b[:, 1], bins=(edges, edges))[0]
+    return np.sum(p * q) / np.sqrt(np.sum(p**2) * np.sum(q**2))
+
+
+def train(net, n_steps, batch_size=256, lr=2e-3):
+    torch.manual_seed(1)
+    optim = torch.optim.Adam(net.parameters(), lr=lr)
+    sched = torch.optim.lr_scheduler.CosineAnnealingLR(optim, n_steps)
+    t = time.perf_counter()
+    for step in range(n_steps):
+        z, log_jac = net(target(batch_size), jac=True)
+        loss = torch.mean(0.5 * torch.sum(z**2, dim=1) - log_jac)
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+        sched.step()
+    return time.perf_counter() - t
+
+
+def main(n_steps=2000, n_samples=50000):
+    torch.manual_seed(2)
+    reference = target(n_samples)[:, :2].numpy()
+    ceiling = overlap(reference, target(n_samples)[:, :2].numpy())
+    print('overlap of two target sample sets: %.3f' % ceiling)
+
+    print('%-24s %7s %11s %10s %14s %9s' % ('block', 'blocks', 'parameters',
+                                           'train [s]', 'sampling [ms]',
+                                           'overlap'))
+    for block, n_blocks in ((affine_coupling_layer, 8),
+                            (spline_coupling_layer, 1),
+                            (spline_coupling_layer, 2),
+                            (spline_coupling_layer, 4)):
+        net = build_net(block, n_blocks)
+        t_train = train(net, n_steps)
+
+        net.eval()
+        z = torch.randn(n_samples, width)
+        with torch.no_grad():
+            net(z, rev=True)
+            t = time.perf_counter()
+            samples = net(z, rev=True)
+            t_sample = time.perf_counter() - t
+
+        print('%-24s %7d %11d %10.1f %14.1f %9.3f' % (
+            block.__name__, n_blocks,
+            sum(p.numel() for p in net.parameters()), t_train,
+            t_sample * 1e3, overlap(reference, samples[:, :2].numpy())))
+
+
+if __name__ == '__main__':
+    main()
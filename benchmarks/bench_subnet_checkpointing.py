@@ -0,0 +1,57 @@
+'''Activation memory and training throughput with and without checkpointing
+of the coupling subnets (ReversibleGraphNet.set_checkpointing), for growing
+internal sizes of the subnets. Activation memory is measured as the total
+size of all tensors autograd keeps for the backward pass.
+
+Run with: python benchmarks/bench_subnet_checkpointing.py'''
+
+import time
+
+import torch
+
+from FrEIA.modules import rev_multiplicative_layer, glow_coupling_layer
+
+from nets import coupling_args, chain_net
+
+
+def build_net(n_blocks, width, internal_size):
+    return chain_net(width, n_blocks,
+                     (glow_coupling_layer, rev_multiplicative_layer),
+                     coupling_args(internal_size))
+
+
+def training_step(net, x):
+    '''Maximum likelihood loss, returns bytes kept for backward and time'''
+    saved = [0]
+
+    def pack(t):
+        saved[0] += t.numel() * t.element_size()
+        return t
+
+    t0 = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        z, log_jac = net(x, jac=True)
+        loss = torch.mean(0.5 * torch.sum(z**2, dim=1) - log_jac)
+    loss.backward()
+    return saved[0], time.perf_counter() - t0
+
+
+def main(n_blocks=8, width=64, batch_size=1024, repeats=3):
+    print('%14s %12s %18s %14s' % ('internal size', 'checkpoint',
+                                   'activations [MB]', 'samples / s'))
+    x = torch.randn(batch_size, width)
+    for internal_size in (256, 512, 1024):
+        for checkpoint in (False, True):
+            net = build_net(n_blocks, width, internal_size)
+            net.set_checkpointing(checkpoint)
+            training_step(net, x)
+            results = [training_step(net, x) for i in range(repeats)]
+            memory = results[0][0]
+            duration = min(r[1] for r in results)
+            print('%14d %12s %18.2f %14.0f' % (
+                internal_size, checkpoint, memory / 2**20,
+                batch_size / duration))
+
+
+if __name__ == '__main__':
+    main()
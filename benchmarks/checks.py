@@ -0,0 +1,125 @@
+'''Quick correctness checks of what the benchmarks time, on small nets, so
+that they can run on their own (in seconds) before any timing run. Checks
+that need optional packages are skipped without them (e.g. the ONNX check
+without onnx and onnxruntime).
+
+Run from the root of the repository with:
+PYTHONPATH=. python benchmarks/checks.py'''
+
+import os
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from FrEIA.modules import (rev_multiplicative_layer, affine_coupling_layer,
+                           spline_coupling_layer)
+from FrEIA.onnx_export import export_all
+
+from nets import coupling_args, chain_net, whitened_net
+
+
+def export_nets(width=16):
+    '''The nets the exports are checked on'''
+    return [chain_net(width, 4, rev_multiplicative_layer).eval(),
+            chain_net(width, 4, spline_coupling_layer,
+                      coupling_args(clamp=None)).eval()]
+
+
+def check_affine_coupling(width=12, batch_size=8):
+    '''The reverse pass inverts the forward pass, and the log jacobian
+    determinant matches the one of the full jacobian from autograd.'''
+    net = chain_net(width, 4, affine_coupling_layer,
+                    coupling_args(2 * (width - width // 2))).double()
+    x = torch.randn(batch_size, width, dtype=torch.float64)
+
+    z, log_jac = net(x, jac=True)
+    assert torch.allclose(net(z, rev=True), x, atol=1e-10)
+    x_rec, log_jac_rev = net(z, rev=True, jac=True)
+    assert torch.allclose(log_jac_rev, -log_jac, atol=1e-10)
+
+    for i in range(batch_size):
+        J = torch.autograd.functional.jacobian(
+            lambda t: net(t[None])[0], x[i])
+        assert torch.allclose(torch.slogdet(J)[1], log_jac[i], atol=1e-8)
+
+
+def check_optimize(width=32):
+    '''optimize_graph doesn't change the results in either direction.'''
+    net = whitened_net(width, 3).eval()
+    optimized = net.optimized()
+    assert len(optimized.plan.steps) < len(net.plan.steps)
+    with torch.no_grad():
+        for batch_size in (1, 64):
+            x = torch.randn(batch_size, width)
+            for rev in (False, True):
+                assert torch.allclose(net(x, rev=rev), optimized(x, rev=rev),
+                                      rtol=1e-4, atol=1e-4)
+
+
+def check_scripted_export(width=16, batch_size=64):
+    '''The frozen scripted exports match eager execution. With a mixed
+    precision policy, the exports run in the precision of the data.'''
+    # Beyond the bound of the splines as well
+    x = 4 * torch.randn(batch_size, width)
+    for net in export_nets(width):
+        for subnet_dtype in (None, torch.bfloat16):
+            net.set_precision(subnet_dtype)
+            scripted = {
+                False: torch.jit.freeze(torch.jit.script(
+                    net.export_forward())),
+                True: torch.jit.freeze(torch.jit.script(
+                    net.export_reverse())),
+            }
+            net.set_precision(None)
+            with torch.no_grad():
+                for rev in (False, True):
+                    assert torch.allclose(net(x, rev=rev), scripted[rev](x),
+                                          atol=1e-5)
+
+
+def check_onnx_export(width=16, batch_size=64):
+    '''The ONNX exports, run with ONNX Runtime, match eager execution.
+    Returns False if onnxruntime is missing.'''
+    try:
+        import onnxruntime
+    except ImportError:
+        return False
+
+    # Beyond the bound of the splines as well
+    x = 4 * torch.randn(batch_size, width)
+    for net in export_nets(width):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = export_all(net, os.path.join(tmp, 'net'))
+            sessions = {key: onnxruntime.InferenceSession(
+                            path, providers=['CPUExecutionProvider'])
+                        for key, path in paths.items()}
+
+        with torch.no_grad():
+            for key, rev, jac in (('forward', False, False),
+                                  ('reverse', True, False),
+                                  ('forward_jac', False, True)):
+                expected = net(x, rev=rev, jac=jac)
+                expected = list(expected) if jac else [expected]
+                got = sessions[key].run(None, {'input_0': x.numpy()})
+                for e, g in zip(expected, got):
+                    assert np.abs(e.numpy() - g).max() < 1e-4, key
+    return True
+
+
+def main():
+    warnings.simplefilter('ignore')
+    torch.manual_seed(0)
+    for check in (check_affine_coupling, check_optimize,
+                  check_scripted_export, check_onnx_export):
+        t = time.perf_counter()
+        ran = check()
+        print('%-24s %s (%.1f s)' % (
+            check.__name__[len('check_'):],
+            'skipped' if ran is False else 'ok', time.perf_counter() - t))
+
+
+if __name__ == '__main__':
+    main()
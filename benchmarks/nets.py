@@ -0,0 +1,86 @@
+'''Net builders shared by the benchmarks and by checks.py. Most benchmarks run
+on a RadynversionNet-like chain of coupling blocks and permutations, built
+with chain_net.'''
+
+import torch
+
+from FrEIA.framework import InputNode, OutputNode, Node, ReversibleGraphNet
+from FrEIA.modules import (rev_multiplicative_layer, permute_layer,
+                           linear_transform, F_fully_connected)
+
+
+def coupling_args(internal_size=None, clamp=2.0, F_class=F_fully_connected):
+    '''Arguments of a coupling block with F_class subnets of the given hidden
+    width (None: the default of F_class). clamp=None leaves it out, for
+    blocks without one (spline_coupling_layer).'''
+    args = {'F_class': F_class}
+    if clamp is not None:
+        args['clamp'] = clamp
+    if internal_size is not None:
+        args['F_args'] = {'internal_size': internal_size}
+    return args
+
+
+def chain_nodes(width, n_blocks, block=rev_multiplicative_layer,
+                block_args=None, conditions=None, final_permute=True):
+    '''Node list of n_blocks coupling blocks on vectors of width dimensions,
+    each followed by a permute_layer seeded with its index (except for the
+    last one with final_permute=False). block is a module class, or a tuple
+    of them used in turns. block_args are the arguments of every block,
+    coupling_args() by default. The blocks get the ConditionNodes in
+    conditions, which are not part of the list.'''
+    if block_args is None:
+        block_args = coupling_args()
+    blocks = block if isinstance(block, tuple) else (block,)
+
+    nodes = [InputNode(width, name='input')]
+    for i in range(n_blocks):
+        nodes.append(Node([nodes[-1].out0], blocks[i % len(blocks)],
+                          block_args, name='coupling_%d' % i,
+                          conditions=conditions))
+        if final_permute or i != n_blocks - 1:
+            nodes.append(Node([nodes[-1].out0], permute_layer, {'seed': i},
+                              name='permute_%d' % i))
+    nodes.append(OutputNode([nodes[-1].out0], name='output'))
+    return nodes
+
+
+def chain_net(width, n_blocks, block=rev_multiplicative_layer,
+              block_args=None, conditions=None, final_permute=True, seed=0,
+              **kwargs):
+    '''ReversibleGraphNet of chain_nodes (and the conditions), initialized
+    after torch.manual_seed(seed), or from the current state of the global
+    generator for seed=None. kwargs are passed to ReversibleGraphNet, with
+    verbose=False by default.'''
+    if seed is not None:
+        torch.manual_seed(seed)
+    nodes = chain_nodes(width, n_blocks, block, block_args, conditions,
+                        final_permute)
+    kwargs.setdefault('verbose', False)
+    return ReversibleGraphNet(nodes + list(conditions or []), **kwargs)
+
+
+def whitened_net(width, n_blocks, seed=0):
+    '''Chain of blocks as produced by stacking sub-graphs that each start and
+    end with a permutation, with a fixed whitening linear_transform at the
+    input and its inverse at the output, i.e. with plenty of work for
+    optimize_graph.'''
+    torch.manual_seed(seed)
+    M = torch.randn(width, width) / width**0.5 + torch.eye(width)
+    b = torch.randn(width)
+
+    nodes = [InputNode(width, name='input')]
+    nodes.append(Node([nodes[-1].out0], linear_transform, {'M': M, 'b': b},
+                      name='whiten'))
+    for i in range(n_blocks):
+        nodes.append(Node([nodes[-1].out0], permute_layer, {'seed': 2*i},
+                          name='permute_in_%d' % i))
+        nodes.append(Node([nodes[-1].out0], rev_multiplicative_layer,
+                          coupling_args(), name='coupling_%d' % i))
+        nodes.append(Node([nodes[-1].out0], permute_layer, {'seed': 2*i+1},
+                          name='permute_out_%d' % i))
+    nodes.append(Node([nodes[-1].out0], linear_transform,
+                      {'M': M.inverse(), 'b': -b.matmul(M.inverse().t())},
+                      name='unwhiten'))
+    nodes.append(OutputNode([nodes[-1].out0], name='output'))
+    return ReversibleGraphNet(nodes, verbose=False)
@@ -0,0 +1,57 @@
+'''Stress test for sharing one ReversibleGraphNet between inference threads.
+Every thread runs forward, reverse and jacobian passes on its own inputs and
+compares them with single threaded reference results. Also reports the
+throughput against running the same calls in one thread.
+
+Run with: python benchmarks/stress_concurrent_inference.py'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from nets import chain_net
+
+
+def run_calls(net, inputs):
+    '''Alternating forward, reverse and jacobian calls'''
+    results = []
+    for k, x in enumerate(inputs):
+        if k % 3 == 0:
+            results.append(net(x))
+        elif k % 3 == 1:
+            results.append(net(x, rev=True))
+        else:
+            results.append(net.jacobian(x))
+    return results
+
+
+def main(n_threads=8, calls_per_thread=60, batch_size=64, width=64):
+    net = chain_net(width, 8).eval()
+    inputs = [[torch.randn(batch_size, width)
+               for k in range(calls_per_thread)] for t in range(n_threads)]
+
+    with torch.no_grad():
+        t0 = time.perf_counter()
+        reference = [run_calls(net, xs) for xs in inputs]
+        t_serial = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(n_threads) as pool:
+            concurrent = list(pool.map(lambda xs: run_calls(net, xs),
+                                       inputs))
+        t_concurrent = time.perf_counter() - t0
+
+    mismatches = sum(not torch.equal(a, b)
+                     for ref, res in zip(reference, concurrent)
+                     for a, b in zip(ref, res))
+    n_calls = n_threads * calls_per_thread
+    print('%d threads, %d calls: %d mismatching results' % (
+        n_threads, n_calls, mismatches))
+    print('calls / s: %.0f in one thread, %.0f concurrent' % (
+        n_calls / t_serial, n_calls / t_concurrent))
+    assert mismatches == 0
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,8 @@ from torch import nn
 import numpy as np
 
 from FrEIA.framework import InputNode, OutputNode, Node, ReversibleGraphNet
-from FrEIA.modules import rev_multiplicative_layer, permute_layer
+from FrEIA.multiscale import multiscale_nodes
+from FrEIA.modules import rev_multiplicative_layer, affine_coupling_layer, spline_coupling_layer, permute_layer
 
 from loss import mse, mse_tv, mmd_multiscale_on
 
@@ -214,7 +215,8 @@ class F_fully_connected_leaky(nn.Module):
         return out
 
 class RadynversionNet(ReversibleGraphNet):
-    def __init__(self, inputs, outputs, zeroPadding=0, numInvLayers=5, dropout=0.00, minSize=None, clamp=2.0):
+    def __init__(self, inputs, outputs, zeroPadding=0, numInvLayers=5, dropout=0.00, minSize=None, clamp=2.0,
+                 coupling_layer=affine_coupling_layer, numScales=1, factorOut=0.5):
         # Determine dimensions and construct DataSchema
         inMinLength = schema_min_len(inputs, zeroPadding)
         outMinLength = schema_min_len(outputs, zeroPadding)
@@ -228,15 +230,41 @@ class RadynversionNet(ReversibleGraphNet):
         if len(self.inSchema) != len(self.outSchema):
             raise ValueError('Input and output schemas do not have the same dimension.')
 
+        # affine_coupling_layer computes the same kind of block as
+        # rev_multiplicative_layer with half the subnets. Its subnets have a
+        # head of twice the width, so the hidden width is set to that of the
+        # rev_multiplicative_layer subnets instead of the default (twice the
+        # output width).
+        # The same holds for the even wider heads of spline_coupling_layer,
+        # which has no clamp, as its splines are bounded by construction.
+        def layerArgs(nChannels):
+            fArgs = {'dropout': dropout}
+            args = {'F_class': F_fully_connected_leaky, 'F_args': fArgs}
+            if coupling_layer in (affine_coupling_layer, spline_coupling_layer):
+                fArgs['internal_size'] = 2 * (nChannels - nChannels // 2)
+            if coupling_layer is not spline_coupling_layer:
+                args['clamp'] = clamp
+            return args
+
+        if numScales > 1:
+            # Multi-scale net: after each of the numScales groups of blocks
+            # but the last, the fraction factorOut of the dimensions skips the
+            # remaining blocks. The factored out parts are concatenated again,
+            # so the output still has the layout of outSchema.
+            nodes = multiscale_nodes(len(self.inSchema), coupling_layer, layerArgs, numInvLayers,
+                                     n_scales=numScales, factor_out=factorOut, merge_outputs=True,
+                                     name='Radynversion')
+            super().__init__(nodes)
+            return
+
         # Build net graph
         inp = InputNode(len(self.inSchema), name='Input (0-pad extra channels)')
         nodes = [inp]
 
         # add requested number of nodes to INN
         for i in range(numInvLayers):
-            nodes.append(Node([nodes[-1].out0], rev_multiplicative_layer,
-                         {'F_class': F_fully_connected_leaky, 'clamp': clamp,
-                          'F_args': {'dropout': dropout}}, name='Inv%d' % i))
+            nodes.append(Node([nodes[-1].out0], coupling_layer, layerArgs(len(self.inSchema)),
+                              name='Inv%d' % i))
             if (i != numInvLayers - 1):
                 nodes.append(Node([nodes[-1].out0], permute_layer, {'seed': i}, name='Permute%d' % i))
 